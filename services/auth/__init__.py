@@ -37,6 +37,7 @@
 """
 import abc
 from services.pluginreg import PluginRegistry
+from services.util import BackendError
 
 
 class NodeAttributionError(Exception):
@@ -209,6 +210,152 @@ class ServicesAuth(PluginRegistry):
             True if the deletion was successful, False otherwise
         """
 
+    def create_users(self, users, batch_size=100):
+        """Creates users in bulk
+
+        Backends should override this method when they can do better than
+        calling create_user for each user. See also create_users() in this
+        module, which works with any backend.
+
+        Args:
+            - users: iterable of (user_name, password, email) tuples
+            - batch_size: number of users created at once
+
+        Returns:
+            list of (True or False, Error Message) tuples, in the users
+            order
+        """
+        return _create_users(self, users)
+
+    def get_user_ids(self, user_names, batch_size=100):
+        """Returns the ids of several users
+
+        Backends should override this method when they can do better than
+        calling get_user_id for each user. See also get_user_ids() in this
+        module, which works with any backend.
+
+        Args:
+            - user_names: iterable of user names
+            - batch_size: number of users looked up at once
+
+        Returns:
+            dict mapping each user name to its id. None if not found.
+        """
+        return _get_user_ids(self, user_names)
+
+    def get_user_infos(self, user_ids, batch_size=100):
+        """Returns the info of several users
+
+        Backends should override this method when they can do better than
+        calling get_user_info for each user. See also get_user_infos() in
+        this module, which works with any backend.
+
+        Args:
+            - user_ids: iterable of user ids
+            - batch_size: number of users looked up at once
+
+        Returns:
+            dict mapping each user id to a (username, email) tuple.
+            (None, None) if not found.
+        """
+        return _get_user_infos(self, user_ids)
+
+
+def _create_users(auth, users):
+    results = []
+    for user_name, password, email in users:
+        try:
+            if auth.create_user(user_name, password, email):
+                results.append((True, None))
+            else:
+                results.append((False, 'Could not create %r' % user_name))
+        except BackendError:
+            raise
+        except Exception, e:
+            results.append((False, str(e)))
+    return results
+
+
+def create_users(auth, users, batch_size=100):
+    """Creates users in bulk with any backend.
+
+    Uses the backend create_users method if it has one, otherwise calls
+    create_user for each user. See ServicesAuth.create_users.
+    """
+    bulk = getattr(auth, 'create_users', None)
+    if bulk is not None:
+        return bulk(users, batch_size)
+    return _create_users(auth, users)
+
+
+def _get_user_ids(auth, user_names):
+    return dict([(user_name, auth.get_user_id(user_name))
+                 for user_name in user_names])
+
+
+def match_user_names(user_names, found):
+    """Maps the requested user names to the users a backend found.
+
+    "found" is a list of (user name, value) pairs, as returned by the
+    backend. Backends can match the names regardless of their case, so
+    the found names are matched exactly first, then case-insensitively.
+
+    Returns a mapping of the requested names to their value, or None.
+    """
+    res = dict([(user_name, None) for user_name in user_names])
+    folded = {}
+    for user_name, value in found:
+        if user_name in res:
+            res[user_name] = value
+        folded.setdefault(user_name.lower(), value)
+
+    for user_name in res:
+        if res[user_name] is None:
+            res[user_name] = folded.get(user_name.lower())
+    return res
+
+
+def match_user_ids(user_ids):
+    """Maps the user ids, as integers, to the requested user ids.
+
+    The callers can pass the ids as strings, while the backends return
+    integers. The ids that are not integers are left out.
+    """
+    res = {}
+    for user_id in user_ids:
+        try:
+            res[int(user_id)] = user_id
+        except (TypeError, ValueError):
+            continue
+    return res
+
+
+def get_user_ids(auth, user_names, batch_size=100):
+    """Returns the ids of several users with any backend.
+
+    See ServicesAuth.get_user_ids.
+    """
+    bulk = getattr(auth, 'get_user_ids', None)
+    if bulk is not None:
+        return bulk(user_names, batch_size)
+    return _get_user_ids(auth, user_names)
+
+
+def _get_user_infos(auth, user_ids):
+    return dict([(user_id, auth.get_user_info(user_id))
+                 for user_id in user_ids])
+
+
+def get_user_infos(auth, user_ids, batch_size=100):
+    """Returns the info of several users with any backend.
+
+    See ServicesAuth.get_user_infos.
+    """
+    bulk = getattr(auth, 'get_user_infos', None)
+    if bulk is not None:
+        return bulk(user_ids, batch_size)
+    return _get_user_infos(auth, user_ids)
+
 
 def get_auth(config):
     """Returns an auth backend instance, given a config.
@@ -219,7 +366,7 @@ def get_auth(config):
 
     - "auth.backend" must be present and contain a fully qualified name of a
       backend class to be used, or the name of any backend services provides.
-      "sql", "ldap" or "dummy".
+      "sql", "shardedsql", "ldap" or "dummy".
 
     - other keys that starts with "auth." are passed to the backend
       constructor -- with the prefix stripped.
@@ -231,6 +378,12 @@ def get_auth(config):
     except ImportError:
         pass
 
+    try:
+        from services.auth.shardedsql import ShardedSQLAuth
+        ServicesAuth.register(ShardedSQLAuth)
+    except ImportError:
+        pass
+
     try:
         from services.auth.ldapsql import LDAPAuth
         ServicesAuth.register(LDAPAuth)
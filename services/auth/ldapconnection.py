@@ -42,7 +42,8 @@ from threading import RLock
 from ldap.ldapobject import ReconnectLDAPObject
 import ldap
 
-from services.util import BackendError, BackendTimeoutError
+from services.util import (BackendError, BackendTimeoutError,
+                           report_backend_call)
 
 
 class MaxConnectionReachedError(Exception):
@@ -166,7 +167,9 @@ class ConnectionManager(object):
                     connected = True
 
             if not connected:
+                report_backend_call(False)
                 raise BackendError(str(e))
+            report_backend_call(True)
 
         conn.active = True
         return conn
@@ -244,6 +247,19 @@ class ConnectionManager(object):
         finally:
             self._release_connection(conn)
 
+    def close(self):
+        """Unbinds the connectors that are not in use."""
+        with self._pool_lock:
+            for conn in list(self._pool):
+                if conn.active:
+                    continue
+                try:
+                    conn.unbind_ext_s()
+                except ldap.LDAPError:
+                    # invalid state
+                    pass
+                self._pool.remove(conn)
+
     def purge(self, bind, passwd=None):
         if self.use_pool:
             return
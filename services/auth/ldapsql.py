@@ -39,16 +39,20 @@ from hashlib import sha1
 import random
 
 import ldap
+from ldap.filter import escape_filter_chars
 
 from sqlalchemy.ext.declarative import declarative_base, Column
 from sqlalchemy import Integer, String
-from sqlalchemy import create_engine, SmallInteger
+from sqlalchemy import SmallInteger
 from sqlalchemy.sql import select, insert, update, and_
 
-from services.util import BackendError, ssha
-from services.auth import NodeAttributionError
+from services.util import (BackendError, LRUCache, get_hasher, batch,
+                           safe_execute)
+from services.hashpool import hash_password, hash_passwords
+from services.auth import NodeAttributionError, match_user_names
 from services.auth.ldapconnection import ConnectionManager, StateConnector
-from services.auth.resetcode import ResetCodeManager
+from services.engines import create_engine
+from services.auth.resetcode import ResetCodeManager, get_storage
 from services import logger
 
 #
@@ -78,11 +82,24 @@ class AvailableNodes(_Base):
 
 available_nodes = AvailableNodes.__table__
 
+_SSHA = get_hasher('ssha')
+
 tables = [userids, available_nodes]
 
 
 class LDAPAuth(ResetCodeManager):
-    """LDAP authentication."""
+    """LDAP authentication.
+
+    If negative_cache_size is set, the user names that were not found are
+    remembered for negative_cache_ttl seconds, so lookups for unknown
+    users don't hit the LDAP server every time.
+
+    The bulk lookups search for at most ldap_batch_size users at once.
+
+    The reset codes are kept in the reset_codes table of sqluri, unless
+    reset_code_storage names another storage ("memory", or "file" with
+    reset_code_path). See services.auth.resetcode.get_storage.
+    """
 
     def __init__(self, ldapuri, sqluri, use_tls=False, bind_user='binduser',
                  bind_password='binduser', admin_user='adminuser',
@@ -91,7 +108,10 @@ class LDAPAuth(ResetCodeManager):
                  reset_on_return=True, single_box=False, ldap_timeout=-1,
                  nodes_scheme='https', check_account_state=True,
                  create_tables=False, ldap_pool_size=10, ldap_use_pool=False,
-                 connector_cls=StateConnector, **kw):
+                 connector_cls=StateConnector, negative_cache_size=0,
+                 negative_cache_ttl=60, ldap_batch_size=50, pool_timeout=None,
+                 max_overflow=None, reset_code_storage=None,
+                 reset_code_path=None, **kw):
         self.check_account_state = check_account_state
         self.ldapuri = ldapuri
         self.sqluri = sqluri
@@ -105,14 +125,23 @@ class LDAPAuth(ResetCodeManager):
         self.single_box = single_box
         self.nodes_scheme = nodes_scheme
         self.ldap_timeout = ldap_timeout
+        self.ldap_batch_size = int(ldap_batch_size)
         # by default, the ldap connections use the bind user
         self.conn = ConnectionManager(ldapuri, bind_user, bind_password,
                                       use_tls=use_tls, timeout=ldap_timeout,
                                       size=ldap_pool_size,
                                       use_pool=ldap_use_pool,
                                       connector_cls=connector_cls)
-        sqlkw = {'pool_size': int(pool_size),
-                 'pool_recycle': int(pool_recycle),
+        if int(negative_cache_size) > 0:
+            self._unknown_users = LRUCache(negative_cache_size,
+                                           negative_cache_ttl)
+        else:
+            self._unknown_users = None
+
+        sqlkw = {'pool_size': pool_size,
+                 'pool_recycle': pool_recycle,
+                 'pool_timeout': pool_timeout,
+                 'max_overflow': max_overflow,
                  'logging_name': 'weaveserver'}
 
         if self.sqluri is not None:
@@ -126,7 +155,14 @@ class LDAPAuth(ResetCodeManager):
         else:
             engine = None
 
-        ResetCodeManager.__init__(self, engine, create_tables=create_tables)
+        if reset_code_storage is None:
+            storage = None
+        else:
+            storage = get_storage(reset_code_storage, engine=engine,
+                                  create_tables=create_tables,
+                                  path=reset_code_path)
+        ResetCodeManager.__init__(self, engine, create_tables=create_tables,
+                                  storage=storage)
 
     def _conn(self, bind=None, passwd=None):
         return self.conn.connection(bind, passwd)
@@ -134,17 +170,35 @@ class LDAPAuth(ResetCodeManager):
     def _purge_conn(self, bind, passwd=None):
         self.conn.purge(bind, passwd=None)
 
+    def close(self):
+        """Closes the pooled LDAP and database connections."""
+        self.conn.close()
+        ResetCodeManager.close(self)
+
     @classmethod
     def get_name(self):
         """Returns the name of the authentication backend"""
         return 'ldap'
 
+    def _is_unknown(self, user_name):
+        """Returns True if the user was recently looked up and not found"""
+        return (self._unknown_users is not None and
+                user_name in self._unknown_users)
+
+    def _set_unknown(self, user_name):
+        if self._unknown_users is not None:
+            self._unknown_users.set(user_name, True)
+
     def _get_dn(self, user_name=None, user_id=None):
         dn = self.users_root
 
         #if we already have the uid, just build it
         if user_id:
             return "uidNumber=%i,%s" % (user_id, dn)
+
+        if self._is_unknown(user_name):
+            return None
+
         scope = ldap.SCOPE_SUBTREE
         filter = '(uid=%s)' % user_name
 
@@ -157,9 +211,11 @@ class LDAPAuth(ResetCodeManager):
                 logger.debug('Could not get the user info from ldap')
                 raise BackendError(str(e))
             except ldap.NO_SUCH_OBJECT:
+                self._set_unknown(user_name)
                 return None
 
         if user is None or len(user) == 0:
+            self._set_unknown(user_name)
             return None
 
         #dn is actually the first element that comes back. Don't need attr
@@ -192,6 +248,9 @@ class LDAPAuth(ResetCodeManager):
 
     def get_user_id(self, user_name):
         """Returns the id for a user name"""
+        if self._is_unknown(user_name):
+            return None
+
         dn = self.users_root
         if dn == 'md5':
             dn = self.users_base_dn
@@ -207,24 +266,96 @@ class LDAPAuth(ResetCodeManager):
                 logger.debug('Could not get the user id from ldap.')
                 raise BackendError(str(e))
             except ldap.NO_SUCH_OBJECT:
+                self._set_unknown(user_name)
                 return None
 
         if user is None or len(user) == 0:
+            self._set_unknown(user_name)
             return None
         user = user[0][1]
         return user['uidNumber'][0]
 
+    def _search_many(self, key, values, attrs, batch_size):
+        """Yields the attributes of the users whose key is in values.
+
+        The values are looked up with OR filters of at most batch_size
+        terms.
+        """
+        dn = self.users_root
+        if dn == 'md5':
+            dn = self.users_base_dn
+        scope = ldap.SCOPE_SUBTREE
+        batch_size = min(batch_size, self.ldap_batch_size)
+
+        for values in batch(values, batch_size):
+            filter = ''.join(['(%s=%s)' % (key, escape_filter_chars(str(v)))
+                              for v in values])
+            filter = '(|%s)' % filter
+
+            with self._conn() as conn:
+                try:
+                    found = conn.search_st(dn, scope, filterstr=filter,
+                                           attrlist=attrs,
+                                           timeout=self.ldap_timeout)
+                except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
+                    logger.debug('Could not get the users from ldap.')
+                    raise BackendError(str(e))
+                except ldap.NO_SUCH_OBJECT:
+                    continue
+
+            for __, user in found or []:
+                yield user
+
+    def get_user_ids(self, user_names, batch_size=100):
+        """Returns a mapping of user names to their ids.
+
+        Runs one search per batch of users, with at most ldap_batch_size
+        users per search.
+        """
+        res = {}
+        todo = []
+        for user_name in user_names:
+            res[user_name] = None
+            if not self._is_unknown(user_name):
+                todo.append(user_name)
+
+        found = [(user['uid'][0], user['uidNumber'][0])
+                 for user in self._search_many('uid', set(todo),
+                                               ['uid', 'uidNumber'],
+                                               batch_size)]
+
+        # the uid matching ignores the case
+        res.update(match_user_names(todo, found))
+        for user_name in todo:
+            if res[user_name] is None:
+                self._set_unknown(user_name)
+        return res
+
+    def get_user_infos(self, user_ids, batch_size=100):
+        """Returns a mapping of user ids to (username, email) tuples.
+
+        Runs one search per batch of users, with at most ldap_batch_size
+        users per search.
+        """
+        ids = dict([(str(user_id), user_id) for user_id in user_ids])
+        res = dict([(user_id, (None, None)) for user_id in ids.values()])
+        for user in self._search_many('uidNumber', ids.keys(),
+                                      ['uid', 'uidNumber', 'mail'],
+                                      batch_size):
+            user_id = ids.get(str(user['uidNumber'][0]))
+            if user_id is not None:
+                res[user_id] = user['uid'][0], user['mail'][0]
+        return res
+
     def _get_next_user_id(self):
         """Returns the next user id"""
         # XXX see if we could use back-sql instead to deal with autoinc
-        res = self._engine.execute(insert(userids))
+        res = safe_execute(self._engine, insert(userids))
         return res.inserted_primary_key[0]
 
-    def create_user(self, user_name, password, email):
-        """Creates a user. Returns True on success."""
-        user_name = str(user_name)   # XXX only ASCII
+    def _user_entry(self, user_name, password_hash, email):
+        """Returns the dn and attributes of a new user"""
         user_id = self._get_next_user_id()
-        password_hash = ssha(password)
         key = '%s%s' % (random.randint(0, 9999999), user_name)
         key = sha1(key).hexdigest()
 
@@ -239,8 +370,16 @@ class LDAPAuth(ResetCodeManager):
                 'mail-verified': key,
                 'objectClass': ['dataStore', 'inetOrgPerson']}
 
-        user = user.items()
         dn = "uidNumber=%i,%s" % (user_id, self.users_root)
+        return dn, user.items()
+
+    def create_user(self, user_name, password, email):
+        """Creates a user. Returns True on success."""
+        user_name = str(user_name)   # XXX only ASCII
+        if self._unknown_users is not None:
+            self._unknown_users.delete(user_name)
+        password_hash = hash_password(_SSHA, password)
+        dn, user = self._user_entry(user_name, password_hash, email)
 
         with self._conn(self.admin_user, self.admin_password) as conn:
             try:
@@ -251,11 +390,54 @@ class LDAPAuth(ResetCodeManager):
 
         return res == ldap.RES_ADD
 
+    def create_users(self, users, batch_size=100):
+        """Creates users in bulk.
+
+        The add requests of a batch are all sent before their results are
+        read.
+
+        Returns a list of (True or False, Error Message) tuples.
+        """
+        results = []
+        for users_batch in batch(users, batch_size):
+            users_batch = [(str(user_name), password, email)
+                           for user_name, password, email in users_batch]
+            hashes = hash_passwords(_SSHA, [password for __, password, __
+                                            in users_batch])
+            entries = []
+            for (user_name, __, email), hash in zip(users_batch, hashes):
+                if self._unknown_users is not None:
+                    self._unknown_users.delete(user_name)
+                entries.append(self._user_entry(user_name, hash, email))
+
+            with self._conn(self.admin_user, self.admin_password) as conn:
+                try:
+                    msgids = [conn.add(dn, user) for dn, user in entries]
+                except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
+                    logger.debug('Could not create the users.')
+                    raise BackendError(str(e))
+
+                for msgid in msgids:
+                    try:
+                        res, __ = conn.result(msgid)
+                    except (ldap.TIMEOUT, ldap.SERVER_DOWN), e:
+                        logger.debug('Could not create the users.')
+                        raise BackendError(str(e))
+                    except ldap.LDAPError, e:
+                        results.append((False, str(e)))
+                    else:
+                        results.append((res == ldap.RES_ADD, None))
+
+        return results
+
     def authenticate_user(self, user_name, passwd):
         """Authenticates a user given a user_name and password.
 
         Returns the user id in case of success. Returns None otherwise."""
         dn = self._get_dn(user_name)
+        if dn is None:
+            return None
+
         attrs = ['uidNumber']
         if self.check_account_state:
             attrs.append('account-enabled')
@@ -373,7 +555,7 @@ class LDAPAuth(ResetCodeManager):
             ldap_password = old_password
             # we need a password
 
-        password_hash = ssha(new_password)
+        password_hash = hash_password(_SSHA, new_password)
         user = [(ldap.MOD_REPLACE, 'userPassword', [password_hash])]
 
         try:
@@ -454,7 +636,7 @@ class LDAPAuth(ResetCodeManager):
         query = select([available_nodes]).where(where)
         query = query.order_by(available_nodes.c.actives).limit(1)
 
-        res = self._engine.execute(query)
+        res = safe_execute(self._engine, query)
         res = res.fetchone()
         if res is None:
             # unable to get a node
@@ -489,7 +671,7 @@ class LDAPAuth(ResetCodeManager):
             query = query.where(available_nodes.c.node == node)
             query = query.values(available_assignments=available - 1,
                                  actives=actives + 1)
-            self._engine.execute(query)
+            safe_execute(self._engine, query)
         finally:
             # we want to return the node even if the sql update fails
             return '%s://%s/' % (self.nodes_scheme, node)
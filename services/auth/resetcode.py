@@ -37,15 +37,35 @@
 
 Stores the reset codes in a SQL Table, per user name.
 
-The storage can be overriden.
+The storage can be overriden: besides "sql", the "memory" storage keeps
+the codes in the process and the "file" storage keeps them in a
+directory, for single-box deployments. Other storages can be added with
+register_storage.
+
+The expirations are stored as epoch seconds. Expired codes are ignored
+when looked up, and deleted in bulk by
+ResetCodeManager.purge_expired_reset_codes, which is meant to be called
+periodically. This module can be run from a cron job to do it with the
+auth backend of a config file:
+
+    $ python -m services.auth.resetcode /etc/sync/production.conf
 """
-import datetime
+import sys
+import time
+import optparse
+import os
+import threading
+import tempfile
+from hashlib import sha1
 
 from sqlalchemy.ext.declarative import declarative_base, Column
-from sqlalchemy import String, DateTime
-from sqlalchemy.sql import bindparam, select, insert, delete
+from sqlalchemy import String, Integer
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import bindparam, select, insert, update, delete, and_
 
-from services.util import generate_reset_code, check_reset_code, safe_execute
+from services.util import (generate_reset_code, check_reset_code,
+                           safe_execute, RESET_CODE_TTL, convert_config)
+from services.engines import ReadWriteEngines
 from services import logger
 
 
@@ -57,62 +77,331 @@ class ResetCodes(_Base):
 
     username = Column(String(32), primary_key=True, nullable=False)
     reset = Column(String(32))
-    expiration = Column(DateTime())
+    # epoch seconds
+    expiration = Column(Integer, index=True)
 
 reset_codes = ResetCodes.__table__
 
-_USER_RESET_CODE = select([reset_codes.c.expiration,
-                           reset_codes.c.reset],
-              reset_codes.c.username == bindparam('user_name'))
+# the expired codes are filtered out by the database
+_USER_RESET_CODE = select([reset_codes.c.reset],
+                          and_(reset_codes.c.username ==
+                               bindparam('user_name'),
+                               reset_codes.c.expiration > bindparam('now')))
 
+_DELETE_RESET_CODE = delete(reset_codes,
+                            reset_codes.c.username == bindparam('user_name'))
 
-class ResetCodeManager(object):
-    """ Implements the reset code methods for auth backends.
+_INSERT_RESET_CODE = insert(reset_codes).values(
+    username=bindparam('user_name'), reset=bindparam('code'),
+    expiration=bindparam('expires'))
+
+_UPDATE_RESET_CODE = update(reset_codes,
+                            reset_codes.c.username == bindparam('user_name'),
+                            {reset_codes.c.reset: bindparam('code'),
+                             reset_codes.c.expiration: bindparam('expires')})
+
+_EXPIRED_RESET_CODES = select([reset_codes.c.username],
+                              reset_codes.c.expiration < bindparam('now'))
+
+# the statements that can be kept compiled
+_STATEMENTS = (_USER_RESET_CODE, _DELETE_RESET_CODE, _INSERT_RESET_CODE,
+               _UPDATE_RESET_CODE)
+
+
+def _delete_expired(names):
+    """Returns a query deleting the given codes if they are still expired.
+
+    A code renewed since it was selected is kept.
     """
-    def __init__(self, engine, create_tables=False):
+    where = and_(reset_codes.c.username.in_(names),
+                 reset_codes.c.expiration < bindparam('now'))
+    return delete(reset_codes, where)
+
+
+class SQLResetCodeStorage(object):
+    """Stores the reset codes in the reset_codes table."""
+
+    def __init__(self, engine, create_tables=False, engines=None, **kw):
         self._engine = engine
-        if engine is not None:
-            reset_codes.metadata.bind = engine
-            if create_tables:
-                reset_codes.create(checkfirst=True)
+        if engines is None:
+            engines = ReadWriteEngines(engine)
+        self._engines = engines
+        reset_codes.metadata.bind = engine
+        if create_tables:
+            reset_codes.create(checkfirst=True)
 
-    #
-    # Private methods
-    #
-    def _get_reset_code(self, user_id):
-        res = self._engine.execute(_USER_RESET_CODE, user_name=user_id)
+    def get(self, user_id):
+        res = self._engines.read(('reset', user_id), _USER_RESET_CODE,
+                                 user_name=user_id, now=int(time.time()))
         res = res.fetchone()
-
-        if res is None or res.reset is None or res.expiration is None:
+        if res is None:
             return None
+        return res.reset
+
+    def set(self, user_id, code, expiration):
+        params = {'user_name': user_id, 'code': code,
+                  'expires': int(expiration)}
+
+        # update in place, or insert. If another process inserted a code
+        # in the meantime, ours replaces it.
+        res = safe_execute(self._engine, _UPDATE_RESET_CODE, **params)
+        if res.rowcount == 0:
+            try:
+                res = safe_execute(self._engine, _INSERT_RESET_CODE,
+                                   **params)
+            except IntegrityError:
+                res = safe_execute(self._engine, _UPDATE_RESET_CODE,
+                                   **params)
+        self._engines.written(('reset', user_id))
+        return res.rowcount == 1
+
+    def delete(self, user_id):
+        res = safe_execute(self._engine, _DELETE_RESET_CODE,
+                           user_name=user_id)
+        self._engines.written(('reset', user_id))
+        return res.rowcount > 0
 
-        if isinstance(res.expiration, basestring):
-            exp = datetime.datetime.strptime(res.expiration,
-                                             '%Y-%m-%d %H:%M:%S.%f')
+    def purge(self, batch_size=1000, pause=0.):
+        expired = _EXPIRED_RESET_CODES.limit(batch_size)
+        purged = 0
+        while True:
+            now = int(time.time())
+            res = safe_execute(self._engine, expired, now=now)
+            names = [row.username for row in res.fetchall()]
+            if not names:
+                break
+
+            res = safe_execute(self._engine, _delete_expired(names), now=now)
+            purged += res.rowcount
+            if len(names) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        return purged
+
+
+class MemoryResetCodeStorage(object):
+    """Stores the reset codes in memory.
+
+    The codes are also filed in a timing wheel by expiration, in slots of
+    `resolution` seconds, so the expired codes are dropped as the time
+    goes by without scanning all the codes.
+
+    The codes are not shared between processes.
+    """
+
+    def __init__(self, resolution=60, **kw):
+        self.resolution = resolution
+        self._codes = {}    # user id -> (code, expiration)
+        self._wheel = {}    # slot -> user ids expiring in the slot
+        self._swept = self._slot(time.time())
+        self._lock = threading.RLock()
+
+    def _slot(self, when):
+        return int(when // self.resolution)
+
+    def _sweep(self, now):
+        """Drops the codes filed in the slots that are over."""
+        slot = self._slot(now)
+        if slot - self._swept > len(self._wheel):
+            slots = [past for past in self._wheel if past < slot]
         else:
-            exp = res.expiration
+            slots = range(self._swept, slot)
+        self._swept = slot
+
+        purged = 0
+        for past in slots:
+            for user_id in self._wheel.pop(past, ()):
+                entry = self._codes.get(user_id)
+                if entry is not None and entry[1] <= now:
+                    del self._codes[user_id]
+                    purged += 1
+        return purged
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            entry = self._codes.get(user_id)
+            if entry is None:
+                return None
+            code, expiration = entry
+            if expiration <= now:
+                del self._codes[user_id]
+                return None
+            return code
 
-        if exp < datetime.datetime.now():
-            # expired
-            self.clear_reset_code(user_id)
+    def set(self, user_id, code, expiration):
+        with self._lock:
+            self._sweep(time.time())
+            self._codes[user_id] = code, expiration
+            # codes expiring in a slot already swept go in the next one
+            slot = max(self._slot(expiration), self._swept)
+            self._wheel.setdefault(slot, set()).add(user_id)
+        return True
+
+    def delete(self, user_id):
+        with self._lock:
+            return self._codes.pop(user_id, None) is not None
+
+    def purge(self, batch_size=1000, pause=0.):
+        now = time.time()
+        with self._lock:
+            purged = self._sweep(now)
+            # the current slot is only partly over
+            current = self._wheel.get(self._slot(now), set())
+            for user_id in list(current):
+                entry = self._codes.get(user_id)
+                if entry is None or entry[1] <= now:
+                    current.discard(user_id)
+                    if entry is not None:
+                        del self._codes[user_id]
+                        purged += 1
+            return purged
+
+
+class FileResetCodeStorage(object):
+    """Stores the reset codes in a directory, one file per user.
+
+    The files are replaced atomically, so the directory can be shared by
+    all the processes of a box.
+    """
+
+    def __init__(self, path, **kw):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, user_id):
+        return os.path.join(self.path, sha1(str(user_id)).hexdigest())
+
+    def _read(self, filename):
+        try:
+            with open(filename) as f:
+                code, expiration = f.read().split()
+        except (IOError, ValueError):
             return None
+        return code, float(expiration)
 
-        return res.reset
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            return False
+        return True
 
-    def _set_reset_code(self, user_id):
-        code, expiration = generate_reset_code()
-        query = delete(reset_codes).where(reset_codes.c.username == user_id)
-        self._engine.execute(query)
+    def get(self, user_id):
+        filename = self._filename(user_id)
+        entry = self._read(filename)
+        if entry is None:
+            return None
+        code, expiration = entry
+        if expiration <= time.time():
+            self._remove(filename)
+            return None
+        return code
+
+    def set(self, user_id, code, expiration):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            os.write(fd, '%s %d' % (code, expiration))
+        finally:
+            os.close(fd)
+        os.rename(tmp, self._filename(user_id))
+        return True
+
+    def delete(self, user_id):
+        return self._remove(self._filename(user_id))
+
+    def purge(self, batch_size=1000, pause=0.):
+        purged = 0
+        for index, name in enumerate(os.listdir(self.path)):
+            if name.startswith('.'):
+                continue
+            if pause and index and index % batch_size == 0:
+                time.sleep(pause)
+            filename = os.path.join(self.path, name)
+            entry = self._read(filename)
+            if entry is not None and entry[1] <= time.time():
+                if self._remove(filename):
+                    purged += 1
+        return purged
+
+
+# storage name -> storage class
+_STORAGES = {}
+
+
+def register_storage(name, klass):
+    """Registers a reset code storage.
+
+    The class must provide "get", "set", "delete" and "purge" methods. Its
+    constructor receives the options passed to get_storage, and must
+    ignore the ones it does not use.
+    """
+    _STORAGES[name] = klass
+
+
+def get_storage(name, **options):
+    """Returns a reset code storage.
+
+    The options are "engine", "engines" and "create_tables" for the SQL
+    storage, "path" for the file storage.
+    """
+    try:
+        klass = _STORAGES[name]
+    except KeyError:
+        raise ValueError('Unknown reset code storage %r' % name)
+    return klass(**options)
+
+
+register_storage('sql', SQLResetCodeStorage)
+register_storage('memory', MemoryResetCodeStorage)
+register_storage('file', FileResetCodeStorage)
+
+
+class ResetCodeManager(object):
+    """ Implements the reset code methods for auth backends.
+
+    The codes are kept by `storage`, which defaults to the reset_codes
+    table of `engine`. See get_storage.
+
+    The reset codes can be read from replicas by passing a
+    services.engines.ReadWriteEngines instance built on the same primary
+    engine.
+    """
+    def __init__(self, engine, create_tables=False, engines=None,
+                 storage=None):
+        self._engine = engine
+        if engines is None:
+            engines = ReadWriteEngines(engine)
+        self._engines = engines
+        if storage is None and engine is not None:
+            storage = SQLResetCodeStorage(engine, create_tables, engines)
+        self._reset_codes = storage
 
-        query = insert(reset_codes).values(reset=code,
-                                           expiration=expiration,
-                                           username=user_id)
+    def _storage(self):
+        if self._reset_codes is None:
+            raise NotImplementedError()
+        return self._reset_codes
 
-        res = safe_execute(self._engine, query)
+    def close(self):
+        """Closes the pooled database connections."""
+        if self._engine is not None:
+            self._engines.dispose()
+
+    #
+    # Private methods
+    #
+    def _get_reset_code(self, user_id):
+        return self._storage().get(user_id)
 
-        if res.rowcount != 1:
-            logger.debug('Unable to add a new reset code in the'
-                         ' reset_code table')
+    def _set_reset_code(self, user_id):
+        code, __ = generate_reset_code()
+        # epoch seconds, not a local time that DST changes make ambiguous
+        expiration = int(time.time()) + RESET_CODE_TTL
+        if not self._storage().set(user_id, code, expiration):
+            logger.debug('Unable to store a new reset code')
             return None  # XXX see if appropriate
 
         return code
@@ -139,9 +428,47 @@ class ResetCodeManager(object):
         return stored_code == code
 
     def clear_reset_code(self, user_id):
-        if self._engine is None:
-            raise NotImplementedError()
+        return self._storage().delete(user_id)
 
-        query = delete(reset_codes).where(reset_codes.c.username == user_id)
-        res = safe_execute(self._engine, query)
-        return res.rowcount > 0
+    def purge_expired_reset_codes(self, batch_size=1000, pause=0.):
+        """Deletes the expired reset codes.
+
+        The codes are deleted by batches of batch_size rows, with a pause
+        of `pause` seconds between batches, so the table is never locked
+        for long.
+
+        Returns the number of deleted codes.
+        """
+        purged = self._storage().purge(batch_size, pause)
+        if purged:
+            logger.info('Purged %d expired reset codes' % purged)
+        return purged
+
+
+def main(args=None):
+    """Purges the expired reset codes of the auth backend of a config."""
+    parser = optparse.OptionParser(usage='%prog [options] config_file')
+    parser.add_option('--batch-size', type='int', default=1000,
+                      help='number of codes deleted at once')
+    parser.add_option('--pause', type='float', default=0.1,
+                      help='seconds to wait between batches')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('A config file is required')
+
+    # services.auth imports this module
+    from services.auth import get_auth
+    config = convert_config({'configuration': 'file:' + args[0]})
+    auth = get_auth(config)
+    if not hasattr(auth, 'purge_expired_reset_codes'):
+        parser.error('The %r backend has no reset codes to purge'
+                     % auth.get_name())
+
+    purged = auth.purge_expired_reset_codes(options.batch_size,
+                                            options.pause)
+    print 'Purged %d expired reset codes' % purged
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,406 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Sharded SQL Authentication
+
+The users are spread over several databases, each one holding a users
+table managed by a SQLAuth instance. A user is stored in the shard picked
+by a stable hash of its name.
+
+The user ids are allocated in a directory database, which also records
+the shard of each user id.
+"""
+import threading
+from hashlib import md5
+
+from sqlalchemy.ext.declarative import declarative_base, Column
+from sqlalchemy import Integer, SmallInteger
+from sqlalchemy.sql import bindparam, select, insert, delete
+
+from services.util import safe_execute, LRUCache, batch, BackendError
+from services.hashpool import hash_password, hash_passwords
+from services.engines import split_uris
+from services.auth import match_user_ids
+from services.auth.sql import SQLAuth, _create_engine, _CREATE_USER_ID
+
+_Base = declarative_base()
+
+
+class UserShards(_Base):
+    __tablename__ = 'user_shards'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    shard = Column(SmallInteger, nullable=False)
+
+user_shards = UserShards.__table__
+
+_USER_SHARD = select([user_shards.c.shard],
+                     user_shards.c.id == bindparam('user_id'))
+
+_NEW_USER = insert(user_shards).values(shard=bindparam('shard_index'))
+
+_DELETE_USER = delete(user_shards, user_shards.c.id == bindparam('user_id'))
+
+# options that would be the same for every shard
+_SHARD_OPTIONS = ('sqluri_read', 'reset_code_storage', 'reset_code_path')
+
+
+def _fan_out(func, groups):
+    """Calls func(shard, items) for each (shard, items) in groups.
+
+    The calls are made in parallel. Returns the list of results, in the
+    groups order. If a call fails, its exception is raised.
+    """
+    groups = list(groups)
+    if len(groups) == 1:
+        return [func(*groups[0])]
+
+    results = [None] * len(groups)
+    errors = []
+
+    def _call(index, shard, items):
+        try:
+            results[index] = func(shard, items)
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_call, args=(index,) + group)
+               for index, group in enumerate(groups)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+class ShardedSQLAuth(object):
+    """SQL authentication, with the users spread over several databases.
+
+    "shards" is the list of the databases URIs, and "sqluri" the directory
+    database. The other options are passed to the SQLAuth instance of each
+    shard, except for the ones that would make the shards share a
+    database or a directory (sqluri_read, reset_code_storage and
+    reset_code_path), which are refused.
+
+    Changing the number of shards moves the users to other shards, so
+    they need to be migrated.
+    """
+
+    def __init__(self, sqluri, shards, pool_size=20, pool_recycle=60,
+                 create_tables=True, pool_timeout=None, max_overflow=None,
+                 **kw):
+        shared = [name for name in _SHARD_OPTIONS if kw.get(name)]
+        if shared:
+            raise ValueError('Options not supported with shards: %s'
+                             % ', '.join(shared))
+        self.sqluri = sqluri
+        self._engine = _create_engine(sqluri, pool_size, pool_recycle,
+                                      pool_timeout, max_overflow)
+        # the shards share the tables metadata, so every query is
+        # executed on an explicit engine
+        if create_tables:
+            user_shards.create(bind=self._engine, checkfirst=True)
+
+        self.shards = [SQLAuth(uri, pool_size=pool_size,
+                               pool_recycle=pool_recycle,
+                               create_tables=create_tables,
+                               pool_timeout=pool_timeout,
+                               max_overflow=max_overflow,
+                               bind_metadata=False, **kw)
+                       for uri in split_uris(shards)]
+        if len(self.shards) == 0:
+            raise ValueError('No shards defined')
+
+        # a user id never moves to another shard
+        self._id_shards = LRUCache(10000)
+
+    @classmethod
+    def get_name(self):
+        """Returns the name of the authentication backend"""
+        return 'shardedsql'
+
+    #
+    # Routing
+    #
+    def _shard_index(self, user_name):
+        if isinstance(user_name, unicode):
+            user_name = user_name.encode('utf8')
+        return int(md5(user_name).hexdigest()[:8], 16) % len(self.shards)
+
+    def _get_shard(self, user_name):
+        """Returns the shard of a user name"""
+        return self.shards[self._shard_index(user_name)]
+
+    def _get_shards(self, user_ids):
+        """Returns a mapping of the user ids to their shard index.
+
+        Unknown user ids are not included.
+        """
+        res = {}
+        todo = []
+        for user_id in user_ids:
+            index = self._id_shards.get(user_id)
+            if index is None:
+                todo.append(user_id)
+            else:
+                res[user_id] = index
+
+        for ids in batch(todo, 100):
+            query = select([user_shards.c.id, user_shards.c.shard],
+                           user_shards.c.id.in_(list(ids)))
+            for row in safe_execute(self._engine, query):
+                self._id_shards.set(row.id, row.shard)
+                res[row.id] = row.shard
+        return res
+
+    def _get_id_shard(self, user_id):
+        """Returns the shard of a user id, or None if it's unknown"""
+        index = self._id_shards.get(user_id)
+        if index is None:
+            row = safe_execute(self._engine, _USER_SHARD,
+                               user_id=user_id).fetchone()
+            if row is None:
+                return None
+            index = row.shard
+            self._id_shards.set(user_id, index)
+        return self.shards[index]
+
+    def _new_user_id(self, index):
+        """Allocates a user id in a shard"""
+        res = safe_execute(self._engine, _NEW_USER, shard_index=index)
+        user_id = res.inserted_primary_key[0]
+        self._id_shards.set(user_id, index)
+        return user_id
+
+    #
+    # Users
+    #
+    def get_user_id(self, user_name):
+        """Returns the id for a user name"""
+        return self._get_shard(user_name).get_user_id(user_name)
+
+    def get_user_ids(self, user_names, batch_size=100):
+        """Returns a mapping of user names to their ids.
+
+        The shards are queried in parallel.
+        """
+        groups = {}
+        for user_name in user_names:
+            index = self._shard_index(user_name)
+            groups.setdefault(index, []).append(user_name)
+
+        res = {}
+        groups = [(self.shards[index], names)
+                  for index, names in groups.items()]
+        for ids in _fan_out(lambda shard, names:
+                            shard.get_user_ids(names, batch_size), groups):
+            res.update(ids)
+        return res
+
+    def get_user_infos(self, user_ids, batch_size=100):
+        """Returns a mapping of user ids to (username, email) tuples.
+
+        The shards are queried in parallel.
+        """
+        res = dict([(user_id, (None, None)) for user_id in user_ids])
+        requested = match_user_ids(res)
+        groups = {}
+        for user_id, index in self._get_shards(requested.keys()).items():
+            groups.setdefault(index, []).append(user_id)
+
+        groups = [(self.shards[index], ids) for index, ids in groups.items()]
+        for infos in _fan_out(lambda shard, ids:
+                              shard.get_user_infos(ids, batch_size), groups):
+            for user_id, info in infos.items():
+                res[requested[user_id]] = info
+        return res
+
+    def create_user(self, user_name, password, email):
+        """Creates a user. Returns True on success."""
+        index = self._shard_index(user_name)
+        shard = self.shards[index]
+        row = {'user_id': self._new_user_id(index),
+               'user_name': user_name, 'user_email': email,
+               'hash': hash_password(shard.hasher, password)}
+        try:
+            res = shard._insert_users([row], _CREATE_USER_ID)
+        except BackendError:
+            self._delete_user_id(row['user_id'])
+            raise
+        if not res[0][0]:
+            self._delete_user_id(row['user_id'])
+        return res[0][0]
+
+    def create_users(self, users, batch_size=100):
+        """Creates users in bulk.
+
+        The users are inserted in their shards in parallel. Returns a list
+        of (True or False, Error Message) tuples.
+        """
+        users = list(users)
+        groups = {}
+        for position, user in enumerate(users):
+            index = self._shard_index(user[0])
+            groups.setdefault(index, []).append((position, user))
+
+        def _create(index, users):
+            shard = self.shards[index]
+            res = []
+            for users_batch in batch(users, batch_size):
+                users_batch = list(users_batch)
+                hashes = hash_passwords(shard.hasher,
+                                        [password for __, (__, password, __)
+                                         in users_batch])
+                rows = []
+                try:
+                    for (__, (user_name, __, email)), hash in \
+                            zip(users_batch, hashes):
+                        rows.append({'user_id': self._new_user_id(index),
+                                     'user_name': user_name,
+                                     'user_email': email, 'hash': hash})
+                    inserted = shard._insert_users(rows, _CREATE_USER_ID)
+                except BackendError:
+                    self._delete_user_ids([row['user_id'] for row in rows])
+                    raise
+                for (position, __), row, result in \
+                        zip(users_batch, rows, inserted):
+                    if not result[0]:
+                        self._delete_user_id(row['user_id'])
+                    res.append((position, result))
+            return res
+
+        results = [None] * len(users)
+        for res in _fan_out(_create, groups.items()):
+            for position, result in res:
+                results[position] = result
+        return results
+
+    def authenticate_user(self, user_name, password):
+        """Authenticates a user given a user_name and password.
+
+        Returns the user id in case of success. Returns None otherwise."""
+        shard = self._get_shard(user_name)
+        return shard.authenticate_user(user_name, password)
+
+    def get_user_info(self, user_id):
+        """Returns user info
+
+        Args:
+            user_id: user id
+
+        Returns:
+            tuple: username, email
+        """
+        shard = self._get_id_shard(user_id)
+        if shard is None:
+            return None, None
+        return shard.get_user_info(user_id)
+
+    def update_email(self, user_id, email, password=None):
+        """Change the user e-mail"""
+        shard = self._get_id_shard(user_id)
+        if shard is None:
+            return False
+        return shard.update_email(user_id, email, password)
+
+    def update_password(self, user_id, password, old_password=None, key=None):
+        """Change the user password"""
+        shard = self._get_id_shard(user_id)
+        if shard is None:
+            return False
+        return shard.update_password(user_id, password, old_password, key)
+
+    def delete_user(self, user_id, password=None):
+        """Deletes a user"""
+        shard = self._get_id_shard(user_id)
+        if shard is None:
+            return False
+        if not shard.delete_user(user_id, password):
+            return False
+        self._delete_user_id(user_id)
+        return True
+
+    def close(self):
+        """Closes the pooled connections of the directory and the shards."""
+        self._engine.dispose()
+        for shard in self.shards:
+            shard.close()
+
+    def _delete_user_id(self, user_id):
+        safe_execute(self._engine, _DELETE_USER, user_id=user_id)
+        self._id_shards.delete(user_id)
+
+    def _delete_user_ids(self, user_ids):
+        """Frees the ids allocated for users that were not created"""
+        for ids in batch(user_ids, 100):
+            ids = list(ids)
+            safe_execute(self._engine, delete(user_shards,
+                                              user_shards.c.id.in_(ids)))
+            for user_id in ids:
+                self._id_shards.delete(user_id)
+
+    def get_user_node(self, user_id, assign=True):
+        """Returns the node of the user"""
+        # the sql auth backend does not handle nodes.
+        return None
+
+    #
+    # Reset code managment
+    #
+    def generate_reset_code(self, user_id, overwrite=False):
+        shard = self._get_id_shard(user_id)
+        if shard is None:
+            return None
+        return shard.generate_reset_code(user_id, overwrite)
+
+    def verify_reset_code(self, user_id, code):
+        shard = self._get_id_shard(user_id)
+        if shard is None:
+            return False
+        return shard.verify_reset_code(user_id, code)
+
+    def clear_reset_code(self, user_id):
+        shard = self._get_id_shard(user_id)
+        if shard is None:
+            return False
+        return shard.clear_reset_code(user_id)
+
+    def purge_expired_reset_codes(self, batch_size=1000, pause=0.):
+        """Deletes the expired reset codes of all the shards."""
+        return sum([shard.purge_expired_reset_codes(batch_size, pause)
+                    for shard in self.shards])
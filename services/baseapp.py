@@ -37,6 +37,10 @@
 Application entry point.
 """
 import traceback
+import time
+import os
+import signal
+import threading
 
 from paste.translogger import TransLogger
 from paste.exceptions.errormiddleware import ErrorMiddleware
@@ -48,14 +52,114 @@ from webob.exc import HTTPNotFound, HTTPBadRequest, HTTPServiceUnavailable
 from webob import Response
 
 from services.util import (convert_config, CatchErrorMiddleware, round_time,
-                           BackendError)
+                           BackendError, filter_params,
+                           set_slow_query_threshold, set_retry_policy,
+                           set_backend_health)
+from services.mailer import enable_queue, disable_queue
+from services.hashpool import enable_pool, disable_pool
 from services import logger
 from services.wsgiauth import Authentication
 from services.controllers import StandardController
 
 
+class BackendHealth(object):
+    """Computes the Retry-After values from the backend recent health.
+
+    The delay is twice the time the backend has been failing for, within
+    the [minimum, maximum] range. Any successful backend call ends the
+    outage. The calls are reported by the backends, see
+    services.util.set_backend_health.
+    """
+    def __init__(self, minimum=5, maximum=1800):
+        self.minimum = int(minimum)
+        self.maximum = int(maximum)
+        self.failing_since = None
+        self._lock = threading.Lock()
+
+    def success(self):
+        self.failing_since = None
+
+    def failure(self):
+        """Records a failure."""
+        with self._lock:
+            if self.failing_since is None:
+                self.failing_since = time.time()
+
+    def retry_after(self):
+        """Returns the Retry-After value to use."""
+        since = self.failing_since
+        if since is None:
+            return self.minimum
+        delay = int((time.time() - since) * 2)
+        return min(self.maximum, max(self.minimum, delay))
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+class ConfigReloader(object):
+    """Reads the application config, and tells when it needs a reload.
+
+    A reload is needed when request() was called -- it can be used as a
+    signal handler -- or, if check_interval is set, when one of the
+    config files changed. The files are checked at most once every
+    check_interval seconds.
+    """
+    def __init__(self, raw_config, check_interval=0):
+        self.raw_config = dict(raw_config)
+        self.check_interval = check_interval
+        self.requested = False
+        self._mtimes = {}
+        self._last_check = time.time()
+
+    def load(self):
+        """Reads the config and returns it."""
+        self.requested = False
+        files = []
+        config = convert_config(self.raw_config, files)
+        self._mtimes = dict([(filename, _mtime(filename))
+                             for filename in files])
+        return config
+
+    def request(self, *args):
+        """Asks for a reload."""
+        self.requested = True
+
+    def install_signal(self, signum=getattr(signal, 'SIGHUP', None)):
+        """Asks for a reload when the process receives signum."""
+        try:
+            signal.signal(signum, self.request)
+        except (ValueError, TypeError):
+            # not in the main thread, or no such signal here
+            logger.warning('Could not install the config reload signal')
+            return False
+        return True
+
+    def changed(self):
+        """Returns True if the config needs to be reloaded."""
+        if self.requested:
+            return True
+        if not self.check_interval:
+            return False
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        for filename, mtime in self._mtimes.items():
+            if _mtime(filename) != mtime:
+                return True
+        return False
+
+
 class SyncServerApp(object):
     """ Dispatches the request to the right controller by using Routes.
+
+    When "reloader" is set to a ConfigReloader, the config is reloaded
+    between requests when it changes. See reload_config.
     """
     def __init__(self, urls, controllers, config=None,
                  auth_class=Authentication):
@@ -65,17 +169,12 @@ class SyncServerApp(object):
         else:
             self.config = {}
 
-        # global config
-        self.retry_after = self.config.get('global.retry_after', 1800)
-
-        # heartbeat page
-        self.heartbeat_page = self.config.get('global.heartbeat_page',
-                                              '__heartbeat__')
-
-        # debug page, if any
-        self.debug_page = self.config.get('global.debug_page')
+        self.reloader = None
+        self._reload_lock = threading.Lock()
+        self._configure(self.config)
 
         # loading the authentication tool
+        self.auth_class = auth_class
         self.auth = None if auth_class is None else auth_class(self.config)
 
         # loading and connecting controllers
@@ -110,14 +209,134 @@ class SyncServerApp(object):
         self.standard_controller._debug_server = self._debug_server
         self.standard_controller._check_server = self._check_server
 
+    def _configure(self, config, previous=None):
+        """Applies the global options of the config."""
+        def _changed(*options):
+            return previous is None or any([config.get(option) !=
+                                            previous.get(option)
+                                            for option in options])
+
+        # global config
+        self.retry_after = config.get('global.retry_after', 1800)
+
+        # when adaptive_retry_after is set, retry_after is only the maximum
+        # value, and short outages get a shorter delay. The health is kept
+        # across reloads, unless its options changed
+        if _changed('global.retry_after', 'global.adaptive_retry_after',
+                    'global.min_retry_after'):
+            if config.get('global.adaptive_retry_after', False):
+                min_retry_after = config.get('global.min_retry_after', 5)
+                self.health = BackendHealth(min_retry_after,
+                                            self.retry_after)
+            else:
+                self.health = None
+            set_backend_health(self.health)
+
+        # SQL read queries retries
+        if _changed('global.sql_retries', 'global.sql_retry_backoff'):
+            set_retry_policy(config.get('global.sql_retries', 2),
+                             config.get('global.sql_retry_backoff', 0.05))
+
+        # queries slower than this threshold (in seconds) are logged
+        slow_query_threshold = config.get('global.slow_query_threshold')
+        if slow_query_threshold is not None or previous is not None:
+            set_slow_query_threshold(slow_query_threshold)
+
+        # heartbeat page
+        self.heartbeat_page = config.get('global.heartbeat_page',
+                                         '__heartbeat__')
+
+        # debug page, if any
+        self.debug_page = config.get('global.debug_page')
+
+        # the queue and the pool are restarted only if their options changed
+        if previous is None:
+            previous = {}
+
+        # outgoing emails can be queued and sent in the background
+        mailqueue = filter_params('mailqueue', config)
+        if mailqueue != filter_params('mailqueue', previous):
+            if mailqueue.pop('use', False):
+                enable_queue(**mailqueue)
+            elif previous:
+                disable_queue()
+
+        # password hashing can be done in worker processes
+        hashpool = filter_params('hashpool', config)
+        if hashpool != filter_params('hashpool', previous):
+            if hashpool.pop('use', False):
+                enable_pool(**hashpool)
+            elif previous:
+                disable_pool()
+
+    def reload_config(self, config):
+        """Replaces the config of the running application.
+
+        The auth backend is recreated only if its options changed, so its
+        connection pools are kept otherwise. The controllers and the URLs
+        are not reloaded.
+        """
+        previous = self.config
+        self._configure(config, previous)
+
+        if self.auth_class is not None:
+            options = ('auth', 'auth_throttle')
+            if any([filter_params(name, config) !=
+                    filter_params(name, previous) for name in options]):
+                auth, self.auth = self.auth, self.auth_class(config)
+                # its pools are emptied, or they would leak on each reload
+                close = getattr(auth, 'close', None)
+                if close is not None:
+                    close()
+            else:
+                self.auth.config = config
+
+        # the overlays of the hosts already seen are computed upfront, and
+        # set last, see _host_specific
+        host_configs = self._host_overlays(config, self._host_configs.keys())
+        self.config = config
+        self._host_configs = host_configs
+        logger.info('Configuration reloaded')
+
+    def _reload(self):
+        """Reloads the config, unless another thread is doing it."""
+        if not self._reload_lock.acquire(False):
+            return
+        try:
+            try:
+                config = self.reloader.load()
+            except Exception:
+                # keeping the current config
+                logger.error(traceback.format_exc())
+                return
+            self.reload_config(config)
+        finally:
+            self._reload_lock.release()
+
     def _before_call(self, request):
         return {}
 
-    def _host_specific(self, host, config):
+    def _host_overlays(self, config, hosts):
+        """Computes the config of the given hosts."""
+        return dict([(host, self._host_config(host, config))
+                     for host in hosts])
+
+    def _host_specific(self, host, config=None):
         """Will compute host-specific requests"""
-        if host in self._host_configs:
-            return self._host_configs[host]
+        # reload_config sets the config before the overlays, so they have
+        # to be read in the other order
+        host_configs = self._host_configs
+        if config is None:
+            config = self.config
+
+        if host in host_configs:
+            return host_configs[host]
+
+        host_config = self._host_config(host, config)
+        host_configs[host] = host_config
+        return host_config
 
+    def _host_config(self, host, config):
         # overrides the original value with the host-specific value
         host_section = 'host:%s.' % host
         host_config = {}
@@ -131,9 +350,16 @@ class SyncServerApp(object):
                 overriden_keys.append(key)
             host_config[key] = value
 
-        self._host_configs[host] = host_config
         return host_config
 
+    def _retry_after(self):
+        """Returns the Retry-After value of a 503"""
+        if self.health is None:
+            return self.retry_after
+        # the backend may not have reported the failure itself
+        self.health.failure()
+        return self.health.retry_after()
+
     #
     # Debug & heartbeat pages
     #
@@ -159,8 +385,11 @@ class SyncServerApp(object):
 
         request.server_time = round_time()
 
+        if self.reloader is not None and self.reloader.changed():
+            self._reload()
+
         # gets request-specific config
-        request.config = self._host_specific(request.host, self.config)
+        request.config = self._host_specific(request.host)
 
         # pre-hook
         before_headers = self._before_call(request)
@@ -207,7 +436,7 @@ class SyncServerApp(object):
         except BackendError:
             err = traceback.format_exc()
             logger.error(err)
-            raise HTTPServiceUnavailable(retry_after=self.retry_after)
+            raise HTTPServiceUnavailable(retry_after=self._retry_after())
 
         if isinstance(result, basestring):
             response = getattr(request, 'response', None)
@@ -246,9 +475,18 @@ def set_app(urls, controllers, klass=SyncServerApp, auth_class=Authentication,
     def make_app(global_conf, **app_conf):
         """Returns a Sync Server Application."""
         global_conf.update(app_conf)
-        params = convert_config(global_conf)
+        reloader = ConfigReloader(global_conf)
+        params = reloader.load()
         app = klass(urls, controllers, params, auth_class)
 
+        # the config can be reloaded on SIGHUP or when its files change
+        reloader.check_interval = params.get('global.config_check_interval',
+                                             0)
+        if params.get('global.reload_on_sighup', False):
+            reloader.install_signal()
+        if reloader.check_interval or params.get('global.reload_on_sighup'):
+            app.reloader = reloader
+
         if params.get('debug', False):
             app = TransLogger(app, logger_name='syncserver',
                               setup_console_handler=True)
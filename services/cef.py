@@ -37,8 +37,11 @@
 # XXX Module to be removed once all app have switched to the
 # standalone lib
 
+import os
 import sys
+import atexit
 import threading
+from collections import deque
 try:
     import syslog
     _SYSLOG_OPTIONS = {'PID': syslog.LOG_PID,
@@ -79,15 +82,19 @@ except ImportError:
     SYSLOG = False
 
 import socket
+import time
 from time import strftime
 import re
 from services import logger
-from services.util import get_source_ip
+from services.util import get_source_ip, get_client_ip, split_proxies
 
 
 _HOST = socket.gethostname()
 _MAXLEN = 1024
 
+# size of the biggest chunk of records written at once
+_MAX_WRITE = 4096
+
 # pre-defined signatures
 AUTH_FAILURE = 'AuthFail'
 CAPTCHA_FAILURE = 'CaptchaFail'
@@ -101,6 +108,11 @@ _CEF_FORMAT = ('%(date)s %(host)s CEF:%(version)s|%(vendor)s|%(product)s|'
                'requestMethod=%(method)s request=%(url)s '
                'src=%(source)s dest=%(dest)s suser=%(suser)s')
 
+_DYNAMIC_FIELDS = ['date', 'signature', 'name', 'severity', 'user_agent',
+                   'method', 'url', 'source', 'dest', 'suser']
+
+_DATE_FORMAT = '%b %d %H:%M:%S'
+
 _EXTENSIONS = ['cs1Label', 'cs1', 'requestMethod', 'request', 'src', 'dest',
                'suser']
 _PREFIX = re.compile(r'([|\\\r\n])')
@@ -129,26 +141,173 @@ def _convert_ext(data):
 
 _LOG_OPENED = None
 
-# will make log writing atomic per-process
-# unfortunately this will not work when several process uses it
-# so lines might get mixed on high loads.
-# we would need a dedicated per-server log service for this
-# to serialize all logs
+# serializes the syslog calls and the writers creation. Writing in files
+# does not need it: see AppendWriter
 _log_lock = threading.RLock()
 
 
-def _syslog(msg, config):
-    """Opens the log with configured options and logs."""
-    logopt = _str2logopt(config.get('syslog_options'))
-    facility = _str2facility(config.get('syslog_facility'))
-    ident = config.get('syslog_ident', sys.argv[0])
-    priority = _str2priority(config.get('syslog.priority'))
+class AppendWriter(object):
+    """Appends records to a file, safely across processes.
+
+    The file is opened once with O_APPEND and each record is written with
+    a single write() call, so records from several processes never get
+    mixed. Whether the file was rotated is checked at most every
+    check_interval seconds, and it is reopened if needed.
+    """
+    def __init__(self, filename, check_interval=1.):
+        self.filename = filename
+        self.check_interval = float(check_interval)
+        self._fd = None
+        self._inode = None
+        self._checked = 0
+        self._old_fd = None
+        self._lock = threading.Lock()
+
+    def _reopen(self):
+        try:
+            stat = os.stat(self.filename)
+            inode = stat.st_dev, stat.st_ino
+        except OSError:
+            inode = None
+
+        if self._fd is not None and inode == self._inode:
+            return
+
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0644)
+        stat = os.fstat(fd)
+        self._inode = stat.st_dev, stat.st_ino
+
+        # the previous descriptor might still be in use by another
+        # thread, so it's closed on the next rotation only
+        if self._old_fd is not None:
+            os.close(self._old_fd)
+        self._old_fd, self._fd = self._fd, fd
+
+    def write(self, data):
+        """Writes data with a single write() call."""
+        now = time.time()
+        if self._fd is None or now - self._checked >= self.check_interval:
+            with self._lock:
+                self._reopen()
+                self._checked = now
+
+        written = os.write(self._fd, data)
+        if written != len(data):
+            logger.warning('Partial write in %s' % self.filename)
+
+    def close(self):
+        with self._lock:
+            for fd in (self._fd, self._old_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._fd = self._old_fd = None
+
+
+class BufferedWriter(object):
+    """Appends records to a file from a background thread.
+
+    Records are pushed in a deque, which does not need any lock, and written
+    when buffer_size records are pending or every flush_interval seconds.
+
+    They are written by chunks of complete records, each chunk being at
+    most max_write bytes, through an AppendWriter.
+    """
+    def __init__(self, filename, buffer_size=100, flush_interval=1.,
+                 max_write=_MAX_WRITE):
+        self.filename = filename
+        self.buffer_size = int(buffer_size)
+        self.flush_interval = float(flush_interval)
+        self.max_write = int(max_write)
+        self._writer = AppendWriter(filename, check_interval=0)
+        self._lines = deque()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, line):
+        """Queues a record."""
+        self._lines.append(line)
+        if len(self._lines) >= self.buffer_size:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except (IOError, OSError), e:
+                logger.error('Could not write CEF records in %s: %s' %
+                             (self.filename, e))
+
+    def flush(self):
+        """Writes all pending records."""
+        with self._flush_lock:
+            chunk = []
+            size = 0
+            while True:
+                try:
+                    line = self._lines.popleft()
+                except IndexError:
+                    break
+                if chunk != [] and size + len(line) > self.max_write:
+                    self._writer.write(''.join(chunk))
+                    chunk = []
+                    size = 0
+                chunk.append(line)
+                size += len(line)
+
+            if chunk != []:
+                self._writer.write(''.join(chunk))
+
+    def close(self):
+        """Stops the background thread and writes the pending records."""
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        self._writer.close()
+
+
+_WRITERS = {}
+
+
+def _get_writer(config):
+    """Returns the writer for the configured file."""
+    filename = config['file']
+    writer = _WRITERS.get(filename)
+    if writer is not None:
+        return writer
+
     with _log_lock:
-        global _LOG_OPENED
-        if _LOG_OPENED != (ident, logopt, facility):
-            syslog.openlog(ident, logopt, facility)
-            _LOG_OPENED = ident, logopt, facility
-        syslog.syslog(priority, msg)
+        if filename not in _WRITERS:
+            if config.get('buffered', False):
+                writer = BufferedWriter(filename,
+                                        config.get('buffer_size', 100),
+                                        config.get('flush_interval', 1.))
+            else:
+                writer = AppendWriter(filename)
+            _WRITERS[filename] = writer
+        return _WRITERS[filename]
+
+
+@atexit.register
+def _close_writers():
+    with _log_lock:
+        loggers = _LOGGERS.values()
+        _LOGGERS.clear()
+    for cef_logger in loggers:
+        cef_logger.flush()
+
+    with _log_lock:
+        writers = _WRITERS.values()
+        _WRITERS.clear()
+    for writer in writers:
+        writer.close()
 
 
 def _str2logopt(value):
@@ -182,6 +341,281 @@ def _check_key(key):
     return _KEY.sub('?', key)
 
 
+# environ keys kept for the summary records
+_SUMMARY_KEYS = ('REQUEST_METHOD', 'PATH_INFO', 'HTTP_HOST', 'HTTP_USER_AGENT',
+                 'HTTP_X_FORWARDED_FOR', 'REMOTE_ADDR')
+
+
+def _summary_environ(environ):
+    return dict([(key, environ[key]) for key in _SUMMARY_KEYS
+                 if key in environ])
+
+
+class CEFLogger(object):
+    """Creates CEF records and emits them in syslog or another file.
+
+    The logger is built once from the "cef" section of the configuration,
+    as returned by filter_params('cef', config). The static part of the
+    records is escaped and formatted at that time.
+
+    trusted_proxies are the proxies whose X-Forwarded-For header is used
+    to find the source IP of the rate limiting. See get_client_ip.
+    """
+    def __init__(self, config, trusted_proxies=None):
+        self.config = config
+        self.trusted_proxies = split_proxies(trusted_proxies)
+        self.filename = config['file']
+
+        self._static = {'version': _convert_prefix(config['version']),
+                        'vendor': _convert_prefix(config['vendor']),
+                        'device_version':
+                                _convert_prefix(config['device_version']),
+                        'product': _convert_prefix(config['product']),
+                        'host': _HOST}
+
+        # formatting the static fields once. The other ones are kept
+        # as placeholders
+        fields = dict([(key, '%%(%s)s' % key) for key in _DYNAMIC_FIELDS])
+        for key, value in self._static.items():
+            fields[key] = value.replace('%', '%%')
+        self._format = _CEF_FORMAT % fields
+
+        self._date_cache = None, None
+
+        # rate limiting
+        rate = config.get('rate_limit')
+        self.rate = rate is not None and float(rate) or None
+        self.burst = float(config.get('rate_burst', 10))
+        self.summary_interval = float(config.get('summary_interval', 60))
+        self.max_sources = int(config.get('max_sources', 10000))
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._last_summary = time.time()
+
+        if self.filename == 'syslog':
+            if not SYSLOG:
+                raise ValueError('syslog not supported on this platform')
+            self._logopt = _str2logopt(config.get('syslog_options'))
+            self._facility = _str2facility(config.get('syslog_facility'))
+            self._ident = config.get('syslog_ident', sys.argv[0])
+            self._priority = _str2priority(config.get('syslog_priority'))
+
+    def _date(self):
+        """Returns the formatted date, computed once per second."""
+        now = int(time.time())
+        cached = self._date_cache
+        if cached[0] != now:
+            cached = now, strftime(_DATE_FORMAT, time.localtime(now))
+            self._date_cache = cached
+        return cached[1]
+
+    def _syslog(self, msg):
+        """Opens the log with configured options and logs."""
+        global _LOG_OPENED
+        options = self._ident, self._logopt, self._facility
+        with _log_lock:
+            if _LOG_OPENED != options:
+                syslog.openlog(*options)
+                _LOG_OPENED = options
+            syslog.syslog(self._priority, msg)
+
+    def log(self, name, severity, environ, username='none', signature=None,
+            **kw):
+        """Creates a CEF record, and emits it.
+
+        See log_cef for the arguments.
+
+        When "rate_limit" is set, each signature (or name, when there's no
+        signature) + source IP pair gets a token bucket of "rate_burst"
+        records, refilled at "rate_limit" records per second. Records that
+        exceed it are not emitted but counted, and every "summary_interval"
+        seconds a summary record is emitted with the count in the "cnt"
+        extension. Past "max_sources" buckets, the records of the new pairs
+        share a single bucket.
+        """
+        if self.rate is not None and not self._allow(name, severity, environ,
+                                                     username, signature):
+            return
+        self._log(name, severity, environ, username, signature, **kw)
+
+    def _allow(self, name, severity, environ, username, signature):
+        """Returns True if the record can be emitted."""
+        now = time.time()
+        key = signature or name, get_client_ip(environ,
+                                               self.trusted_proxies)
+        summaries = None
+
+        with self._buckets_lock:
+            if now - self._last_summary >= self.summary_interval:
+                summaries = self._pop_summaries(now)
+
+            bucket = self._buckets.get(key)
+            if bucket is None and len(self._buckets) >= self.max_sources:
+                # too many sources, the new ones are aggregated
+                key = None
+                bucket = self._buckets.get(key)
+
+            if bucket is None:
+                # tokens, last update, suppressed records, last record
+                bucket = self._buckets[key] = [self.burst, now, 0, None]
+
+            tokens = min(self.burst,
+                         bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                allowed = True
+            else:
+                bucket[0] = tokens
+                bucket[2] += 1
+                bucket[3] = (name, severity, _summary_environ(environ),
+                             username, signature)
+                allowed = False
+
+        if summaries:
+            self._emit_summaries(summaries)
+        return allowed
+
+    def _pop_summaries(self, now):
+        """Collects the suppressed records counts and drops idle buckets.
+
+        Must be called with the buckets lock held.
+        """
+        summaries = []
+        for key, bucket in self._buckets.items():
+            if bucket[2] > 0:
+                summaries.append((bucket[3], bucket[2]))
+                bucket[2] = 0
+                bucket[3] = None
+            elif bucket[0] + (now - bucket[1]) * self.rate >= self.burst:
+                # the bucket is full again, no need to keep it
+                del self._buckets[key]
+        self._last_summary = now
+        return summaries
+
+    def _emit_summaries(self, summaries):
+        for (name, severity, environ, username, signature), count \
+                in summaries:
+            self._log(name, severity, environ, username, signature,
+                      cnt=count)
+
+    def flush(self):
+        """Emits the pending summary records."""
+        if self.rate is None:
+            return
+        with self._buckets_lock:
+            summaries = self._pop_summaries(time.time())
+        self._emit_summaries(summaries)
+
+    def _log(self, name, severity, environ, username='none', signature=None,
+             **kw):
+        name = _convert_prefix(name)
+        if signature is None:
+            signature = name
+        else:
+            signature = _convert_prefix(signature)
+
+        fields = {'severity': _convert_prefix(severity),
+                  'source': get_source_ip(environ),
+                  'method': _convert_ext(environ['REQUEST_METHOD']),
+                  'url': _convert_ext(environ['PATH_INFO']),
+                  'dest': _convert_ext(environ.get('HTTP_HOST', u'none')),
+                  'user_agent': _convert_ext(environ.get('HTTP_USER_AGENT',
+                                                         u'none')),
+                  'signature': signature,
+                  'name': name,
+                  'suser': username,
+                  'date': self._date()}
+
+        if not kw:
+            self._emit(self._format % fields)
+            return
+
+        # make sure we don't have a | anymore in regular fields
+        for key, value in list(kw.items()):
+            new_key = _check_key(key)
+            if new_key == key:
+                continue
+            kw[new_key] = value
+            del kw[key]
+
+        # overriding with provided datas
+        fields.update(kw)
+
+        # resulting message
+        for key in kw:
+            if key in self._static:
+                # a static field is overriden, so the pre-formatted
+                # version can't be used
+                all_fields = dict(self._static)
+                all_fields.update(fields)
+                msg = _CEF_FORMAT % all_fields
+                break
+        else:
+            msg = self._format % fields
+
+        # adding custom extensions
+        # sorting by size
+        extensions = [(len(str(value)), len(key), key, value)
+                      for key, value in kw.items()
+                      if key not in _EXTENSIONS]
+        extensions.sort()
+
+        msg_len = len(msg)
+
+        for value_len, key_len, key, value in extensions:
+            added_len = value_len + key_len + 2
+            value = _convert_ext(value)
+            key = _check_key(key)
+
+            if msg_len + added_len > _MAXLEN:
+                # msg is too big.
+                warn = 'CEF Message too big. %s %s' % (msg, str(kw.items()))
+                logger.warning(warn)
+                break
+
+            msg += ' %s=%s' % (key, value)
+            msg_len += added_len
+
+        self._emit(msg)
+
+    def _emit(self, msg):
+        if self.filename == 'syslog':
+            self._syslog(msg)
+        else:
+            _get_writer(self.config).write('%s\n' % msg)
+
+
+# options the loggers depend on
+_CONFIG_KEYS = ['cef.%s' % key for key in ('file', 'version', 'vendor',
+                'device_version', 'product', 'buffered', 'buffer_size',
+                'flush_interval', 'syslog_options', 'syslog_facility',
+                'syslog_ident', 'syslog_priority', 'rate_limit',
+                'rate_burst', 'summary_interval', 'max_sources')] + \
+               ['auth_throttle.trusted_proxies']
+
+_LOGGERS = {}
+
+
+def get_cef_logger(config):
+    """Returns the CEFLogger for an application configuration.
+
+    The loggers are cached, keyed on the values of the cef options.
+    """
+    key = tuple([config.get(option) for option in _CONFIG_KEYS])
+    cef_logger = _LOGGERS.get(key)
+    if cef_logger is not None:
+        return cef_logger
+
+    # XXX might want to remove the request dependency here
+    # so this module is standalone
+    from services.util import filter_params
+    cef_logger = CEFLogger(filter_params('cef', config),
+                           config.get('auth_throttle.trusted_proxies'))
+    with _log_lock:
+        return _LOGGERS.setdefault(key, cef_logger)
+
+
 def log_cef(name, severity, environ, config, username='none',
             signature=None, **kw):
     """Creates a CEF record, and emit it in syslog or another file.
@@ -194,79 +628,10 @@ def log_cef(name, severity, environ, config, username='none',
         - signature: CEF signature code - defaults to name value
         - username: user name - defaults to 'none'
         - extra keywords: extra keys used in the CEF extension
+
+    Records are appended to the file with single write() calls, so several
+    processes can share the same file. When "cef.buffered" is set, they are
+    written by a background thread. See AppendWriter and BufferedWriter.
     """
-    # XXX might want to remove the request dependency here
-    # so this module is standalone
-    from services.util import filter_params
-    name = _convert_prefix(name)
-    if signature is None:
-        signature = name
-    else:
-        signature = _convert_prefix(signature)
-    severity = _convert_prefix(severity)
-    config = filter_params('cef', config)
-
-    source = get_source_ip(environ)
-
-    fields = {'severity': severity,
-              'source': source,
-              'method': _convert_ext(environ['REQUEST_METHOD']),
-              'url': _convert_ext(environ['PATH_INFO']),
-              'dest': _convert_ext(environ.get('HTTP_HOST', u'none')),
-              'user_agent': _convert_ext(environ.get('HTTP_USER_AGENT',
-                                                     u'none')),
-              'signature': signature,
-              'name': name,
-              'version': config['version'],
-              'vendor': config['vendor'],
-              'device_version': config['device_version'],
-              'product': config['product'],
-              'host': _HOST,
-              'suser': username,
-              'date': strftime("%b %d %H:%M:%S")}
-
-    # make sure we don't have a | anymore in regular fields
-    for key, value in list(kw.items()):
-        new_key = _check_key(key)
-        if new_key == key:
-            continue
-        kw[new_key] = value
-        del kw[key]
-
-    # overriding with provided datas
-    fields.update(kw)
-
-    # resulting message
-    msg = _CEF_FORMAT % fields
-
-    # adding custom extensions
-    # sorting by size
-    extensions = [(len(str(value)), len(key), key, value)
-                    for key, value in kw.items()
-                  if key not in _EXTENSIONS]
-    extensions.sort()
-
-    msg_len = len(msg)
-
-    for value_len, key_len, key, value in extensions:
-        added_len = value_len + key_len + 2
-        value = _convert_ext(value)
-        key = _check_key(key)
-
-        if msg_len + added_len > _MAXLEN:
-            # msg is too big.
-            warn = 'CEF Message too big. %s %s' % (msg, str(kw.items()))
-            logger.warning(warn)
-            break
-
-        msg += ' %s=%s' % (key, value)
-        msg_len += added_len
-
-    if config['file'] == 'syslog':
-        if not SYSLOG:
-            raise ValueError('syslog not supported on this platform')
-        _syslog(msg, config)
-    else:
-        with _log_lock:
-            with open(config['file'], 'a') as f:
-                f.write('%s\n' % msg)
+    get_cef_logger(config).log(name, severity, environ, username, signature,
+                               **kw)
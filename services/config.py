@@ -39,10 +39,16 @@ https://wiki.mozilla.org/index.php?title=Services/Sync/Server/GlobalConfFile
 """
 import re
 import os
+import marshal
+import time
+import tempfile
+from hashlib import sha1
 from ConfigParser import RawConfigParser, Error
 
 _IS_NUMBER = re.compile('^-?[0-9].*')
 _IS_ENV_VAR = re.compile('\$\{(\w.*)?\}')
+_SNAPSHOT_VERSION = 1
+_RACY_DELAY = 2
 
 
 class EnvironmentNotFoundError(Error):
@@ -87,8 +93,13 @@ def convert(value):
 
 
 class Config(RawConfigParser):
+    """Config reader supporting the "extends" option.
+
+    "filenames" lists the files read, including the extended ones.
+    """
 
     def __init__(self, filename):
+        self.filenames = []
         # let's read the file
         RawConfigParser.__init__(self)
         if isinstance(filename, basestring):
@@ -99,6 +110,7 @@ class Config(RawConfigParser):
     def _read(self, fp, filename):
         # first pass
         RawConfigParser._read(self, fp, filename)
+        self.filenames.append(filename)
 
         # let's expand it now if needed
         defaults = self.defaults()
@@ -162,6 +174,7 @@ class Config(RawConfigParser):
             raise IOError('No such file: %s' % filename)
         parser = RawConfigParser()
         parser.read([filename])
+        self.filenames.append(filename)
         for section in parser.sections():
             if not self.has_section(section):
                 self.add_section(section)
@@ -169,3 +182,97 @@ class Config(RawConfigParser):
                 if self.has_option(section, option):
                     continue
                 RawConfigParser.set(self, section, option, value)
+
+
+def _stamp(filename):
+    """Returns what tells if a file changed."""
+    stat = os.stat(filename)
+    return stat.st_mtime, stat.st_size
+
+
+def _env_vars(config):
+    """Returns the names of the environment variables used by the config."""
+    names = set()
+    for section in config.sections():
+        for __, value in RawConfigParser.items(config, section):
+            if isinstance(value, basestring):
+                names.update(_IS_ENV_VAR.findall(value))
+    return names
+
+
+def _read_snapshot(path):
+    """Returns the snapshot at path, or None if it's missing or outdated."""
+    try:
+        with open(path, 'rb') as f:
+            snapshot = marshal.load(f)
+        if snapshot['version'] != _SNAPSHOT_VERSION:
+            return None
+        for filename, stamp in snapshot['files']:
+            if _stamp(filename) != stamp:
+                return None
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        return None
+
+    for name, value in snapshot['env'].items():
+        if os.environ.get(name) != value:
+            return None
+    return snapshot
+
+
+def _write_snapshot(path, snapshot):
+    """Writes the snapshot atomically, if possible."""
+    dirname = os.path.dirname(path)
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            os.write(fd, marshal.dumps(snapshot))
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        # the snapshot is just an optimization
+        pass
+
+
+def load_config_map(filename, cache_dir=None, files=None):
+    """Returns Config(filename).get_map().
+
+    If cache_dir is given, the map is saved in a snapshot in that directory,
+    and loaded from it as long as the config files and the environment
+    variables they use don't change. The snapshot is only a cache and is
+    rebuilt if it can't be read.
+
+    If "files" is a list, the names of the files read are appended to it.
+    """
+    if cache_dir is not None:
+        key = sha1(os.path.abspath(filename)).hexdigest()
+        path = os.path.join(cache_dir, '%s.snapshot' % key)
+        snapshot = _read_snapshot(path)
+        if snapshot is not None:
+            if files is not None:
+                files.extend([name for name, __ in snapshot['files']])
+            return snapshot['map']
+
+    config = Config(filename)
+    stamps = dict([(name, _stamp(name)) for name in config.filenames])
+    config_map = config.get_map()
+    if files is not None:
+        files.extend(config.filenames)
+
+    # a file changed in the last seconds may still be changing after we
+    # read it, with the same mtime. Not saving the snapshot then.
+    recent = time.time() - _RACY_DELAY
+    if cache_dir is not None and max([mtime for mtime, __
+                                      in stamps.values()]) < recent:
+        env = dict([(name, os.environ.get(name))
+                    for name in _env_vars(config)])
+        snapshot = {'version': _SNAPSHOT_VERSION,
+                    'files': [(name, stamps[name])
+                              for name in config.filenames],
+                    'env': env,
+                    'map': config_map}
+        _write_snapshot(path, snapshot)
+
+    return config_map
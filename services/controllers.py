@@ -40,7 +40,8 @@ import re
 import pprint
 import StringIO
 
-from services.util import html_response, text_response
+from services.util import html_response, text_response, get_query_stats
+from services.engines import get_metrics
 
 
 _DEBUG_TMPL = """
@@ -53,6 +54,14 @@ _DEBUG_TMPL = """
   <pre>
    %(environ)s
   </pre>
+  <h1>Database pools</h1>
+  <pre>
+  %(engines)s
+  </pre>
+  <h1>SQL queries</h1>
+  <pre>
+  %(queries)s
+  </pre>
   <h1>Additional information</h1>
   <pre>
   %(extra)s
@@ -61,6 +70,15 @@ _DEBUG_TMPL = """
 </html>"""
 
 
+def _pformat(data):
+    if not data:
+        return 'None.'
+    out = StringIO.StringIO()
+    pprint.pprint(data, out)
+    out.seek(0)
+    return out.read()
+
+
 class StandardController(object):
     """Standard controller
 
@@ -112,10 +130,11 @@ class StandardController(object):
                             attrs['config'][key] = new
 
         # environ
-        out = StringIO.StringIO()
-        pprint.pprint(request.environ, out)
-        out.seek(0)
-        data = {'environ': out.read()}
+        data = {'environ': _pformat(request.environ)}
+
+        # SQL engines and queries metrics
+        data['engines'] = _pformat(get_metrics())
+        data['queries'] = _pformat(get_query_stats())
 
         # extra info
         extra = '\n'.join(self._debug_server(request))
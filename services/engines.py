@@ -0,0 +1,321 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+SQL engines helpers.
+
+create_engine() is the factory used by the SQL backends. The engines it
+creates collect metrics on their pool and their queries, available through
+get_metrics() and on the debug page.
+
+ReadWriteEngines sends the writes to a primary engine and spreads the
+reads over read replicas.
+"""
+import time
+import itertools
+import threading
+import weakref
+
+from sqlalchemy import create_engine as sa_create_engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.interfaces import PoolListener, ConnectionProxy
+
+from services.util import safe_execute, BackendError, LRUCache
+from services import logger
+
+
+class EngineMetrics(object):
+    """Pool and query metrics of an engine"""
+
+    _TIMERS = ('checkout_wait', 'connection_age', 'query')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections = 0
+            self.checkouts = 0
+            self.checked_out = 0
+            self.max_overflow_used = 0
+            self.timers = dict([(name, [0, 0., 0.])
+                                for name in self._TIMERS])
+
+    def add_time(self, name, duration):
+        """Records a duration, in seconds"""
+        with self._lock:
+            timer = self.timers[name]
+            timer[0] += 1
+            timer[1] += duration
+            if duration > timer[2]:
+                timer[2] = duration
+
+    def connected(self):
+        with self._lock:
+            self.connections += 1
+
+    def checkout(self, overflow=None):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            if overflow is not None and overflow > self.max_overflow_used:
+                self.max_overflow_used = overflow
+
+    def checkin(self):
+        with self._lock:
+            self.checked_out -= 1
+
+    def snapshot(self):
+        """Returns the metrics as a dict. Durations are in milliseconds."""
+        with self._lock:
+            res = {'connections': self.connections,
+                   'checkouts': self.checkouts,
+                   'checked_out': self.checked_out,
+                   'max_overflow_used': self.max_overflow_used}
+            for name, (count, total, max_) in self.timers.items():
+                res[name + '_count'] = count
+                res[name + '_avg_ms'] = count and total * 1000. / count or 0.
+                res[name + '_max_ms'] = max_ * 1000.
+        return res
+
+
+class _PoolMetrics(PoolListener):
+    """Records the connections and their age at checkout"""
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def connect(self, dbapi_con, con_record):
+        con_record.info['created'] = time.time()
+        self.metrics.connected()
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        created = con_record.info.get('created')
+        if created is not None:
+            self.metrics.add_time('connection_age', time.time() - created)
+        pool = getattr(con_proxy, '_pool', None)
+        if isinstance(pool, QueuePool):
+            self.metrics.checkout(max(pool.overflow(), 0))
+        else:
+            self.metrics.checkout()
+
+    def checkin(self, dbapi_con, con_record):
+        self.metrics.checkin()
+
+
+class _QueryMetrics(ConnectionProxy):
+    """Records the duration of the queries"""
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        start = time.time()
+        try:
+            return execute(cursor, statement, parameters, context)
+        finally:
+            self.metrics.add_time('query', time.time() - start)
+
+
+class _MeteredQueuePool(QueuePool):
+    """QueuePool that records how long the checkouts wait"""
+    metrics = None
+
+    def do_get(self):
+        start = time.time()
+        try:
+            return QueuePool.do_get(self)
+        finally:
+            if self.metrics is not None:
+                self.metrics.add_time('checkout_wait', time.time() - start)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.__class__ = _MeteredQueuePool
+        pool.metrics = self.metrics
+        return pool
+
+
+_ENGINES = weakref.WeakKeyDictionary()
+_ENGINES_LOCK = threading.Lock()
+
+
+def _engine_name(url):
+    name = '%s://%s' % (url.drivername, url.host or '')
+    if url.port:
+        name += ':%d' % url.port
+    return '%s/%s' % (name, url.database or '')
+
+
+def create_engine(sqluri, pool_size=None, pool_recycle=None,
+                  pool_timeout=None, max_overflow=None, **kw):
+    """Creates a SQLAlchemy engine that records metrics.
+
+    pool_timeout and max_overflow only apply to the servers using a
+    QueuePool (not SQLite). The other options are passed to
+    sqlalchemy.create_engine.
+    """
+    metrics = EngineMetrics()
+    options = dict(kw)
+    options['listeners'] = list(options.get('listeners', [])) + \
+            [_PoolMetrics(metrics)]
+    options['proxy'] = _QueryMetrics(metrics)
+    if pool_size is not None:
+        options['pool_size'] = int(pool_size)
+    if pool_recycle is not None:
+        options['pool_recycle'] = int(pool_recycle)
+
+    if not sqluri.startswith('sqlite'):
+        options['poolclass'] = _MeteredQueuePool
+        if pool_timeout is not None:
+            options['pool_timeout'] = int(pool_timeout)
+        if max_overflow is not None:
+            options['max_overflow'] = int(max_overflow)
+
+    engine = sa_create_engine(sqluri, **options)
+    if isinstance(engine.pool, _MeteredQueuePool):
+        engine.pool.metrics = metrics
+    engine.metrics = metrics
+
+    with _ENGINES_LOCK:
+        _ENGINES[engine] = _engine_name(engine.url)
+    return engine
+
+
+def get_metrics():
+    """Returns the metrics of the engines created with create_engine.
+
+    The result maps each engine, named after its URL without the
+    credentials, to its metrics and pool status.
+    """
+    with _ENGINES_LOCK:
+        engines = _ENGINES.items()
+
+    res = {}
+    for engine, name in engines:
+        metrics = engine.metrics.snapshot()
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            metrics['pool_size'] = pool.size()
+            metrics['pool_overflow'] = pool.overflow()
+        # several engines can share the same URL
+        key, index = name, 1
+        while key in res:
+            index += 1
+            key = '%s (%d)' % (name, index)
+        res[key] = metrics
+    return res
+
+
+def split_uris(uris):
+    """Returns a list of URIs from a config value.
+
+    The value can be a list, or a string of comma-separated URIs.
+    """
+    if uris is None:
+        return []
+    if isinstance(uris, basestring):
+        uris = uris.split(',')
+    return [uri.strip() for uri in uris if uri.strip()]
+
+
+class ReadWriteEngines(object):
+    """Routes the queries between a primary engine and read replicas.
+
+    The reads are load-balanced over the replicas in turn. Once a key
+    (usually a user) is written, its reads go to the primary for
+    sticky_ttl seconds so they see the change even if the replicas lag
+    behind.
+
+    A replica that fails is left aside for retry_delay seconds, and the
+    read is retried on the next replica, then on the primary.
+    """
+    def __init__(self, primary, replicas=None, sticky_ttl=5,
+                 retry_delay=30, sticky_size=10000):
+        self.primary = primary
+        self.replicas = list(replicas or [])
+        self.retry_delay = float(retry_delay)
+        if float(sticky_ttl) > 0:
+            self._sticky = LRUCache(sticky_size, sticky_ttl)
+        else:
+            self._sticky = None
+        self._down = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def written(self, *keys):
+        """Sends the next reads of these keys to the primary."""
+        if not self.replicas or self._sticky is None:
+            return
+        for key in keys:
+            self._sticky.set(key, True)
+
+    def readers(self, key=None):
+        """Returns the replicas to try, in order, to read a key."""
+        if not self.replicas:
+            return []
+        if key is not None and self._sticky is not None and \
+                key in self._sticky:
+            return []
+
+        with self._lock:
+            start = self._counter.next()
+        now = time.time()
+        size = len(self.replicas)
+        replicas = [self.replicas[(start + i) % size] for i in range(size)]
+        return [replica for replica in replicas
+                if self._down.get(replica, 0) <= now]
+
+    def read(self, key, *args, **kwargs):
+        """Executes a read query. See safe_execute."""
+        for replica in self.readers(key):
+            try:
+                return safe_execute(replica, *args, **kwargs)
+            except BackendError:
+                url = replica.url
+                logger.error('Replica %s/%s failed, leaving it aside for %ds'
+                             % (url.host, url.database, self.retry_delay))
+                self._down[replica] = time.time() + self.retry_delay
+
+        return safe_execute(self.primary, *args, **kwargs)
+
+    def write(self, *args, **kwargs):
+        """Executes a query on the primary. See safe_execute."""
+        return safe_execute(self.primary, *args, **kwargs)
+
+    def dispose(self):
+        """Closes the pooled connections of all the engines."""
+        for engine in [self.primary] + self.replicas:
+            engine.dispose()
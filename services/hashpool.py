@@ -0,0 +1,223 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Password hashing in a pool of worker processes.
+
+Costly password hashes are CPU-bound and hold the GIL, stalling the other
+request threads. Once enabled with enable_pool(), hash_password() and
+verify_password() run the work in a multiprocessing pool instead.
+
+The number of pending jobs is bounded: when the pool is saturated or a job
+takes longer than the timeout, a BackendError is raised so the caller
+can answer with a 503 rather than piling up requests.
+
+The pool is off by default, in which case the hashing is done in the
+calling thread.
+"""
+import os
+import threading
+import multiprocessing
+
+from services.util import validate_password, BackendError, BackendTimeoutError
+from services import logger
+
+
+def _encode(hasher, password):
+    return hasher.encode(password)
+
+
+def _encode_many(args):
+    hasher, password = args
+    return hasher.encode(password)
+
+
+def _call(func, args):
+    # the pool callbacks are only called on success, so the errors are
+    # returned instead of raised
+    try:
+        return True, func(*args)
+    except Exception, e:
+        return False, e
+
+
+def _call_many(args):
+    func, item = args
+    return _call(func, (item,))
+
+
+def _result(res):
+    success, value = res
+    if not success:
+        raise value
+    return value
+
+
+class HashPool(object):
+    """Runs the password hashing in worker processes.
+
+    Options:
+        - size: number of processes. Defaults to the number of CPUs
+        - max_pending: maximum number of jobs queued or running
+        - timeout: maximum time in seconds to wait for a job
+
+    A job that timed out still counts as pending until a worker is done
+    with it, so the timeouts don't let the backlog grow past max_pending.
+    """
+    def __init__(self, size=None, max_pending=100, timeout=5.):
+        if size is not None:
+            size = int(size)
+        self.size = size
+        self.max_pending = int(max_pending)
+        self.timeout = float(timeout)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def _get_pool(self):
+        # a pool can't be shared with a forked process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = multiprocessing.Pool(self.size)
+                    self._pid = os.getpid()
+                    self._pending = 0
+        return self._pool
+
+    def apply(self, func, *args):
+        """Runs func(*args) in a worker and returns the result."""
+        res = self._wait(lambda pool: pool.apply_async(_call, (func, args),
+                                                       callback=self._done))
+        return _result(res)
+
+    def map(self, func, iterable):
+        """Runs func on each item, spread over the workers.
+
+        Returns the list of results. The timeout applies to the whole
+        list.
+        """
+        items = [(func, item) for item in iterable]
+        res = self._wait(lambda pool: pool.map_async(_call_many, items,
+                                                     callback=self._done))
+        return [_result(item) for item in res]
+
+    def _wait(self, run):
+        pool = self._get_pool()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                logger.error('Too many pending password hashing jobs')
+                raise BackendError('Hashing pool saturated')
+            self._pending += 1
+        try:
+            res = run(pool)
+        except:
+            self._done(None)
+            raise
+        try:
+            return res.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            logger.error('Password hashing timed out')
+            raise BackendTimeoutError('Hashing timed out')
+
+    def _done(self, res):
+        # called by the pool once the job is over
+        with self._lock:
+            self._pending -= 1
+
+    def close(self):
+        """Stops the workers."""
+        with self._lock:
+            pool, self._pool, self._pid = self._pool, None, None
+            self._pending = 0
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+_POOL = None
+_OPTIONS = None
+
+
+def enable_pool(**options):
+    """Runs the password hashing in worker processes.
+
+    The options are passed to HashPool. The running pool is kept if the
+    options did not change. Otherwise it's stopped and replaced.
+    """
+    global _POOL, _OPTIONS
+    if _POOL is not None and options == _OPTIONS:
+        return
+    disable_pool()
+    _POOL = HashPool(**options)
+    _OPTIONS = options
+
+
+def disable_pool():
+    """Stops the pool. The hashing goes back to the calling thread."""
+    global _POOL
+    pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.close()
+
+
+def get_pool():
+    """Returns the pool, or None if it's not enabled."""
+    return _POOL
+
+
+def hash_password(hasher, password):
+    """Hashes a password with a hasher from services.util.get_hasher"""
+    pool = _POOL
+    if pool is None:
+        return hasher.encode(password)
+    return pool.apply(_encode, hasher, password)
+
+
+def hash_passwords(hasher, passwords):
+    """Hashes a list of passwords. Returns the list of hashes."""
+    pool = _POOL
+    if pool is None:
+        return [hasher.encode(password) for password in passwords]
+    return pool.map(_encode_many, [(hasher, password)
+                                   for password in passwords])
+
+
+def verify_password(clear, hash):
+    """Same as services.util.validate_password"""
+    pool = _POOL
+    if pool is None:
+        return validate_password(clear, hash)
+    return pool.apply(validate_password, clear, hash)
@@ -0,0 +1,490 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Asynchronous mailer.
+
+Outgoing emails are queued and sent by a background worker that keeps its
+SMTP session open between messages. When a spool directory is configured,
+queued messages are written on disk so they survive a restart.
+
+The queues are stopped when the process exits, after sending the queued
+messages or giving up after a few seconds.
+
+The queue is off by default. Once enabled with enable_queue(),
+services.util.send_email just queues the message and returns.
+"""
+import os
+import time
+import atexit
+import fcntl
+import socket
+import smtplib
+import tempfile
+import threading
+import Queue
+from collections import deque
+
+import simplejson as json
+
+from services import logger
+
+
+# errors that mean the session is unusable -- the message is retried
+_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected,
+                      smtplib.SMTPConnectError,
+                      smtplib.SMTPHeloError,
+                      smtplib.SMTPAuthenticationError,
+                      socket.error)
+
+_STOP = object()
+
+# seconds given to the queues to send their messages at exit
+_EXIT_TIMEOUT = 10
+
+
+class SpoolFullError(Exception):
+    """Raised when the spool can't take more messages."""
+    pass
+
+
+class SMTPConnection(object):
+    """SMTP session that is kept open between messages.
+
+    The session is opened on the first message and transparently reopened
+    if the server dropped it.
+    """
+    def __init__(self, host='localhost', port=25, user=None, password=None,
+                 timeout=5):
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self._server = None
+
+    @property
+    def connected(self):
+        return self._server is not None
+
+    def connect(self):
+        """Opens the session, and authenticates if needed."""
+        self.close()
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.user is not None and self.password is not None:
+            try:
+                server.login(self.user, self.password)
+            except smtplib.SMTPException:
+                server.close()
+                raise
+        self._server = server
+
+    def close(self):
+        """Ends the session, if any."""
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self._server = None
+
+    def sendmail(self, sender, rcpts, msg):
+        """Sends a message, reconnecting once if the session was lost."""
+        if self._server is None:
+            self.connect()
+        try:
+            return self._server.sendmail(sender, rcpts, msg)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            self.connect()
+            return self._server.sendmail(sender, rcpts, msg)
+
+
+def _lock_spool(path):
+    """Locks a spool directory. Returns the lock file, or None."""
+    try:
+        lockfile = open(os.path.join(path, 'lock'), 'a')
+    except IOError:
+        # being created or removed
+        return None
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lockfile.close()
+        return None
+    return lockfile
+
+
+def _remove_spool(path):
+    """Removes a locked spool directory, if it's empty."""
+    filenames = os.listdir(path)
+    if [filename for filename in filenames if filename.endswith('.msg')]:
+        return
+    try:
+        for filename in filenames:
+            os.remove(os.path.join(path, filename))
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+class MailSpool(object):
+    """Bounded on-disk spool. Each message is stored in its own file.
+
+    Files are named after their creation time, so keys() returns
+    the messages in the order they were spooled.
+
+    Several processes can share the same path: each spool writes in its
+    own sub-directory, which stays locked until the spool is closed or its
+    process ends. A new spool takes over the messages of the unlocked
+    sub-directories, so a message is never sent by two processes.
+    """
+    def __init__(self, path, max_size=1000):
+        self.root = path
+        self.max_size = int(max_size)
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # the directory is locked before it gets its visible name
+        tmp = tempfile.mkdtemp(dir=path, prefix='.spool-')
+        self._lockfile = _lock_spool(tmp)
+        self.path = os.path.join(path, os.path.basename(tmp)[1:])
+        os.rename(tmp, self.path)
+
+        self._recover()
+        self._size = len(self.keys())
+
+    def _recover(self):
+        """Takes over the messages of the spools that are not locked."""
+        # messages spooled in the root directory by older versions
+        self._take(self.root)
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if (name.startswith('.') or path == self.path or
+                not os.path.isdir(path)):
+                continue
+            lockfile = _lock_spool(path)
+            if lockfile is None:
+                # its process is still running
+                continue
+            try:
+                self._take(path)
+                _remove_spool(path)
+            finally:
+                lockfile.close()
+
+    def _take(self, path):
+        # the rename fails if another spool took the message first
+        for filename in os.listdir(path):
+            if not filename.endswith('.msg'):
+                continue
+            try:
+                os.rename(os.path.join(path, filename),
+                          os.path.join(self.path, filename))
+            except OSError:
+                pass
+
+    def close(self):
+        """Releases the spool. Its messages can be taken over."""
+        if self._lockfile is None:
+            return
+        _remove_spool(self.path)
+        self._lockfile.close()
+        self._lockfile = None
+
+    def __len__(self):
+        return self._size
+
+    def keys(self):
+        """Returns the keys of the spooled messages, oldest first."""
+        return sorted([filename for filename in os.listdir(self.path)
+                       if filename.endswith('.msg')])
+
+    def put(self, sender, rcpts, msg):
+        """Writes a message in the spool and returns its key."""
+        with self._lock:
+            if self._size >= self.max_size:
+                raise SpoolFullError(self.path)
+            self._size += 1
+
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'sender': sender, 'rcpts': rcpts, 'msg': msg}, f)
+
+            # the rename makes the message visible atomically
+            name = os.path.basename(tmp)[:-len('.tmp')]
+            key = '%017.6f-%s.msg' % (time.time(), name)
+            os.rename(tmp, os.path.join(self.path, key))
+        except (IOError, OSError):
+            with self._lock:
+                self._size -= 1
+            raise
+        return key
+
+    def get(self, key):
+        """Returns a (sender, rcpts, msg) tuple, or None if not found."""
+        try:
+            with open(os.path.join(self.path, key)) as f:
+                data = json.load(f)
+        except IOError:
+            return None
+        return data['sender'], data['rcpts'], data['msg']
+
+    def remove(self, key):
+        """Removes a message from the spool."""
+        try:
+            os.remove(os.path.join(self.path, key))
+        except OSError:
+            return
+        with self._lock:
+            self._size -= 1
+
+
+class MailQueue(object):
+    """Sends emails from a background thread.
+
+    Options:
+        - host, port, user, password, timeout: SMTP server settings
+        - spool_dir: if set, queued messages are stored in this directory
+          until they are sent
+        - max_size: maximum number of queued messages
+        - batch_size: maximum number of messages sent in a row
+        - retry_delay: seconds to wait before retrying when the SMTP
+          server is unreachable
+        - idle_timeout: seconds after which an unused session is closed
+    """
+    def __init__(self, host='localhost', port=25, user=None, password=None,
+                 timeout=5, spool_dir=None, max_size=1000, batch_size=20,
+                 retry_delay=5, idle_timeout=30):
+        self.connection = SMTPConnection(host, port, user, password,
+                                         timeout)
+        if spool_dir is not None:
+            self.spool = MailSpool(spool_dir, max_size)
+        else:
+            self.spool = None
+        self.batch_size = int(batch_size)
+        self.retry_delay = float(retry_delay)
+        self.idle_timeout = float(idle_timeout)
+        self._queue = Queue.Queue(int(max_size))
+        self._thread = None
+        self._stopping = False
+
+        # messages left over by a previous run, or taken over from other
+        # processes. They can outnumber max_size, so the ones that don't
+        # fit in the queue wait on disk until the worker gets to them.
+        self._backlog = deque()
+        if self.spool is not None:
+            self._backlog.extend(self.spool.keys())
+            self._refill()
+
+    def __len__(self):
+        return self._queue.qsize() + len(self._backlog)
+
+    def _refill(self):
+        """Moves spooled messages from the backlog to the queue."""
+        while self._backlog:
+            try:
+                self._queue.put_nowait(self._backlog[0])
+            except Queue.Full:
+                return
+            self._backlog.popleft()
+
+    def enqueue(self, sender, rcpts, msg):
+        """Queues a message.
+
+        Returns:
+            tuple: (True or False, Error Message)
+        """
+        if self.spool is not None:
+            try:
+                item = self.spool.put(sender, rcpts, msg)
+            except SpoolFullError:
+                return False, 'The mail queue is full'
+            except (IOError, OSError), e:
+                return False, str(e)
+        else:
+            item = sender, rcpts, msg
+
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            if self.spool is not None:
+                self.spool.remove(item)
+            return False, 'The mail queue is full'
+
+        return True, None
+
+    def start(self):
+        """Starts the worker."""
+        if self._thread is not None and self._thread.isAlive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the worker after the queued messages are sent.
+
+        If the SMTP server is unreachable, the worker gives up and the
+        remaining messages are left in the spool.
+        """
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                # nothing to send, let's not keep the session open
+                self.connection.close()
+                continue
+
+            # sending all available messages in the same session
+            batch = [item]
+            while len(batch) < self.batch_size and item is not _STOP:
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                batch.append(item)
+
+            if batch[-1] is _STOP:
+                self._send_batch(batch[:-1])
+                self.connection.close()
+                return
+
+            self._send_batch(batch)
+            self._refill()
+
+    def _send_batch(self, batch):
+        pending = list(batch)
+        while pending:
+            item = pending[0]
+            if self.spool is not None:
+                message = self.spool.get(item)
+            else:
+                message = item
+
+            if message is not None:
+                try:
+                    self.connection.sendmail(*message)
+                except _CONNECTION_ERRORS, e:
+                    logger.error('Could not reach the SMTP server: %s' % e)
+                    self.connection.close()
+                    if self._stopping:
+                        return
+                    time.sleep(self.retry_delay)
+                    continue
+                except smtplib.SMTPException, e:
+                    # the server refused this message, retrying won't help
+                    logger.error('Email dropped: %s' % e)
+
+            if self.spool is not None:
+                self.spool.remove(item)
+            pending.pop(0)
+
+
+_OPTIONS = None
+_QUEUES = {}
+_QUEUES_LOCK = threading.Lock()
+
+
+def enable_queue(**options):
+    """Makes send_email queue the messages instead of sending them.
+
+    The options are passed to MailQueue. When spool_dir is provided, each
+    SMTP server gets its own sub-directory.
+
+    The running queues are kept if the options did not change. Otherwise
+    they are stopped, and new ones are started with the new options.
+    """
+    global _OPTIONS
+    if options == _OPTIONS:
+        return
+    disable_queue()
+    _OPTIONS = options
+
+
+def disable_queue(timeout=None):
+    """Stops all the queues. send_email goes back to synchronous mode."""
+    global _OPTIONS
+    _OPTIONS = None
+    with _QUEUES_LOCK:
+        queues = _QUEUES.values()
+        _QUEUES.clear()
+    for queue in queues:
+        queue.stop(timeout)
+        if queue.spool is not None:
+            queue.spool.close()
+
+
+@atexit.register
+def _stop_queues():
+    disable_queue(_EXIT_TIMEOUT)
+
+
+def get_queue(host='localhost', port=25, user=None, password=None):
+    """Returns the running queue for a SMTP server.
+
+    Returns None if the queue is not enabled.
+    """
+    options = _OPTIONS
+    if options is None:
+        return None
+
+    key = host, int(port), user, password
+    with _QUEUES_LOCK:
+        if key in _QUEUES:
+            return _QUEUES[key]
+
+        options = dict(options)
+        spool_dir = options.pop('spool_dir', None)
+        if spool_dir is not None:
+            spool_dir = os.path.join(spool_dir, '%s-%d' % (host, int(port)))
+
+        queue = MailQueue(host, port, user, password, spool_dir=spool_dir,
+                          **options)
+        queue.start()
+        _QUEUES[key] = queue
+        return queue
@@ -0,0 +1,74 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Compiled statements cache benchmark.
+
+Runs the user authentication query on an engine built by the sql backend,
+which caches the compiled statements, and on a plain engine.
+
+    $ python -m services.tests.bench_compiled_cache [runs]
+"""
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+from services.auth.sql import _create_engine, _USER_AUTH
+from services.auth.sqlmappers import users
+
+
+def _run(engine, runs):
+    start = time.time()
+    for i in range(runs):
+        engine.execute(_USER_AUTH, user_name='bob').fetchall()
+    return time.time() - start
+
+
+def main(runs=3000):
+    cached = _create_engine('sqlite:///:memory:', 5, 60)
+    plain = create_engine('sqlite:///:memory:')
+    timings = []
+    for engine in (cached, plain):
+        users.create(bind=engine)
+        timings.append(min([_run(engine, runs) for i in range(5)]))
+
+    cached, plain = timings
+    print 'cached: %.1f us per query' % (cached / runs * 1e6)
+    print 'plain:  %.1f us per query' % (plain / runs * 1e6)
+    print 'speedup: %.1fx' % (plain / cached)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,81 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Config loading benchmark.
+
+Loads a config file from its snapshot, and by parsing it, the way the
+workers do at startup.
+
+    $ python -m services.tests.bench_config [runs] [config_file]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from services.config import load_config_map
+
+_CONFIG = os.path.join(os.path.dirname(__file__), 'sync.conf')
+
+
+def _run(filename, cache_dir, runs):
+    start = time.time()
+    for i in range(runs):
+        load_config_map(filename, cache_dir)
+    return time.time() - start
+
+
+def main(runs=1000, filename=_CONFIG):
+    runs = int(runs)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        # writes the snapshot
+        load_config_map(filename, cache_dir)
+        timings = []
+        for directory in (cache_dir, None):
+            timings.append(min([_run(filename, directory, runs)
+                                for i in range(3)]))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    snapshot, parsing = timings
+    print 'snapshot: %.1f us per load' % (snapshot / runs * 1e6)
+    print 'parsing:  %.1f us per load' % (parsing / runs * 1e6)
+    print 'speedup: %.1fx' % (parsing / snapshot)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,88 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Bulk user creation benchmark.
+
+Creates users with SQLAuth.create_users, which inserts them by batches,
+and with one create_user call per user, in a SQLite file database.
+
+    $ python -m services.tests.bench_create_users [users]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from services.auth.sql import SQLAuth
+
+
+def _run(create, count):
+    path = tempfile.mkdtemp()
+    try:
+        auth = SQLAuth('sqlite:///%s' % os.path.join(path, 'auth.db'))
+        users = [('user%d' % i, 'secret', 'user%d@moz.com' % i)
+                 for i in range(count)]
+        start = time.time()
+        create(auth, users)
+        duration = time.time() - start
+        auth.close()
+        return duration
+    finally:
+        shutil.rmtree(path)
+
+
+def _bulk(auth, users):
+    auth.create_users(users)
+
+
+def _one_by_one(auth, users):
+    for user in users:
+        auth.create_user(*user)
+
+
+def main(count=1000):
+    timings = []
+    for create in (_bulk, _one_by_one):
+        timings.append(min([_run(create, count) for i in range(3)]))
+
+    bulk, one_by_one = timings
+    print 'create_users: %d users/sec' % (count / bulk)
+    print 'create_user:  %d users/sec' % (count / one_by_one)
+    print 'speedup: %.1fx' % (one_by_one / bulk)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
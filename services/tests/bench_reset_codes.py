@@ -0,0 +1,107 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Reset code verification benchmark.
+
+Verifies a reset code with ResetCodeManager, which stores the expiration
+as epoch seconds and lets the database filter out the expired codes. The
+previous schema, with a DATETIME expiration read back and compared in
+Python, is rebuilt here for comparison.
+
+    $ python -m services.tests.bench_reset_codes [runs]
+"""
+import sys
+import time
+import datetime
+
+from sqlalchemy import create_engine, MetaData, Table, Column, String, \
+                       DateTime
+from sqlalchemy.sql import select, bindparam
+
+from services.auth.resetcode import ResetCodeManager, _USER_RESET_CODE
+
+_OLD = Table('old_reset_codes', MetaData(),
+             Column('username', String(32), primary_key=True),
+             Column('reset', String(32)),
+             Column('expiration', DateTime()))
+
+_OLD_RESET_CODE = select([_OLD.c.expiration, _OLD.c.reset],
+                         _OLD.c.username == bindparam('user_name'))
+
+
+def _run(func, runs):
+    start = time.time()
+    for i in range(runs):
+        func()
+    return time.time() - start
+
+
+def main(runs=5000):
+    engine = create_engine('sqlite:///:memory:')
+    mgr = ResetCodeManager(engine, True)
+    code = mgr.generate_reset_code(1)
+
+    _OLD.create(bind=engine)
+    expiration = datetime.datetime.now() + datetime.timedelta(hours=6)
+    engine.execute(_OLD.insert().values(username='1', reset=code,
+                                        expiration=expiration))
+
+    def _old_verify():
+        row = engine.execute(_OLD_RESET_CODE, user_name='1').fetchone()
+        return (row is not None and row.expiration > datetime.datetime.now()
+                and row.reset == code)
+
+    def _new_verify():
+        row = engine.execute(_USER_RESET_CODE, user_name='1',
+                             now=int(time.time())).fetchone()
+        return row is not None and row.reset == code
+
+    def _verify():
+        return mgr.verify_reset_code(1, code)
+
+    assert _verify() and _new_verify() and _old_verify()
+    timings = []
+    for func in (_new_verify, _old_verify, _verify):
+        timings.append(min([_run(func, runs) for i in range(5)]))
+
+    new, old, full = timings
+    print 'epoch lookup:    %.1f us' % (new / runs * 1e6)
+    print 'datetime lookup: %.1f us' % (old / runs * 1e6)
+    print 'speedup: %.1fx' % (old / new)
+    print 'verify_reset_code: %.1f us' % (full / runs * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
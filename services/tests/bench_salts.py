@@ -0,0 +1,74 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Salt generation benchmark.
+
+Generates 8-char salts with _gensalt, which reads urandom by blocks, and
+with one urandom call per char, like the previous randchar did.
+
+    $ python -m services.tests.bench_salts [runs]
+"""
+import os
+import sys
+import time
+
+from services.util import _gensalt, _CHARS
+
+
+def _urandom_salt(size=8):
+    return ''.join([_CHARS[ord(os.urandom(1)) % len(_CHARS)]
+                    for i in range(size)])
+
+
+def _run(func, runs):
+    start = time.time()
+    for i in range(runs):
+        func()
+    return time.time() - start
+
+
+def main(runs=20000):
+    timings = []
+    for func in (_gensalt, _urandom_salt):
+        timings.append(min([_run(func, runs) for i in range(3)]))
+
+    blocks, chars = timings
+    print 'blocks:   %d salts/sec' % (runs / blocks)
+    print 'per char: %d salts/sec' % (runs / chars)
+    print 'speedup: %.1fx' % (chars / blocks)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,71 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" User name extraction benchmark.
+
+Converts the same email addresses with extract_username, which memoizes
+the conversions, and with the plain conversion it wraps.
+
+    $ python -m services.tests.bench_usernames [runs]
+"""
+import sys
+import time
+
+from services.util import extract_username, _hash_email
+
+
+def _run(func, emails, runs):
+    start = time.time()
+    for i in range(runs):
+        for email in emails:
+            func(email)
+    return time.time() - start
+
+
+def main(runs=100):
+    emails = ['user%d@moz.com' % i for i in range(1000)]
+    count = runs * len(emails)
+    timings = []
+    for func in (extract_username, _hash_email):
+        timings.append(min([_run(func, emails, runs) for i in range(3)]))
+
+    memoized, plain = timings
+    print 'memoized: %.2f us per email' % (memoized / count * 1e6)
+    print 'plain:    %.2f us per email' % (plain / count * 1e6)
+    print 'speedup: %.1fx' % (plain / memoized)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
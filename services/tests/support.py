@@ -37,6 +37,9 @@ from ConfigParser import RawConfigParser
 import os
 from logging.config import fileConfig
 import smtplib
+import smtpd
+import asyncore
+import threading
 from email import message_from_string
 
 from services.auth import ServicesAuth
@@ -218,3 +221,44 @@ def get_sent_email(index=-1):
     sender, rcpts, msg = _FakeSMTP.msgs[index]
     msg = message_from_string(msg)
     return sender, rcpts, msg
+
+
+class _SMTPServer(smtpd.SMTPServer):
+
+    def __init__(self, localaddr):
+        smtpd.SMTPServer.__init__(self, localaddr, None)
+        self.msgs = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.msgs.append((mailfrom, rcpttos, data))
+
+
+class LocalSMTPServer(object):
+    """smtpd stand-in, running in a thread on a random local port."""
+
+    def __init__(self):
+        self._server = _SMTPServer(('127.0.0.1', 0))
+        self.port = self._server.socket.getsockname()[1]
+        self.msgs = self._server.msgs
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def connections(self):
+        return self._server.connections
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        asyncore.close_all()
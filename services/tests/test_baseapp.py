@@ -35,9 +35,14 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import base64
+import os
+import tempfile
+import time
 
-from services.baseapp import SyncServerApp
-from services.util import BackendError
+from services.baseapp import SyncServerApp, ConfigReloader
+from services.util import BackendError, safe_execute, set_backend_health
+from sqlalchemy import create_engine
+from services.mailer import get_queue, disable_queue
 from webob.exc import HTTPUnauthorized, HTTPServiceUnavailable
 
 
@@ -115,6 +120,168 @@ class TestBaseApp(unittest.TestCase):
         else:
             raise AssertionError()
 
+    def test_adaptive_retry_after(self):
+        config = {'global.retry_after': 60,
+                  'global.adaptive_retry_after': True,
+                  'auth.backend': 'dummy'}
+        urls = [('GET', '/boom', 'foo', 'boom'),
+                ('POST', '/', 'foo', 'secret')]
+        controllers = {'foo': _Foo}
+        app = SyncServerApp(urls, controllers, config)
+
+        def _retry_after():
+            request = _Request('GET', '/boom', 'localhost')
+            try:
+                app(request)
+            except HTTPServiceUnavailable, error:
+                return error.headers['Retry-After']
+            raise AssertionError()
+
+        # the outage just started
+        self.assertEqual(_retry_after(), '5')
+
+        # it's been going on for a while
+        app.health.failing_since -= 20
+        self.assertEqual(_retry_after(), '40')
+        app.health.failing_since -= 100
+        self.assertEqual(_retry_after(), '60')
+
+        # requests that don't reach the backend don't end it
+        app(_Request('POST', '/', 'localhost'))
+        self.assertEqual(_retry_after(), '60')
+
+        # a successful backend call does
+        try:
+            safe_execute(create_engine('sqlite:///:memory:'), 'select 1')
+            self.assertEqual(_retry_after(), '5')
+
+            # failing calls keep it going
+            app.health.failing_since -= 20
+            self.assertRaises(BackendError, safe_execute,
+                              create_engine('sqlite:///:memory:'),
+                              'select * from nowhere')
+            self.assertEqual(_retry_after(), '40')
+
+            # the reloads keep the outage going
+            config = dict(config)
+            config['one.two'] = 1
+            health = app.health
+            app.reload_config(config)
+            self.assertTrue(app.health is health)
+            self.assertEqual(_retry_after(), '40')
+        finally:
+            set_backend_health(None)
+
+    def test_reload_config(self):
+        request = _Request('POST', '/', 'here')
+        self.assertEqual(self.app(request).body, '1')
+        auth = self.app.auth
+
+        config = {'host:here.one.two': 3,
+                  'one.two': 4,
+                  'global.retry_after': 10,
+                  'auth.backend': 'dummy'}
+        self.app.reload_config(config)
+        self.assertTrue(self.app.config is config)
+        self.assertEqual(self.app.retry_after, 10)
+
+        # the overlays of the known hosts are ready
+        self.assertEqual(self.app._host_configs.keys(), ['here'])
+        self.assertEqual(self.app(request).body, '3')
+        request = _Request('POST', '/', 'localhost')
+        self.assertEqual(self.app(request).body, '4')
+
+        # the auth options did not change
+        self.assertTrue(self.app.auth is auth)
+        self.assertTrue(self.app.auth.config is config)
+
+        # the old backend is closed when it's replaced
+        closed = []
+        auth.backend.close = lambda: closed.append(True)
+        config = dict(config)
+        config['auth_throttle.use'] = True
+        self.app.reload_config(config)
+        self.assertFalse(self.app.auth is auth)
+        self.assertEqual(closed, [True])
+
+    def test_reload_mailqueue(self):
+        config = dict(self.app.config)
+        config['mailqueue.use'] = True
+        config['mailqueue.batch_size'] = 5
+        self.app.reload_config(config)
+        try:
+            queue = get_queue()
+            self.assertEqual(queue.batch_size, 5)
+
+            # the queue is kept by the reloads and the new apps with the
+            # same options
+            config = dict(config)
+            config['one.two'] = 5
+            self.app.reload_config(config)
+            SyncServerApp([], {}, config)
+            self.assertTrue(get_queue() is queue)
+
+            # the queue is replaced when its options change
+            config = dict(config)
+            config['mailqueue.batch_size'] = 50
+            self.app.reload_config(config)
+            self.assertEqual(get_queue().batch_size, 50)
+            self.assertTrue(queue._thread is None)
+
+            # and stopped when it's disabled
+            config = dict(config)
+            del config['mailqueue.use']
+            self.app.reload_config(config)
+            self.assertTrue(get_queue() is None)
+        finally:
+            disable_queue()
+
+    def test_config_reloader(self):
+        fd, extended = tempfile.mkstemp()
+        os.write(fd, '[one]\ntwo = 5\n')
+        os.close(fd)
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, '[DEFAULT]\nextends = %s\n[auth]\nbackend = dummy\n'
+                 % extended)
+        os.close(fd)
+        try:
+            reloader = ConfigReloader({'configuration': 'file:' + filename},
+                                      check_interval=0.01)
+            config = reloader.load()
+            self.assertEqual(config['one.two'], 5)
+
+            urls = [('POST', '/', 'foo', 'index')]
+            app = SyncServerApp(urls, {'foo': _Foo}, config)
+            app.reloader = reloader
+            request = _Request('POST', '/', 'localhost')
+            self.assertEqual(app(request).body, '5')
+
+            # changing the extended file
+            time.sleep(0.02)
+            self.assertFalse(reloader.changed())
+            with open(extended, 'w') as f:
+                f.write('[one]\ntwo = 6\n')
+            mtime = time.time() + 10
+            os.utime(extended, (mtime, mtime))
+            time.sleep(0.02)
+            self.assertEqual(app(request).body, '6')
+            self.assertFalse(reloader.changed())
+
+            # asking for it
+            reloader.request()
+            self.assertTrue(reloader.changed())
+            reloader.load()
+            self.assertFalse(reloader.changed())
+
+            # a broken config is not applied
+            os.remove(extended)
+            reloader.request()
+            self.assertEqual(app(request).body, '6')
+        finally:
+            os.remove(filename)
+            if os.path.exists(extended):
+                os.remove(extended)
+
     def test_heartbeat_debug_pages(self):
 
         config = {'global.heartbeat_page': '__heartbeat__',
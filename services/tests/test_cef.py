@@ -0,0 +1,210 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import tempfile
+import os
+
+from services.cef import (log_cef, AppendWriter, BufferedWriter,
+                          CEFLogger, get_cef_logger, _close_writers)
+from services.util import filter_params
+
+
+class TestCEF(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        self.environ = {'REMOTE_ADDR': '127.0.0.1', 'HTTP_HOST': '127.0.0.1',
+                        'PATH_INFO': '/', 'REQUEST_METHOD': 'GET',
+                        'HTTP_USER_AGENT': 'MySuperBrowser'}
+        self.config = {'cef.version': '0', 'cef.vendor': 'mozilla',
+                       'cef.device_version': '3', 'cef.product': 'weave',
+                       'cef.file': self.filename}
+
+    def tearDown(self):
+        _close_writers()
+        for filename in (self.filename, self.filename + '.1'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _lines(self, filename=None):
+        with open(filename or self.filename) as f:
+            return f.readlines()
+
+    def test_log(self):
+        log_cef('xx|x', 5, self.environ, self.config, username='tarek',
+                custom1='yes')
+        line = self._lines()[0]
+        self.assertTrue('|xx\\|x|xx\\|x|5|' in line)
+        self.assertTrue('suser=tarek' in line)
+        self.assertTrue(line.rstrip().endswith('custom1=yes'))
+
+    def test_logger(self):
+        # loggers are built once per configuration
+        cef_logger = get_cef_logger(self.config)
+        self.assertTrue(cef_logger is get_cef_logger(dict(self.config)))
+        self.config['cef.vendor'] = '100%|moz'
+        self.assertFalse(cef_logger is get_cef_logger(self.config))
+
+        cef_logger = CEFLogger(filter_params('cef', self.config))
+        cef_logger.log('one', 5, self.environ)
+
+        # static fields can still be overriden
+        cef_logger.log('two', 5, self.environ, product='sync')
+        one, two = self._lines()
+        self.assertTrue('CEF:0|100%\\|moz|weave|3|one|one|5|' in one)
+        self.assertTrue('CEF:0|100%\\|moz|sync|3|two|two|5|' in two)
+
+    def test_rate_limit(self):
+        self.config['cef.rate_limit'] = 0.001
+        self.config['cef.rate_burst'] = 2
+        cef_logger = CEFLogger(filter_params('cef', self.config))
+        for i in range(5):
+            cef_logger.log('AuthFail', 5, self.environ)
+
+        # another source has its own bucket
+        environ = dict(self.environ)
+        environ['REMOTE_ADDR'] = '10.0.0.1'
+        cef_logger.log('AuthFail', 5, environ)
+
+        # the first records are kept verbatim
+        lines = self._lines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue('src=10.0.0.1' in lines[-1])
+
+        # the other ones are counted in a summary
+        cef_logger.flush()
+        summary = self._lines()[-1]
+        self.assertTrue('src=127.0.0.1' in summary)
+        self.assertTrue(summary.rstrip().endswith('cnt=3'))
+
+    def test_rate_limit_keys(self):
+        self.config['cef.rate_limit'] = 0.001
+        self.config['cef.rate_burst'] = 2
+        self.config['cef.max_sources'] = 10
+        cef_logger = CEFLogger(filter_params('cef', self.config),
+                               trusted_proxies='10.0.0.1')
+
+        # the user name in the record name is not part of the key, and
+        # X-Forwarded-For is ignored when not set by a trusted proxy
+        for i in range(50):
+            environ = dict(self.environ)
+            environ['HTTP_X_FORWARDED_FOR'] = '192.168.0.%d' % i
+            cef_logger.log('Authentication Failed for user%d' % i, 5,
+                           environ, signature='AuthFail')
+        self.assertEqual(len(self._lines()), 2)
+        self.assertEqual(len(cef_logger._buckets), 1)
+
+        # the trusted proxy forwards the client IP, the others share a
+        # single bucket once max_sources is reached
+        for i in range(50):
+            environ = dict(self.environ)
+            environ['REMOTE_ADDR'] = '10.0.0.1'
+            environ['HTTP_X_FORWARDED_FOR'] = 'spoofed, 192.168.0.%d' % i
+            cef_logger.log('AuthFail', 5, environ)
+        self.assertEqual(len(cef_logger._buckets), 11)
+        self.assertEqual(len(self._lines()), 2 + 9 + 2)
+
+    def test_buffered(self):
+        self.config['cef.buffered'] = True
+        self.config['cef.flush_interval'] = 60
+        for i in range(3):
+            log_cef('event %d' % i, 5, self.environ, self.config)
+
+        # nothing is written yet
+        self.assertEqual(self._lines(), [])
+        _close_writers()
+        self.assertEqual(len(self._lines()), 3)
+
+    def test_rotation(self):
+        writer = BufferedWriter(self.filename, flush_interval=60)
+        try:
+            writer.write('one\n')
+            writer.flush()
+            os.rename(self.filename, self.filename + '.1')
+            writer.write('two\n')
+            writer.flush()
+        finally:
+            writer.close()
+
+        self.assertEqual(self._lines(self.filename + '.1'), ['one\n'])
+        self.assertEqual(self._lines(), ['two\n'])
+
+    def test_multiprocess(self):
+        # records written by several processes are never mixed
+        pids = []
+        for char in 'abcd':
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    writer = AppendWriter(self.filename)
+                    for i in range(200):
+                        writer.write(char * 900 + '\n')
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        lines = self._lines()
+        self.assertEqual(len(lines), 800)
+        for line in lines:
+            self.assertEqual(line, line[0] * 900 + '\n')
+
+    def test_chunks(self):
+        writer = BufferedWriter(self.filename, flush_interval=60,
+                                max_write=10)
+        writes = []
+        writer._writer.write = writes.append
+        try:
+            for line in ('one\n', 'two\n', 'three\n'):
+                writer.write(line)
+            writer.flush()
+        finally:
+            writer.close()
+
+        # complete records only, no more than 10 bytes at once
+        self.assertEqual(writes, ['one\ntwo\n', 'three\n'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCEF))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -36,9 +36,12 @@
 import unittest
 import tempfile
 import os
+import time
+import shutil
 from StringIO import StringIO
 
-from services.config import Config, EnvironmentNotFoundError
+from services.config import (Config, EnvironmentNotFoundError,
+                             load_config_map)
 
 
 _FILE_ONE = """\
@@ -117,8 +120,57 @@ class ConfigTestCase(unittest.TestCase):
         # extends
         self.assertEquals(config.get('three', 'more'), 'stuff')
         self.assertEquals(config.get('one', 'two'), 'a')
+        self.assertEquals(len(config.filenames), 2)
+        self.assertEquals(config.filenames[1], self.file_two)
 
     def test_nofile(self):
         # if a user tries to use an inexistant file in extensios,
         # pops an error
         self.assertRaises(IOError, Config, self.file_three)
+
+    def test_snapshot(self):
+        cache_dir = tempfile.mkdtemp()
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, _FILE_ONE % self.file_two)
+        os.close(fd)
+
+        def _age(*filenames):
+            past = time.time() - 60
+            for name in filenames:
+                os.utime(name, (past, past))
+
+        try:
+            _age(filename, self.file_two)
+            files = []
+            map = load_config_map(filename, cache_dir, files)
+            self.assertEquals(map, Config(filename).get_map())
+            self.assertEquals(files, [filename, self.file_two])
+            self.assertEquals(len(os.listdir(cache_dir)), 1)
+
+            # loaded from the snapshot
+            files = []
+            self.assertEquals(load_config_map(filename, cache_dir, files),
+                              map)
+            self.assertEquals(files, [filename, self.file_two])
+
+            # the environment changes
+            os.environ['__STUFF__'] = 'other'
+            map = load_config_map(filename, cache_dir)
+            self.assertEquals(map['one.env'], 'some other')
+
+            # an extended file changes
+            with open(self.file_two, 'w') as f:
+                f.write(_FILE_TWO.replace('more = stuff', 'more = things'))
+            _age(self.file_two)
+            map = load_config_map(filename, cache_dir)
+            self.assertEquals(map['three.more'], 'things')
+            self.assertEquals(load_config_map(filename, cache_dir), map)
+
+            # a broken snapshot is rebuilt
+            snapshot = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            with open(snapshot, 'w') as f:
+                f.write('boom')
+            self.assertEquals(load_config_map(filename, cache_dir), map)
+        finally:
+            os.remove(filename)
+            shutil.rmtree(cache_dir)
@@ -35,6 +35,7 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 from services.controllers import StandardController
+from services.engines import create_engine
 
 
 _ENVIRON = {'HTTP_COOKIE': 'somecookie', 'SCRIPT_NAME': '',
@@ -128,6 +129,13 @@ class TestStandardController(unittest.TestCase):
         # make sure we don't have any password left
         self.assertTrue('xxxx' not in debug.body)
 
+    def test_engines_metrics(self):
+        engine = create_engine('sqlite:///:memory:')
+        engine.execute('select 1')
+        debug = StandardController(None)._debug(_Request())
+        self.assertTrue('sqlite:///:memory:' in debug.body)
+        self.assertTrue('query_count' in debug.body)
+
 
 def test_suite():
     suite = unittest.TestSuite()
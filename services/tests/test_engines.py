@@ -0,0 +1,167 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import tempfile
+import shutil
+import os
+
+from sqlalchemy import create_engine
+
+from services.engines import (ReadWriteEngines, split_uris, get_metrics,
+                              _MeteredQueuePool, EngineMetrics)
+from services.engines import create_engine as create_metered_engine
+from services.auth.sql import SQLAuth
+
+
+class TestReadWriteEngines(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.engines = []
+        for name in ('primary', 'replica1', 'replica2'):
+            engine = create_engine(self._uri(name))
+            engine.execute('create table who (name varchar(32))')
+            engine.execute("insert into who values ('%s')" % name)
+            self.engines.append(engine)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _uri(self, name):
+        return 'sqlite:///%s' % os.path.join(self.dir, name + '.db')
+
+    def _who(self, engines, key=None):
+        return engines.read(key, 'select name from who').fetchone()[0]
+
+    def test_split_uris(self):
+        self.assertEqual(split_uris(None), [])
+        self.assertEqual(split_uris('a, b'), ['a', 'b'])
+        self.assertEqual(split_uris(['a', 'b']), ['a', 'b'])
+
+    def test_routing(self):
+        primary, replica1, replica2 = self.engines
+
+        # no replicas
+        engines = ReadWriteEngines(primary)
+        self.assertEqual(self._who(engines), 'primary')
+
+        # the reads are spread over the replicas
+        engines = ReadWriteEngines(primary, [replica1, replica2])
+        names = set([self._who(engines) for i in range(4)])
+        self.assertEqual(names, set(['replica1', 'replica2']))
+
+        # unless the key was just written
+        engines.written('tarek')
+        self.assertEqual(self._who(engines, 'tarek'), 'primary')
+        self.assertNotEqual(self._who(engines, 'bob'), 'primary')
+
+        engines = ReadWriteEngines(primary, [replica1], sticky_ttl=-1)
+        engines.written('tarek')
+        self.assertEqual(self._who(engines, 'tarek'), 'replica1')
+
+    def test_fallback(self):
+        primary, replica1, replica2 = self.engines
+        broken = create_engine('sqlite:////doesnotexist/broken.db')
+        engines = ReadWriteEngines(primary, [broken])
+        self.assertEqual(self._who(engines), 'primary')
+
+        # the broken replica is left aside
+        self.assertEqual(engines.readers(), [])
+
+        engines = ReadWriteEngines(primary, [broken, replica1])
+        for i in range(3):
+            self.assertEqual(self._who(engines), 'replica1')
+
+    def test_sqlauth(self):
+        primary = self._uri('auth')
+        replica = self._uri('auth-replica')
+        auth = SQLAuth(primary, sqluri_read=replica, create_tables=True)
+        SQLAuth(replica, create_tables=True)
+
+        # the user is created on the primary, and read from there
+        self.assertTrue(auth.create_user('tarek', 'tarek', 'tarek@moz.com'))
+        user_id = auth.get_user_id('tarek')
+        self.assertNotEqual(user_id, None)
+        self.assertEqual(auth.authenticate_user('tarek', 'tarek'), user_id)
+
+        # once the sticky period is over, the replica is used
+        auth._engines._sticky.clear()
+        self.assertEqual(auth.get_user_id('tarek'), None)
+
+
+class TestEngineMetrics(unittest.TestCase):
+
+    def test_metrics(self):
+        engine = create_metered_engine('sqlite:///:memory:', pool_size=2)
+        for i in range(3):
+            engine.execute('select 1').fetchall()
+
+        metrics = engine.metrics.snapshot()
+        self.assertEqual(metrics['connections'], 1)
+        self.assertEqual(metrics['checkouts'], 3)
+        self.assertEqual(metrics['checked_out'], 0)
+        self.assertEqual(metrics['query_count'], 3)
+        self.assertEqual(metrics['connection_age_count'], 3)
+        self.assertTrue(metrics['query_max_ms'] >= metrics['query_avg_ms'])
+
+        self.assertTrue('sqlite:///:memory:' in get_metrics())
+        engine.metrics.reset()
+        self.assertEqual(engine.metrics.snapshot()['checkouts'], 0)
+
+    def test_checkout_wait(self):
+        metrics = EngineMetrics()
+        engine = create_engine('sqlite:///:memory:',
+                               poolclass=_MeteredQueuePool, pool_size=1,
+                               max_overflow=0, pool_timeout=1)
+        engine.pool.metrics = metrics
+        engine.execute('select 1').fetchall()
+        self.assertEqual(metrics.snapshot()['checkout_wait_count'], 1)
+
+        # the metrics survive a pool recreation
+        engine.dispose()
+        self.assertTrue(isinstance(engine.pool, _MeteredQueuePool))
+        engine.execute('select 1').fetchall()
+        self.assertEqual(metrics.snapshot()['checkout_wait_count'], 2)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestReadWriteEngines))
+    suite.addTest(unittest.makeSuite(TestEngineMetrics))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
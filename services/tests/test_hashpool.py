@@ -0,0 +1,132 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import os
+import time
+import threading
+
+from services.hashpool import (HashPool, enable_pool, disable_pool, get_pool,
+                               hash_password, hash_passwords,
+                               verify_password)
+from services.util import get_hasher, BackendError, BackendTimeoutError
+
+
+def _wait_for(condition, timeout=5.):
+    start = time.time()
+    while not condition() and time.time() - start < timeout:
+        time.sleep(0.01)
+
+
+class TestHashPool(unittest.TestCase):
+
+    def tearDown(self):
+        disable_pool()
+
+    def test_disabled(self):
+        self.assertEqual(get_pool(), None)
+        hasher = get_hasher('ssha256')
+        hash = hash_password(hasher, 'secret')
+        self.assertTrue(hash.startswith('{SSHA-256}'))
+        self.assertTrue(verify_password('secret', hash))
+        self.assertFalse(verify_password('wrong', hash))
+
+    def test_enabled(self):
+        enable_pool(size=2)
+        self.assertNotEqual(get_pool(), None)
+        hasher = get_hasher('pbkdf2', 100)
+        hash = hash_password(hasher, 'secret')
+        self.assertTrue(hash.startswith('{PBKDF2-SHA256}100$'))
+        self.assertTrue(verify_password('secret', hash))
+        self.assertFalse(verify_password('wrong', hash))
+
+        hashes = hash_passwords(hasher, ['one', 'two'])
+        self.assertTrue(verify_password('one', hashes[0]))
+        self.assertTrue(verify_password('two', hashes[1]))
+
+        # the work is done in another process
+        pid = get_pool().apply(os.getpid)
+        self.assertNotEqual(pid, os.getpid())
+
+    def test_timeout(self):
+        pool = HashPool(size=1, timeout=0.1)
+        try:
+            self.assertRaises(BackendTimeoutError, pool.apply,
+                              time.sleep, 0.5)
+
+            # the job is still running, so it's still pending
+            self.assertEqual(pool._pending, 1)
+            _wait_for(lambda: pool._pending == 0)
+            self.assertEqual(pool._pending, 0)
+
+            # errors are raised in the caller
+            self.assertRaises(TypeError, pool.apply, time.sleep, 'bad')
+            self.assertRaises(TypeError, pool.map, time.sleep, [0, 'bad'])
+            self.assertEqual(pool._pending, 0)
+        finally:
+            pool.close()
+
+    def test_saturation(self):
+        pool = HashPool(size=1, max_pending=1)
+        errors = []
+
+        def _hash():
+            try:
+                pool.apply(time.sleep, 0.5)
+            except BackendError:
+                errors.append(1)
+
+        try:
+            # the pool is started in the main thread first
+            pool.apply(os.getpid)
+            threads = [threading.Thread(target=_hash) for i in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            pool.close()
+
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(pool._pending, 0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestHashPool))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -35,6 +35,7 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import random
+import re
 
 from services.util import BackendError, BackendTimeoutError
 from sqlalchemy.exc import OperationalError
@@ -99,6 +100,7 @@ if LDAP:
                 self.simple_bind_s(bind, passwd)
             self.uri = uri
             self._next_id = 30
+            self._results = {}
             self._l = self
 
         def unbind_ext(self, *args, **kw):
@@ -125,6 +127,13 @@ if LDAP:
             if dn in self.users:
                 return [(dn, self.users[dn])]
             elif dn in ('ou=users,dc=mozilla', 'dc=mozilla', 'md5'):
+                if kw['filterstr'].startswith('(|'):
+                    # OR filter
+                    terms = re.findall(r'\((\w+)=([^()]*)\)',
+                                       kw['filterstr'])
+                    return [(dn_, value) for dn_, value in self.users.items()
+                            if (key, str(value[key][0])) in terms]
+
                 key, field = kw['filterstr'][1:-1].split('=')
                 for dn_, value in self.users.items():
                     if key not in value:
@@ -148,6 +157,20 @@ if LDAP:
                 self._next_id += 1
             return ldap.RES_ADD, ''
 
+        def add(self, dn, user):
+            msgid = len(self._results) + 1
+            try:
+                self._results[msgid] = self.add_s(dn, user)
+            except Exception, e:
+                self._results[msgid] = ldap.ALREADY_EXISTS(str(e))
+            return msgid
+
+        def result(self, msgid):
+            res = self._results.pop(msgid)
+            if isinstance(res, Exception):
+                raise res
+            return res
+
         def modify_s(self, dn, user):
             if dn in self.users:
                 for type_, key, value in user:
@@ -235,6 +258,39 @@ class TestLDAPSQLAuth(unittest.TestCase):
         auth_uid = auth.authenticate_user('tarek', 'xxxx')
         self.assertEquals(auth_uid, None)
 
+    def test_create_users(self):
+        if not LDAP:
+            return
+
+        auth = self._get_auth()
+        users_ = [('bulk%d' % i, 'secret%d' % i, 'bulk%d@moz.com' % i)
+                  for i in range(5)]
+        res = auth.create_users(users_, batch_size=2)
+        self.assertEqual(res, [(True, None)] * 5)
+        for user_name, password, email in users_:
+            uid = auth.get_user_id(user_name)
+            self.assertNotEqual(uid, None)
+            self.assertEqual(auth.get_user_info(uid), (user_name, email))
+
+    def test_get_user_ids(self):
+        if not LDAP:
+            return
+
+        auth = self._get_auth(ldap_batch_size=2)
+        users_ = [('bulk%d' % i, 'secret%d' % i, 'bulk%d@moz.com' % i)
+                  for i in range(5)]
+        auth.create_users(users_)
+        names = [user_name for user_name, __, __ in users_] + ['unknown']
+        ids = auth.get_user_ids(names)
+        self.assertEqual(ids['unknown'], None)
+        for user_name in names[:-1]:
+            self.assertEqual(ids[user_name], auth.get_user_id(user_name))
+
+        infos = auth.get_user_infos([ids['bulk0'], ids['bulk4'], 12345])
+        self.assertEqual(infos[ids['bulk0']], ('bulk0', 'bulk0@moz.com'))
+        self.assertEqual(infos[ids['bulk4']], ('bulk4', 'bulk4@moz.com'))
+        self.assertEqual(infos[12345], (None, None))
+
     def test_node_attribution(self):
         if not LDAP:
             return
@@ -322,6 +378,20 @@ class TestLDAPSQLAuth(unittest.TestCase):
         uid = auth.authenticate_user('x', 'xxxx')
         self.assertTrue(uid is not None)
 
+    def test_negative_cache(self):
+        if not LDAP:
+            return
+
+        auth = self._get_auth(negative_cache_size=10)
+        self.assertEqual(auth.get_user_id('bob'), None)
+        self.assertEqual(auth.authenticate_user('bob', 'bob'), None)
+        self.assertTrue('bob' in auth._unknown_users)
+
+        # creating the user invalidates the cache
+        self.assertTrue(auth.create_user('bob', 'bob', 'bob@moz.com'))
+        self.assertFalse('bob' in auth._unknown_users)
+        self.assertTrue(auth.authenticate_user('bob', 'bob') is not None)
+
     def test_ldap_pool_size(self):
         if not LDAP:
             return
@@ -0,0 +1,165 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import os
+import tempfile
+import shutil
+import time
+
+from services.mailer import (MailQueue, MailSpool, SpoolFullError,
+                             enable_queue, disable_queue, get_queue)
+from services.util import send_email
+from services.tests.support import LocalSMTPServer
+
+
+def _wait_for(condition, timeout=5.):
+    start = time.time()
+    while not condition() and time.time() - start < timeout:
+        time.sleep(0.01)
+
+
+class TestMailer(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.smtp = LocalSMTPServer()
+
+    def tearDown(self):
+        disable_queue(timeout=5)
+        self.smtp.stop()
+        shutil.rmtree(self.spool_dir)
+
+    def test_spool(self):
+        spool = MailSpool(self.spool_dir, max_size=2)
+        first = spool.put('tarek@moz.com', ['a@moz.com'], 'one')
+        spool.put('tarek@moz.com', ['b@moz.com'], 'two')
+        self.assertRaises(SpoolFullError, spool.put, 'x', ['x'], 'x')
+        self.assertEqual(len(spool), 2)
+
+        # another process does not see the messages
+        other = MailSpool(self.spool_dir, max_size=2)
+        self.assertEqual(len(other), 0)
+        other.close()
+
+        # the spool survives a restart and keeps the order
+        spool.close()
+        spool = MailSpool(self.spool_dir, max_size=2)
+        self.assertEqual(spool.keys()[0], first)
+        self.assertEqual(spool.get(first),
+                         ('tarek@moz.com', ['a@moz.com'], 'one'))
+        spool.remove(first)
+        self.assertEqual(len(spool), 1)
+
+        # the messages are taken over only once
+        spool.close()
+        spools = [MailSpool(self.spool_dir) for i in range(2)]
+        self.assertEqual(sorted([len(spool) for spool in spools]), [0, 1])
+        for spool in spools:
+            spool.close()
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+
+    def test_queue(self):
+        queue = MailQueue('127.0.0.1', self.smtp.port,
+                          spool_dir=self.spool_dir)
+        for i in range(5):
+            self.assertEqual(queue.enqueue('tarek@moz.com', ['a@moz.com'],
+                                           'message %d' % i), (True, None))
+
+        # nothing is sent until the worker runs
+        self.assertEqual(self.smtp.msgs, [])
+        queue.start()
+        _wait_for(lambda: len(self.smtp.msgs) == 5)
+        queue.stop(timeout=5)
+
+        self.assertEqual(len(self.smtp.msgs), 5)
+        self.assertEqual(self.smtp.msgs[0][2], 'message 0')
+
+        # all messages went through the same session
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(queue.spool.keys(), [])
+
+    def test_queue_full(self):
+        queue = MailQueue('127.0.0.1', self.smtp.port, max_size=1)
+        self.assertTrue(queue.enqueue('tarek@moz.com', ['a'], 'one')[0])
+        res, msg = queue.enqueue('tarek@moz.com', ['a'], 'two')
+        self.assertFalse(res)
+        self.assertEqual(len(queue), 1)
+
+    def test_queue_recovery(self):
+        # two processes died with spooled messages
+        for i in range(2):
+            spool = MailSpool(self.spool_dir)
+            for j in range(3):
+                spool.put('tarek@moz.com', ['a@moz.com'], 'message')
+            spool._lockfile.close()
+            spool._lockfile = None
+
+        # more messages than the queue can hold are taken over
+        queue = MailQueue('127.0.0.1', self.smtp.port,
+                          spool_dir=self.spool_dir, max_size=4)
+        self.assertEqual(len(queue.spool), 6)
+        self.assertEqual(len(queue), 6)
+
+        queue.start()
+        _wait_for(lambda: len(self.smtp.msgs) == 6)
+        queue.stop(timeout=5)
+        self.assertEqual(len(self.smtp.msgs), 6)
+        self.assertEqual(queue.spool.keys(), [])
+
+    def test_send_email(self):
+        # synchronous by default
+        self.assertTrue(get_queue() is None)
+        send_email('tarek@moz.com', 'a@moz.com', 'Subject', 'Body',
+                   smtp_host='127.0.0.1', smtp_port=self.smtp.port)
+        self.assertEqual(len(self.smtp.msgs), 1)
+
+        # now queued
+        enable_queue(spool_dir=self.spool_dir)
+        res, msg = send_email('tarek@moz.com', 'a@moz.com', 'Subject',
+                              'Body', smtp_host='127.0.0.1',
+                              smtp_port=self.smtp.port)
+        self.assertTrue(res)
+        _wait_for(lambda: len(self.smtp.msgs) == 2)
+        self.assertEqual(len(self.smtp.msgs), 2)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMailer))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
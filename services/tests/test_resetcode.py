@@ -34,7 +34,14 @@
 #
 # ***** END LICENSE BLOCK *****
 import unittest
-from services.auth.resetcode import ResetCodeManager
+import shutil
+import time
+import tempfile
+import os
+
+from services.auth.resetcode import (ResetCodeManager, reset_codes,
+                                     get_storage, MemoryResetCodeStorage,
+                                     main)
 from sqlalchemy import create_engine
 
 
@@ -56,6 +63,119 @@ class TestResetCodeManager(unittest.TestCase):
         mgr.clear_reset_code(1)
         self.assertFalse(mgr.verify_reset_code(1, code2))
 
+    def test_overwrite(self):
+        engine = create_engine('sqlite:///:memory:')
+        mgr = ResetCodeManager(engine, True)
+
+        codes = set([mgr.generate_reset_code(1, True) for i in range(3)])
+        self.assertEqual(len(codes), 3)
+        rows = engine.execute(reset_codes.select()).fetchall()
+        self.assertEqual(len(rows), 1)
+
+    def test_purge(self):
+        engine = create_engine('sqlite:///:memory:')
+        mgr = ResetCodeManager(engine, True)
+
+        past = int(time.time()) - 3600
+        for user_id in range(7):
+            engine.execute(reset_codes.insert().values(username=user_id,
+                                                       reset='X' * 32,
+                                                       expiration=past))
+        code = mgr.generate_reset_code(10)
+
+        self.assertEqual(mgr.purge_expired_reset_codes(batch_size=3), 7)
+        self.assertEqual(mgr.purge_expired_reset_codes(), 0)
+        rows = engine.execute(reset_codes.select()).fetchall()
+        self.assertEqual(len(rows), 1)
+        self.assertTrue(mgr.verify_reset_code(10, code))
+
+    def test_purge_script(self):
+        path = tempfile.mkdtemp()
+        try:
+            sqluri = 'sqlite:///%s' % os.path.join(path, 'auth.db')
+            config = os.path.join(path, 'sync.conf')
+            with open(config, 'w') as f:
+                f.write('[auth]\nbackend = sql\nsqluri = %s\n'
+                        'reset_code_storage = sql\n' % sqluri)
+
+            engine = create_engine(sqluri)
+            reset_codes.create(bind=engine)
+            engine.execute(reset_codes.insert().values(
+                username=1, reset='X' * 32, expiration=int(time.time()) - 1))
+
+            self.assertEqual(main([config, '--pause', '0']), 0)
+            self.assertEqual(engine.execute(reset_codes.count()).scalar(), 0)
+        finally:
+            shutil.rmtree(path)
+
+    def test_expired(self):
+        engine = create_engine('sqlite:///:memory:')
+        mgr = ResetCodeManager(engine, True)
+
+        code = mgr.generate_reset_code(1)
+        row = engine.execute(reset_codes.select()).fetchone()
+        self.assertTrue(isinstance(row.expiration, (int, long)))
+        self.assertTrue(row.expiration > time.time() + 5 * 3600)
+
+        engine.execute(reset_codes.update().values(
+            expiration=int(time.time()) - 1))
+        self.assertFalse(mgr.verify_reset_code(1, code))
+        self.assertNotEqual(mgr.generate_reset_code(1), code)
+
+    def _test_storage(self, storage):
+        mgr = ResetCodeManager(None, storage=storage)
+
+        code = mgr.generate_reset_code(1)
+        self.assertEqual(code, mgr.generate_reset_code(1))
+        code2 = mgr.generate_reset_code(1, True)
+        self.assertNotEqual(code, code2)
+        self.assertFalse(mgr.verify_reset_code(1, code))
+        self.assertTrue(mgr.verify_reset_code(1, code2))
+        self.assertFalse(mgr.verify_reset_code(2, code2))
+
+        self.assertTrue(mgr.clear_reset_code(1))
+        self.assertFalse(mgr.clear_reset_code(1))
+        self.assertFalse(mgr.verify_reset_code(1, code2))
+
+        # expired codes
+        now = int(time.time())
+        storage.set(3, 'XXXX-XXXX-XXXX-XXXX', now - 1)
+        storage.set(4, 'XXXX-XXXX-XXXX-XXXX', now - 1)
+        storage.set(5, 'XXXX-XXXX-XXXX-XXXX', now + 86400)
+        self.assertFalse(mgr.verify_reset_code(3, 'XXXX-XXXX-XXXX-XXXX'))
+        self.assertEqual(mgr.purge_expired_reset_codes(), 1)
+        self.assertTrue(mgr.verify_reset_code(5, 'XXXX-XXXX-XXXX-XXXX'))
+
+    def test_memory_storage(self):
+        self._test_storage(get_storage('memory', resolution=1))
+
+    def test_memory_storage_wheel(self):
+        storage = MemoryResetCodeStorage(resolution=10)
+        now = int(time.time())
+        for user_id in range(100):
+            storage.set(user_id, 'XXXX-XXXX-XXXX-XXXX', now + user_id)
+
+        # going forward in time, the slots that are over are emptied
+        storage._sweep(time.time() + 50)
+        self.assertTrue(40 <= len(storage._codes) <= 60)
+        self.assertTrue(len(storage._wheel) <= 6)
+        storage._sweep(time.time() + 1000)
+        self.assertEqual(len(storage._codes), 0)
+        self.assertEqual(len(storage._wheel), 0)
+
+    def test_file_storage(self):
+        path = tempfile.mkdtemp()
+        try:
+            self._test_storage(get_storage('file', path=path))
+            self.assertEqual(len(os.listdir(path)), 1)
+        finally:
+            shutil.rmtree(path)
+
+    def test_no_storage(self):
+        mgr = ResetCodeManager(None)
+        self.assertRaises(NotImplementedError, mgr.clear_reset_code, 1)
+        self.assertRaises(ValueError, get_storage, 'foo')
+
 
 def test_suite():
     suite = unittest.TestSuite()
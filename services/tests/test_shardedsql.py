@@ -0,0 +1,173 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import tempfile
+import shutil
+import os
+
+from services.util import BackendError
+from services.auth import ServicesAuth, get_auth
+from services.auth.shardedsql import ShardedSQLAuth, user_shards
+from services.auth.sqlmappers import users
+
+ServicesAuth.register(ShardedSQLAuth)
+
+
+class TestShardedSQLAuth(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        shards = [self._uri('shard%d' % i) for i in range(3)]
+        self.auth = ShardedSQLAuth(self._uri('directory'), shards)
+        self.users = [('user%d' % i, 'secret%d' % i, 'user%d@moz.com' % i)
+                      for i in range(10)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _uri(self, name):
+        return 'sqlite:///%s' % os.path.join(self.dir, name + '.db')
+
+    def _count(self, shard):
+        return shard._engine.execute('select count(*) from users').scalar()
+
+    def test_get_auth(self):
+        config = {'auth.backend': 'shardedsql',
+                  'auth.sqluri': self._uri('directory'),
+                  'auth.shards': '%s, %s' % (self._uri('one'),
+                                             self._uri('two'))}
+        auth = get_auth(config)
+        self.assertEqual(len(auth.shards), 2)
+
+    def test_users(self):
+        auth = self.auth
+        for user_name, password, email in self.users:
+            self.assertTrue(auth.create_user(user_name, password, email))
+
+        # the users are spread over the shards
+        counts = [self._count(shard) for shard in auth.shards]
+        self.assertEqual(sum(counts), 10)
+        self.assertTrue(len([count for count in counts if count]) > 1)
+
+        # and have distinct ids
+        ids = [auth.get_user_id(user_name) for user_name, __, __
+               in self.users]
+        self.assertEqual(len(set(ids)), 10)
+
+        user_id = auth.authenticate_user('user1', 'secret1')
+        self.assertEqual(user_id, ids[1])
+        self.assertEqual(auth.authenticate_user('user1', 'xxx'), None)
+
+        # the user id leads to the right shard
+        auth._id_shards.clear()
+        self.assertEqual(auth.get_user_info(user_id),
+                         ('user1', 'user1@moz.com'))
+        self.assertTrue(auth.update_email(user_id, 'new@moz.com'))
+        self.assertEqual(auth.get_user_info(user_id)[1], 'new@moz.com')
+
+        code = auth.generate_reset_code(user_id)
+        self.assertTrue(auth.verify_reset_code(user_id, code))
+        self.assertTrue(auth.update_password(user_id, 'newpass', key=code))
+        self.assertEqual(auth.authenticate_user('user1', 'newpass'), user_id)
+
+        self.assertTrue(auth.delete_user(user_id))
+        self.assertEqual(auth.get_user_id('user1'), None)
+        self.assertEqual(auth.get_user_info(user_id), (None, None))
+        self.assertFalse(auth.delete_user(user_id))
+
+    def test_bulk(self):
+        auth = self.auth
+        res = auth.create_users(self.users, batch_size=2)
+        self.assertEqual(res, [(True, None)] * 10)
+
+        names = [user_name for user_name, __, __ in self.users]
+        ids = auth.get_user_ids(names + ['unknown'])
+        self.assertEqual(ids['unknown'], None)
+        for user_name in names:
+            self.assertEqual(ids[user_name], auth.get_user_id(user_name))
+
+        auth._id_shards.clear()
+        infos = auth.get_user_infos(ids.values())
+        for user_name, __, email in self.users:
+            self.assertEqual(infos[ids[user_name]], (user_name, email))
+        self.assertEqual(infos[None], (None, None))
+
+        user_id = str(ids['user1'])
+        self.assertEqual(auth.get_user_infos([user_id]),
+                         {user_id: ('user1', 'user1@moz.com')})
+
+    def test_metadata(self):
+        # the shards don't bind the shared metadata
+        old = users.metadata.bind
+        users.metadata.bind = self.auth._engine
+        try:
+            ShardedSQLAuth(self._uri('directory'), [self._uri('one')])
+            self.assertTrue(users.metadata.bind is self.auth._engine)
+        finally:
+            users.metadata.bind = old
+        self.assertTrue(user_shards.metadata.bind is None)
+
+    def test_shared_options(self):
+        for name in ('sqluri_read', 'reset_code_storage', 'reset_code_path'):
+            self.assertRaises(ValueError, ShardedSQLAuth,
+                              self._uri('directory'), [self._uri('one')],
+                              **{name: 'value'})
+
+    def test_insert_failure(self):
+        auth = self.auth
+
+        def _insert_users(rows, query):
+            raise BackendError()
+
+        for shard in auth.shards:
+            shard._insert_users = _insert_users
+
+        # the allocated ids are freed
+        self.assertRaises(BackendError, auth.create_user, 'user1', 'secret',
+                          'user1@moz.com')
+        self.assertRaises(BackendError, auth.create_users, self.users)
+        count = 'select count(*) from user_shards'
+        self.assertEqual(auth._engine.execute(count).scalar(), 0)
+        self.assertEqual(len(auth._id_shards), 0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestShardedSQLAuth))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -40,9 +40,13 @@ import datetime
 from sqlalchemy.sql import text
 
 from services.tests.support import initenv
-from services.auth.sql import SQLAuth
-from services.auth import ServicesAuth
-from services.util import ssha, BackendError
+from services.auth.sql import SQLAuth, _create_engine, _USER_AUTH
+from services.auth.sqlmappers import users
+from services.auth import (ServicesAuth, create_users, get_user_ids,
+                           get_user_infos, match_user_names)
+from services.auth.dummy import DummyAuth
+from services.util import ssha, BackendError, get_hasher
+from services.hashpool import enable_pool, disable_pool
 
 ServicesAuth.register(SQLAuth)
 
@@ -108,6 +112,198 @@ class TestSQLAuth(unittest.TestCase):
         self.auth._engine.execute('update users set status=0')
         self.assertEquals(self.auth.authenticate_user('tarek', 'tarek'), None)
 
+    def test_negative_cache(self):
+        auth = SQLAuth('sqlite:///:memory:', negative_cache_size=10)
+        self.assertEqual(auth.get_user_id('bob'), None)
+
+        # bob is created behind our back, we don't see it yet
+        query = text('insert into users (username, password_hash, status) '
+                     'values (:username, :password, 1)')
+        auth._engine.execute(query, username='bob', password=ssha('bob'))
+        self.assertEqual(auth.get_user_id('bob'), None)
+        self.assertEqual(auth.authenticate_user('bob', 'bob'), None)
+
+        # creating a user invalidates the cache
+        auth._engine.execute('delete from users')
+        self.assertTrue(auth.create_user('bob', 'bob', 'bob@moz.com'))
+        self.assertTrue(auth.authenticate_user('bob', 'bob') is not None)
+
+    def test_rehash(self):
+        if self.auth.get_name() != 'sql':
+            # not supported yet
+            return
+
+        def _hash():
+            query = 'select password_hash from users where id = %d'
+            query = query % self.user_id
+            return self.auth._engine.execute(query).fetchone()[0]
+
+        # tarek's password was stored as a SSHA, it's upgraded on login
+        self.assertTrue(_hash().startswith('{SSHA}'))
+        self.assertEqual(self.auth.authenticate_user('tarek', 'tarek'),
+                         self.user_id)
+        self.assertTrue(_hash().startswith('{SSHA-256}'))
+
+        # now switching to a stronger scheme
+        self.auth.hasher = get_hasher('pbkdf2', 100)
+        self.assertEqual(self.auth.authenticate_user('tarek', 'tarek'),
+                         self.user_id)
+        self.assertTrue(_hash().startswith('{PBKDF2-SHA256}100$'))
+        self.assertEqual(self.auth.authenticate_user('tarek', 'tarek'),
+                         self.user_id)
+
+        # no rehash on failures
+        self.auth.hasher = get_hasher('ssha256')
+        self.assertEqual(self.auth.authenticate_user('tarek', 'xxx'), None)
+        self.assertTrue(_hash().startswith('{PBKDF2-SHA256}'))
+
+    def test_hashpool(self):
+        enable_pool(size=1)
+        try:
+            self.assertTrue(self.auth.create_user('pool', 'secret',
+                                                  'pool@moz.com'))
+            user_id = self.auth.authenticate_user('pool', 'secret')
+            self.assertNotEqual(user_id, None)
+            self.assertEqual(self.auth.authenticate_user('pool', 'xxx'),
+                             None)
+        finally:
+            disable_pool()
+
+    def test_compiled_cache(self):
+        if self.auth.get_name() != 'sql':
+            # not supported yet
+            return
+
+        cache = self.auth._engine._execution_options['compiled_cache']
+        self.auth.update_email(self.user_id, 'one@moz.com')
+        self.auth.generate_reset_code(self.user_id)
+        self.auth.clear_reset_code(self.user_id)
+        size = len(cache)
+        self.assertTrue(size > 0)
+
+        # the statements are compiled only once
+        self.auth.update_email(self.user_id, 'two@moz.com')
+        self.auth.generate_reset_code(self.user_id)
+        self.auth.clear_reset_code(self.user_id)
+        self.assertEqual(len(cache), size)
+        self.assertEqual(self.auth.get_user_info(self.user_id)[1],
+                         'two@moz.com')
+
+        # the bulk lookups use a few padded statements
+        for count in range(1, 30):
+            names = ['user%d' % i for i in range(count)]
+            self.auth.get_user_ids(names)
+        size = len(cache)
+        for count in range(1, 30):
+            self.auth.get_user_infos(range(count))
+        self.assertTrue(len(cache) <= size + 6)
+        size = len(cache)
+
+        # the other statements are not kept
+        self.auth._engine.execute(users.select(users.c.id > 1))
+        self.assertEqual(len(cache), size)
+
+    def test_compiled_cache_hits(self):
+        # a cached statement is compiled on its first execution only
+        engine = _create_engine('sqlite:///:memory:', 5, 60)
+        users.create(bind=engine)
+        compiled = []
+        compiler = engine.dialect.statement_compiler
+
+        def _compiler(*args, **kw):
+            compiled.append(args[1])
+            return compiler(*args, **kw)
+
+        engine.dialect.statement_compiler = _compiler
+        for i in range(10):
+            engine.execute(_USER_AUTH, user_name='bob').fetchall()
+        self.assertEqual(compiled, [_USER_AUTH])
+
+    def test_create_users(self):
+        if self.auth.get_name() != 'sql':
+            # not supported yet
+            return
+
+        users_ = [('bulk%d' % i, 'secret%d' % i, 'bulk%d@moz.com' % i)
+                  for i in range(5)]
+        res = self.auth.create_users(users_, batch_size=2)
+        self.assertEqual(res, [(True, None)] * 5)
+        for user_name, password, email in users_:
+            user_id = self.auth.authenticate_user(user_name, password)
+            self.assertNotEqual(user_id, None)
+            self.assertEqual(self.auth.get_user_info(user_id)[1], email)
+
+        # generic version, for backends with no bulk API
+        auth = DummyAuth()
+        res = create_users(auth, [('one', 'one', 'one@moz.com'),
+                                  ('one', 'one', 'one@moz.com')])
+        self.assertEqual(res[0], (True, None))
+        self.assertFalse(res[1][0])
+        self.assertNotEqual(auth.get_user_id('one'), None)
+
+    def test_get_user_ids(self):
+        if self.auth.get_name() != 'sql':
+            # not supported yet
+            return
+
+        users_ = [('bulk%d' % i, 'secret%d' % i, 'bulk%d@moz.com' % i)
+                  for i in range(5)]
+        self.auth.create_users(users_)
+        names = [user_name for user_name, __, __ in users_] + ['unknown']
+        ids = self.auth.get_user_ids(names, batch_size=2)
+        self.assertEqual(ids['unknown'], None)
+        for user_name in names[:-1]:
+            self.assertEqual(ids[user_name],
+                             self.auth.get_user_id(user_name))
+
+        infos = self.auth.get_user_infos([ids['bulk0'], ids['bulk4'], 12345],
+                                         batch_size=2)
+        self.assertEqual(infos[ids['bulk0']], ('bulk0', 'bulk0@moz.com'))
+        self.assertEqual(infos[ids['bulk4']], ('bulk4', 'bulk4@moz.com'))
+        self.assertEqual(infos[12345], (None, None))
+
+        # the ids are returned as they were passed
+        user_id = str(ids['bulk1'])
+        infos = self.auth.get_user_infos([user_id, 'xxx', None])
+        self.assertEqual(infos, {user_id: ('bulk1', 'bulk1@moz.com'),
+                                 'xxx': (None, None), None: (None, None)})
+
+        # generic version, for backends with no bulk API
+        auth = DummyAuth()
+        auth.create_user('one', 'one', 'one@moz.com')
+        ids = get_user_ids(auth, ['one', 'two'])
+        self.assertEqual(ids, {'one': auth.get_user_id('one'), 'two': None})
+        infos = get_user_infos(auth, [ids['one']])
+        self.assertEqual(infos, {ids['one']: (None, None)})
+
+    def test_get_user_ids_case(self):
+        # like MySQL's default collation, the names ignore the case
+        auth = SQLAuth('sqlite:///:memory:', create_tables=False,
+                       negative_cache_size=10)
+        auth._engine.execute('create table users (id integer primary key, '
+                             'username varchar(32) collate nocase, '
+                             'password_hash varchar(128), '
+                             'email varchar(64), status integer, '
+                             'alert text, reset varchar(32), '
+                             'reset_expiration datetime)')
+        auth.create_user('bob', 'secret', 'bob@moz.com')
+        user_id = auth.get_user_id('bob')
+
+        ids = auth.get_user_ids(['Bob', 'BOB', 'alice'])
+        self.assertEqual(ids, {'Bob': user_id, 'BOB': user_id,
+                               'alice': None})
+
+        # the names that were found are not cached as unknown
+        self.assertEqual(auth.authenticate_user('Bob', 'secret'), user_id)
+        self.assertTrue(auth._is_unknown('alice'))
+
+    def test_match_user_names(self):
+        found = [('bob', 1), ('Bob', 2), ('alice', 3)]
+        self.assertEqual(match_user_names(['bob', 'Bob', 'BOB', 'Alice',
+                                           'carol'], found),
+                         {'bob': 1, 'Bob': 2, 'BOB': 1, 'Alice': 3,
+                          'carol': None})
+
     def test_no_create(self):
         # testing the create_tables option
         testsdir = os.path.dirname(__file__)
@@ -118,6 +314,39 @@ class TestSQLAuth(unittest.TestCase):
         self.assertRaises(BackendError, auth.authenticate_user,
                           'tarek', 'tarek')
 
+    def test_purge_reset_codes(self):
+        auth = SQLAuth('sqlite:///:memory:')
+        ids = []
+        for i in range(7):
+            auth.create_user('user%d' % i, 'x', 'user%d@moz.com' % i)
+            ids.append(auth.get_user_id('user%d' % i))
+            auth.generate_reset_code(ids[-1])
+
+        past = datetime.datetime.now() - datetime.timedelta(hours=1)
+        query = text('update users set reset_expiration = :expiration '
+                     'where id != :user_id')
+        auth._engine.execute(query, expiration=past, user_id=ids[3])
+
+        self.assertEqual(auth.purge_expired_reset_codes(batch_size=2), 6)
+        self.assertEqual(auth.purge_expired_reset_codes(), 0)
+        rows = auth._engine.execute('select id from users '
+                                    'where reset is not null').fetchall()
+        self.assertEqual([row.id for row in rows], [ids[3]])
+
+    def test_reset_code_storage(self):
+        auth = SQLAuth('sqlite:///:memory:', reset_code_storage='memory')
+        auth.create_user('bob', 'bob', 'bob@moz.com')
+        user_id = auth.get_user_id('bob')
+
+        code = auth.generate_reset_code(user_id)
+        self.assertTrue(auth.verify_reset_code(user_id, code))
+        row = auth._engine.execute('select reset from users').fetchone()
+        self.assertEqual(row.reset, None)
+
+        self.assertTrue(auth.update_password(user_id, 'new', key=code))
+        self.assertFalse(auth.verify_reset_code(user_id, code))
+        self.assertTrue(auth.authenticate_user('bob', 'new') is not None)
+
 
 def test_suite():
     suite = unittest.TestSuite()
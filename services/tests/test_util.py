@@ -42,6 +42,12 @@ import urllib2
 import socket
 import StringIO
 import sys
+import logging
+import smtplib
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import select, text
 
 from services.util import (convert_config, bigint2time,
                            time2bigint, valid_email, batch,
@@ -49,7 +55,28 @@ from services.util import (convert_config, bigint2time,
                            valid_password, json_response,
                            newlines_response, whoisi_response, text_response,
                            extract_username, get_url, proxy,
-                           get_source_ip, CatchErrorMiddleware, round_time)
+                           get_source_ip, CatchErrorMiddleware, round_time,
+                           send_emails, LRUCache, extract_usernames,
+                           get_hasher, randchar, generate_reset_code,
+                           check_reset_code, _RandomSource, QueryStats,
+                           safe_execute, get_query_stats, set_retry_policy,
+                           BackendError)
+from services.tests.support import LocalSMTPServer
+from services import util
+
+
+class _FlakyEngine(object):
+    """Fails the first queries with an OperationalError"""
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+        self.engine = create_engine('sqlite:///:memory:')
+
+    def execute(self, *args, **kw):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise OperationalError('query', {}, Exception('gone away'))
+        return self.engine.execute(*args, **kw)
 
 
 _EXTRA = """\
@@ -169,6 +196,21 @@ class TestUtil(unittest.TestCase):
         two = ssha256('two')
         self.assertTrue(validate_password('one', one))
         self.assertTrue(validate_password('two', two))
+        self.assertFalse(validate_password('two', one))
+
+        # hashes with no prefix are Salted-SHA
+        self.assertTrue(validate_password('one', one[len('{SSHA}'):]))
+
+        # stronger scheme
+        hasher = get_hasher('pbkdf2', cost=100)
+        three = hasher.encode('three')
+        self.assertTrue(three.startswith('{PBKDF2-SHA256}100$'))
+        self.assertTrue(validate_password('three', three))
+        self.assertFalse(validate_password('four', three))
+        self.assertFalse(hasher.needs_rehash(three))
+        self.assertTrue(hasher.needs_rehash(one))
+        self.assertTrue(get_hasher('pbkdf2', cost=200).needs_rehash(three))
+        self.assertRaises(ValueError, get_hasher, 'rot13')
 
     def test_valid_password(self):
         self.assertFalse(valid_password('tarek', 'xx'))
@@ -208,6 +250,18 @@ class TestUtil(unittest.TestCase):
         self.assertRaises(UnicodeError, extract_username,
                           'bo%ef%bb%bc@badbidiuser.test')      # invalid BIDI
 
+        # errors are not memoized
+        self.assertRaises(UnicodeError, extract_username,
+                          'bo%ef%bb%bc@badbidiuser.test')
+
+        # bulk version
+        res = list(extract_usernames(['username', 'test@test.com',
+                                      'bo%EF%bb@badcharacter.test']))
+        self.assertEquals(res[0], ('username', 'username'))
+        self.assertEquals(res[1], ('test@test.com',
+                                   'u2wqblarhim5su7pxemcbwdyryrghmuk'))
+        self.assertEquals(res[2], ('bo%EF%bb@badcharacter.test', None))
+
     def test_get_url(self):
 
         # malformed url
@@ -332,3 +386,196 @@ class TestUtil(unittest.TestCase):
         # changing the precision
         res = round_time(129084.198271987, precision=3)
         self.assertEqual(str(res), '129084.198')
+
+    def test_send_emails(self):
+        smtp = LocalSMTPServer()
+        try:
+            messages = [('tarek@moz.com', 'user%d@moz.com' % i, 'Alert',
+                         u'Body %d' % i) for i in range(10)]
+            res = send_emails(messages, smtp_host='127.0.0.1',
+                              smtp_port=smtp.port, pool_size=2)
+            self.assertEqual(res, [(True, None)] * 10)
+            self.assertEqual(len(smtp.msgs), 10)
+
+            # the sessions were reused
+            self.assertTrue(smtp.connections <= 2)
+
+            # throttling
+            start = time.time()
+            send_emails(messages[:5], smtp_host='127.0.0.1',
+                        smtp_port=smtp.port, max_rate=20)
+            self.assertTrue(time.time() - start >= 0.15)
+        finally:
+            smtp.stop()
+
+        # errors are reported per message
+        res = send_emails(messages[:2], smtp_host='127.0.0.1',
+                          smtp_port=smtp.port)
+        self.assertEqual(len(res), 2)
+        for success, error in res:
+            self.assertFalse(success)
+            self.assertTrue(error is not None)
+
+    def test_send_emails_errors(self):
+        sessions = []
+
+        class _Connection(object):
+            def __init__(self, *args):
+                self.closed = 0
+                sessions.append(self)
+
+            def sendmail(self, sender, rcpts, msg):
+                if rcpts[0] == 'refused@moz.com':
+                    raise smtplib.SMTPRecipientsRefused({})
+                if rcpts[0] == 'broken@moz.com':
+                    raise ValueError('broken')
+
+            def close(self):
+                self.closed += 1
+
+        old = util.SMTPConnection
+        util.SMTPConnection = _Connection
+        try:
+            messages = [('tarek@moz.com', rcpt, 'Alert', u'Body')
+                        for rcpt in ('refused@moz.com', 'user@moz.com',
+                                     'broken@moz.com', 'user2@moz.com')]
+            messages.insert(1, ('tarek@moz.com', 'malformed@moz.com'))
+            res = send_emails(messages, pool_size=1)
+        finally:
+            util.SMTPConnection = old
+
+        # every message gets a result
+        self.assertEqual([success for success, __ in res],
+                         [False, False, True, False, True])
+        self.assertEqual(res[3][1], 'broken')
+
+        # the refused recipient did not end the session, the other error did
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions[0].closed, 2)
+
+    def test_lru_cache(self):
+        cache = LRUCache(size=2)
+        cache.set('one', 1)
+        cache.set('two', 2)
+        self.assertEqual(cache.get('one'), 1)
+
+        # 'two' is the least recently used key
+        cache.set('three', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('two' in cache)
+        self.assertTrue('one' in cache)
+
+        self.assertTrue(cache.delete('one'))
+        self.assertFalse(cache.delete('one'))
+        self.assertEqual(cache.get('one', 'default'), 'default')
+
+        # expiration
+        cache = LRUCache(size=2, ttl=-1)
+        cache.set('one', 1)
+        self.assertEqual(cache.get('one'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_random_source(self):
+        source = _RandomSource(block_size=16)
+        chars = source.sample('abc', 300)
+        self.assertEqual(len(chars), 300)
+        self.assertEqual(set(chars), set('abc'))
+
+        self.assertTrue(randchar('xyz') in 'xyz')
+        for i in range(10):
+            code, expiration = generate_reset_code()
+            self.assertTrue(check_reset_code(code))
+
+    def test_random_source_fork(self):
+        source = _RandomSource()
+        source.sample('abc')    # filling the buffer
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write, source.sample('abcdef', 32))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        try:
+            # the child process did not reuse the parent's buffer
+            self.assertNotEqual(os.read(read, 32),
+                                source.sample('abcdef', 32))
+        finally:
+            os.close(read)
+            os.close(write)
+
+    def test_query_stats(self):
+        stats = QueryStats(max_statements=2)
+        stats.record('select 1', None, 0.002)
+        stats.record('select 1', None, 10.)
+        stats.record('select 2', {'a': 1}, 0.0001)
+        stats.record('select 3', [{'a': 1}, {'a': 2}], 0.0001)
+        stats.record('select 4', None, 0.0001)
+
+        res = stats.snapshot()
+        self.assertEqual(sorted(res.keys()),
+                         ['other', 'select 1', 'select 2'])
+        self.assertEqual(res['other']['count'], 2)
+        select1 = res['select 1']
+        self.assertEqual(select1['count'], 2)
+        self.assertEqual(select1['max_ms'], 10000.)
+        self.assertEqual(select1['histogram'][1], (5., 1))
+        self.assertEqual(select1['histogram'][-1], (None, 1))
+
+        # slow queries are logged, without the parameters values
+        logs = StringIO.StringIO()
+        handler = logging.StreamHandler(logs)
+        logger = logging.getLogger('syncserver')
+        logger.addHandler(handler)
+        try:
+            stats.slow_query_threshold = 1.
+            stats.record('select 5', {'password': 'secret'}, 0.5)
+            stats.record('select 6', {'password': 'secret'}, 1.5)
+        finally:
+            logger.removeHandler(handler)
+
+        logs = logs.getvalue()
+        self.assertFalse('select 5' in logs)
+        self.assertTrue('select 6' in logs)
+        self.assertTrue("['password']" in logs)
+        self.assertFalse('secret' in logs)
+
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {})
+
+    def test_safe_execute_stats(self):
+        engine = create_engine('sqlite:///:memory:')
+        safe_execute(engine, 'select 1 + 41')
+        self.assertTrue(get_query_stats()['select 1 + 41']['count'] >= 1)
+
+    def test_safe_execute_retries(self):
+        set_retry_policy(retries=2, backoff=0.001)
+        try:
+            # reads are retried
+            engine = _FlakyEngine(failures=2)
+            res = safe_execute(engine, select([text('42')]))
+            self.assertEqual(res.fetchone()[0], 42)
+            self.assertEqual(engine.calls, 3)
+
+            engine = _FlakyEngine(failures=1)
+            res = safe_execute(engine, 'SELECT 42')
+            self.assertEqual(res.fetchone()[0], 42)
+
+            # but not too much
+            engine = _FlakyEngine(failures=3)
+            self.assertRaises(BackendError, safe_execute, engine,
+                              'select 42')
+            self.assertEqual(engine.calls, 3)
+
+            # writes are not retried
+            engine = _FlakyEngine(failures=1)
+            self.assertRaises(BackendError, safe_execute, engine,
+                              'create table one (id integer)')
+            self.assertEqual(engine.calls, 1)
+
+            # retries can be disabled
+            set_retry_policy(retries=0)
+            engine = _FlakyEngine(failures=1)
+            self.assertRaises(BackendError, safe_execute, engine,
+                              'select 42')
+        finally:
+            set_retry_policy()
@@ -35,10 +35,13 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import base64
-from webob.exc import HTTPUnauthorized
+import tempfile
+import os
+from webob.exc import HTTPUnauthorized, HTTPServiceUnavailable
 
-from services.wsgiauth import Authentication
+from services.wsgiauth import Authentication, FailureTracker
 from services.auth.dummy import DummyAuth
+from services.cef import _close_writers
 
 
 class Request(object):
@@ -50,8 +53,11 @@ class Request(object):
 
 class AuthTool(DummyAuth):
 
+    calls = 0
+
     def authenticate_user(self, *args):
-        if args[0] == 'tarekbad':
+        AuthTool.calls += 1
+        if args[0].startswith('tarekbad'):
             return None
         return 1
 
@@ -99,3 +105,107 @@ class AuthenticationTestCase(unittest.TestCase):
                            'cef.product': 'test',
                            'cef.file': 'test',
                             }, 'tarekbad')
+
+    def test_throttling(self):
+        fd, cef_file = tempfile.mkstemp()
+        os.close(fd)
+        config = {'auth.backend': 'services.tests.test_wsgiauth.AuthTool',
+                  'auth_throttle.use': True,
+                  'auth_throttle.max_user_failures': 2,
+                  'auth_throttle.max_ip_failures': 4,
+                  'cef.version': '0.0', 'cef.vendor': 'test',
+                  'cef.device_version': '0.0', 'cef.product': 'test',
+                  'cef.file': cef_file}
+        auth = Authentication(config)
+
+        def _auth(user_name, password='tarek', forwarded=None):
+            token = base64.b64encode('%s:%s' % (user_name, password))
+            environ = {'HTTP_AUTHORIZATION': 'Basic ' + token,
+                       'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                       'REMOTE_ADDR': '10.0.0.1'}
+            if forwarded is not None:
+                environ['HTTP_X_FORWARDED_FOR'] = forwarded
+            return auth.authenticate_user(Request('/', environ), config)
+
+        try:
+            for i in range(2):
+                self.assertRaises(HTTPUnauthorized, _auth, 'tarekbad')
+
+            # the backend is not called anymore for this user
+            calls = AuthTool.calls
+            self.assertRaises(HTTPUnauthorized, _auth, 'tarekbad')
+            self.assertEqual(AuthTool.calls, calls)
+
+            # other users are fine
+            self.assertEqual(_auth('tarek'), 1)
+
+            # until the IP reaches its own limit, X-Forwarded-For
+            # can't be used to escape it
+            self.assertRaises(HTTPUnauthorized, _auth, 'tarekbad0',
+                              forwarded='1.2.3.4')
+            self.assertRaises(HTTPUnauthorized, _auth, 'tarekbad1',
+                              forwarded='1.2.3.5')
+            self.assertRaises(HTTPServiceUnavailable, _auth, 'tarek',
+                              forwarded='1.2.3.6')
+            self.assertEqual(auth.ip_failures.count('10.0.0.1'), 4)
+
+            # the failures share a signature, whatever the user name
+            _close_writers()
+            with open(cef_file) as f:
+                lines = [line for line in f
+                         if 'Authentication Failed' in line]
+            self.assertEqual(len(lines), 4)
+            for line in lines:
+                self.assertTrue('|AuthFail|' in line)
+        finally:
+            os.remove(cef_file)
+
+    def test_client_ip(self):
+        config = {'auth.backend': 'services.tests.test_wsgiauth.AuthTool',
+                  'auth_throttle.use': True,
+                  'auth_throttle.trusted_proxies': '10.0.0.1, 10.0.0.2'}
+        auth = Authentication(config)
+
+        def _ip(remote, forwarded=None):
+            environ = {'REMOTE_ADDR': remote}
+            if forwarded is not None:
+                environ['HTTP_X_FORWARDED_FOR'] = forwarded
+            return auth._client_ip(environ)
+
+        self.assertEqual(_ip('1.2.3.4', '5.6.7.8'), '1.2.3.4')
+        self.assertEqual(_ip('10.0.0.1'), '10.0.0.1')
+        self.assertEqual(_ip('10.0.0.1', '5.6.7.8'), '5.6.7.8')
+        # the client can't choose the left-most entries
+        self.assertEqual(_ip('10.0.0.1', '9.9.9.9, 5.6.7.8, 10.0.0.2'),
+                         '5.6.7.8')
+
+    def test_failure_tracker(self):
+        tracker = FailureTracker(window=300)
+        for i in range(3):
+            tracker.add('tarek')
+        self.assertEqual(tracker.count('tarek'), 3)
+        self.assertEqual(tracker.count('bob'), 0)
+
+        # failures of the previous period count partially
+        tracker._counters['tarek'][0] -= 1
+        self.assertTrue(0 < tracker.count('tarek') <= 3)
+
+        # old entries are swept
+        tracker._counters['tarek'][0] -= 1
+        self.assertEqual(tracker.count('tarek'), 0)
+        tracker.sweep_interval = 0
+        tracker.add('bob')
+        self.assertEqual(len(tracker), 1)
+
+        tracker.reset('bob')
+        self.assertEqual(tracker.count('bob'), 0)
+
+        # the number of keys is capped
+        tracker = FailureTracker(window=300, max_keys=2)
+        for key in ('one', 'two', 'three'):
+            tracker.add(key)
+        self.assertEqual(len(tracker), 2)
+        self.assertEqual(tracker.count('three'), 0)
+        tracker.add('one')
+        self.assertEqual(tracker.count('one'), 2)
+
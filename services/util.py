@@ -39,8 +39,11 @@ Various utilities
 import traceback
 import random
 import string
+import hashlib
+import hmac
 from hashlib import sha256, sha1
 import base64
+import binascii
 import simplejson as json
 import itertools
 import struct
@@ -52,6 +55,8 @@ import re
 import datetime
 import os
 import logging
+import threading
+import Queue
 import urllib2
 from urlparse import urlparse, urlunparse
 from decimal import Decimal, InvalidOperation
@@ -61,8 +66,10 @@ from webob.exc import HTTPBadRequest
 from webob import Response
 
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.expression import Select
 
-from services.config import Config, convert
+from services.config import Config, convert, load_config_map
+from services.mailer import get_queue, SMTPConnection
 from services import logger
 
 
@@ -70,19 +77,57 @@ random.seed()
 _RE_CODE = re.compile('[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}')
 
 
-def randchar(chars=string.digits + string.letters):
-    """Generates a random char using urandom.
+class _RandomSource(object):
+    """Secure random characters, read from urandom by blocks.
 
-    If the system does not support it, the function fallbacks on random.choice
+    The characters are picked by rejection sampling so they are evenly
+    distributed. The buffer is dropped after a fork so the processes
+    don't share the same random bytes.
 
-    See Haypo's explanation on the used formula to pick a char:
-    http://bitbucket.org/haypo/hasard/src/tip/doc/common_errors.rst
+    If the system does not support urandom, fallbacks on random.choice.
     """
-    try:
-        pos = int(float(ord(os.urandom(1))) * 256. / 255.)
-        return chars[pos % len(chars)]
-    except NotImplementedError:
-        return random.choice(chars)
+    def __init__(self, block_size=1024):
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._pos = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _fill(self):
+        self._buffer = bytearray(os.urandom(self.block_size))
+        self._pos = 0
+        self._pid = os.getpid()
+
+    def sample(self, chars, size=1):
+        """Returns a string of size random chars picked in chars"""
+        num = len(chars)
+        limit = 256 - 256 % num
+        res = []
+        try:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._fill()
+                while len(res) < size:
+                    if self._pos == len(self._buffer):
+                        self._fill()
+                    byte = self._buffer[self._pos]
+                    self._pos += 1
+                    if byte < limit:
+                        res.append(chars[byte % num])
+        except NotImplementedError:
+            res.extend([random.choice(chars)
+                        for i in range(size - len(res))])
+        return ''.join(res)
+
+
+_RANDOM = _RandomSource()
+_CHARS = string.digits + string.letters
+_CODE_CHARS = string.ascii_uppercase + string.digits
+
+
+def randchar(chars=_CHARS):
+    """Generates a random char using urandom."""
+    return _RANDOM.sample(chars)
 
 
 def text_response(data, **kw):
@@ -183,46 +228,205 @@ def round_time(value=None, precision=2):
 _SALT_LEN = 8
 
 
-def _gensalt():
+def _gensalt(size=_SALT_LEN):
     """Generates a salt"""
-    return ''.join([randchar() for i in range(_SALT_LEN)])
+    return _RANDOM.sample(_CHARS, size)
+
+
+def _constant_time_compare(one, two):
+    """Compares two strings in a time that only depends on their length"""
+    if len(one) != len(two):
+        return False
+    result = 0
+    for char1, char2 in zip(one, two):
+        result |= ord(char1) ^ ord(char2)
+    return result == 0
+
+
+def _pbkdf2(password, salt, rounds, size=32):
+    """PBKDF2-HMAC-SHA256 key derivation"""
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, rounds, size)
+
+    # Python < 2.7.8
+    mac = hmac.new(password, None, sha256)
+
+    def _prf(data):
+        prf = mac.copy()
+        prf.update(data)
+        return prf.digest()
+
+    key = ''
+    block = 1
+    while len(key) < size:
+        digest = _prf(salt + struct.pack('>I', block))
+        result = int(binascii.hexlify(digest), 16)
+        for i in xrange(rounds - 1):
+            digest = _prf(digest)
+            result ^= int(binascii.hexlify(digest), 16)
+        key += binascii.unhexlify('%064x' % result)
+        block += 1
+    return key[:size]
+
+
+class SSHAHasher(object):
+    """Salted SHA1 password hashes, as used by LDAP"""
+    prefix = '{SSHA}'
+    hashfunc = staticmethod(sha1)
+
+    def __init__(self, cost=None):
+        self.digest_size = self.hashfunc().digest_size
+
+    def encode(self, password, salt=None):
+        """Returns the hash of the password"""
+        if salt is None:
+            salt = _gensalt()
+        hashed = self.hashfunc(password + salt).digest()
+        return '%s%s' % (self.prefix, base64.b64encode(hashed + salt))
+
+    def verify(self, password, hashed):
+        """Checks a password against a hash"""
+        try:
+            raw = base64.b64decode(hashed[len(self.prefix):])
+        except (TypeError, binascii.Error):
+            return False
+        digest, salt = raw[:self.digest_size], raw[self.digest_size:]
+        return _constant_time_compare(self.hashfunc(password + salt).digest(),
+                                      digest)
+
+    def needs_rehash(self, hashed):
+        """Returns True if the hash was not produced with these settings"""
+        return not hashed.startswith(self.prefix)
+
+
+class SSHA256Hasher(SSHAHasher):
+    """Salted SHA256 password hashes"""
+    prefix = '{SSHA-256}'
+    hashfunc = staticmethod(sha256)
+
+
+class PBKDF2Hasher(object):
+    """PBKDF2-HMAC-SHA256 password hashes.
+
+    The cost is the number of rounds. It is stored in the hash, so
+    raising it does not invalidate the existing hashes.
+    """
+    prefix = '{PBKDF2-SHA256}'
+
+    def __init__(self, cost=10000):
+        self.cost = int(cost or 10000)
+
+    def encode(self, password, salt=None, cost=None):
+        """Returns the hash of the password"""
+        if isinstance(password, unicode):
+            password = password.encode('utf8')
+        if salt is None:
+            salt = _gensalt(16)
+        if cost is None:
+            cost = self.cost
+        key = _pbkdf2(password, salt, cost)
+        return '%s%d$%s$%s' % (self.prefix, cost, base64.b64encode(salt),
+                               base64.b64encode(key))
+
+    def _parse(self, hashed):
+        cost, salt, key = hashed[len(self.prefix):].split('$')
+        return int(cost), base64.b64decode(salt), base64.b64decode(key)
+
+    def verify(self, password, hashed):
+        """Checks a password against a hash"""
+        if isinstance(password, unicode):
+            password = password.encode('utf8')
+        try:
+            cost, salt, key = self._parse(hashed)
+        except (ValueError, TypeError, binascii.Error):
+            return False
+        return _constant_time_compare(_pbkdf2(password, salt, cost,
+                                              len(key)), key)
+
+    def needs_rehash(self, hashed):
+        """Returns True if the hash was not produced with these settings"""
+        if not hashed.startswith(self.prefix):
+            return True
+        try:
+            return self._parse(hashed)[0] != self.cost
+        except (ValueError, TypeError, binascii.Error):
+            return True
+
+
+# scheme name -> hasher class
+_HASHERS = {}
+
+# hash prefix -> hasher used to verify the hashes
+_VERIFIERS = {}
+
+
+def register_hasher(name, klass):
+    """Registers a password hashing scheme.
+
+    The class must have a "prefix" attribute, and provide "encode",
+    "verify" and "needs_rehash" methods. Its constructor receives the cost.
+    """
+    _HASHERS[name] = klass
+    _VERIFIERS[klass.prefix] = klass()
+
+
+def get_hasher(scheme='ssha256', cost=None):
+    """Returns a hasher for the scheme."""
+    try:
+        klass = _HASHERS[scheme]
+    except KeyError:
+        raise ValueError('Unknown password scheme %r' % scheme)
+    return klass(cost)
+
+
+register_hasher('ssha', SSHAHasher)
+register_hasher('ssha256', SSHA256Hasher)
+register_hasher('pbkdf2', PBKDF2Hasher)
 
 
 def ssha(password, salt=None):
     """Returns a Salted-SHA password"""
-    if salt is None:
-        salt = _gensalt()
-    ssha = base64.b64encode(sha1(password + salt).digest()
-                               + salt).strip()
-    return "{SSHA}%s" % ssha
+    return _VERIFIERS[SSHAHasher.prefix].encode(password, salt)
 
 
 def ssha256(password, salt=None):
     """Returns a Salted-SHA256 password"""
-    if salt is None:
-        salt = _gensalt()
-    ssha = base64.b64encode(sha256(password + salt).digest()
-                               + salt).strip()
-    return "{SSHA-256}%s" % ssha
+    return _VERIFIERS[SSHA256Hasher.prefix].encode(password, salt)
 
 
 def validate_password(clear, hash):
-    """Validates a Salted-SHA(256) password"""
-    if hash.startswith('{SSHA-256}'):
-        real_hash = hash.split('{SSHA-256}')[-1]
-        hash_meth = ssha256
-    else:
-        real_hash = hash.split('{SSHA}')[-1]
-        hash_meth = ssha
+    """Validates a password against a hash.
+
+    The hashing scheme is picked from the hash prefix. Hashes with no
+    known prefix are considered as Salted-SHA.
+    """
+    verifier = None
+    if hash.startswith('{'):
+        verifier = _VERIFIERS.get(hash[:hash.find('}') + 1])
+
+    if verifier is None:
+        verifier = _VERIFIERS[SSHAHasher.prefix]
+        hash = SSHAHasher.prefix + hash
 
-    salt = base64.decodestring(real_hash)[-_SALT_LEN:]
-    password = hash_meth(clear, salt)
-    return password == hash
+    return verifier.verify(clear, hash)
+
+
+def _build_message(sender, rcpt, subject, body):
+    """Prepares a text/plain message"""
+    msg = MIMEText(body.encode('utf8'), 'plain', 'utf8')
+    msg['From'] = Header(sender, 'utf8')
+    msg['To'] = Header(rcpt, 'utf8')
+    msg['Subject'] = Header(subject, 'utf8')
+    return msg
 
 
 def send_email(sender, rcpt, subject, body, smtp_host='localhost',
                smtp_port=25, smtp_user=None, smtp_password=None):
-    """Sends a text/plain email synchronously.
+    """Sends a text/plain email.
+
+    The email is sent synchronously, unless the mail queue is enabled.
+    In that case it is queued and sent by a background worker. See
+    services.mailer.
 
     Args:
         sender: sender address - unicode + utf8
@@ -237,11 +441,11 @@ def send_email(sender, rcpt, subject, body, smtp_host='localhost',
     Returns:
         tuple: (True or False, Error Message)
     """
-    # preparing the message
-    msg = MIMEText(body.encode('utf8'), 'plain', 'utf8')
-    msg['From'] = Header(sender, 'utf8')
-    msg['To'] = Header(rcpt, 'utf8')
-    msg['Subject'] = Header(subject, 'utf8')
+    msg = _build_message(sender, rcpt, subject, body)
+
+    queue = get_queue(smtp_host, smtp_port, smtp_user, smtp_password)
+    if queue is not None:
+        return queue.enqueue(sender, [rcpt], msg.as_string())
 
     try:
         server = smtplib.SMTP(smtp_host, smtp_port, timeout=5)
@@ -266,6 +470,106 @@ def send_email(sender, rcpt, subject, body, smtp_host='localhost',
     return True, None
 
 
+class _Throttle(object):
+    """Spaces out calls to wait() to respect a maximum rate per second"""
+    def __init__(self, rate=None):
+        self.interval = rate and 1. / rate or 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# errors after which smtplib resets the session, which can be reused
+_MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                   smtplib.SMTPDataError)
+
+
+def send_emails(messages, smtp_host='localhost', smtp_port=25,
+                smtp_user=None, smtp_password=None, pool_size=2,
+                max_rate=None, max_per_session=100):
+    """Sends text/plain emails in bulk.
+
+    The emails are sent over a small pool of SMTP sessions that are reused
+    from one message to the other.
+
+    Args:
+        messages: iterable of (sender, rcpt, subject, body) tuples
+        smtp_host: smtp server -- defaults to localhost
+        smtp_port: smtp port -- defaults to 25
+        smtp_user: smtp user if the smtp server requires it
+        smtp_password: smtp password if the smtp server requires it
+        pool_size: number of SMTP sessions used in parallel
+        max_rate: maximum number of emails sent per second. No limit if None
+        max_per_session: number of emails after which a session is renewed
+
+    Returns:
+        list of (True or False, Error Message) tuples, in the messages order
+    """
+    todo = Queue.Queue()
+    size = 0
+    for index, message in enumerate(messages):
+        todo.put((index, message))
+        size += 1
+
+    results = [None] * size
+    throttle = _Throttle(max_rate)
+
+    def _sender():
+        conn = SMTPConnection(smtp_host, smtp_port, smtp_user, smtp_password)
+        sent = 0
+        try:
+            while True:
+                try:
+                    index, message = todo.get_nowait()
+                except Queue.Empty:
+                    return
+
+                # a malformed message is only an error for itself
+                try:
+                    sender, rcpt, subject, body = message
+                    msg = _build_message(sender, rcpt, subject, body)
+                except Exception, e:
+                    results[index] = False, str(e)
+                    continue
+
+                if sent == max_per_session:
+                    conn.close()
+                    sent = 0
+
+                try:
+                    throttle.wait()
+                    conn.sendmail(sender, [rcpt], msg.as_string())
+                except _MESSAGE_ERRORS, e:
+                    results[index] = False, str(e)
+                except Exception, e:
+                    results[index] = False, str(e)
+                    conn.close()
+                    sent = 0
+                else:
+                    results[index] = True, None
+                    sent += 1
+        finally:
+            conn.close()
+
+    senders = [threading.Thread(target=_sender)
+               for i in range(min(int(pool_size), size))]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+
+    return results
+
+
 _USER = '(([^<>()[\]\\.,;:\s@\"]+(\.[^<>()[\]\\.,;:\s@\"]+)*)|(\".+\"))'
 _IP_DOMAIN = '([0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})'
 _NAME_DOMAIN = '(([a-zA-Z\-0-9]+\.)+[a-zA-Z]{2,})'
@@ -301,13 +605,20 @@ def valid_password(user_name, password):
     return user_name.lower().strip() != password.lower().strip()
 
 
-def convert_config(config):
+def convert_config(config, files=None):
     """Loads the configuration.
 
     If a "configuration" option is found, reads it using config.Config.
     Each section/option is then converted to "section.option" in the resulting
     mapping.
+
+    If a "config_cache_dir" option is found, the configuration is loaded
+    from a snapshot in this directory when it's up-to-date. See
+    config.load_config_map.
+
+    If "files" is a list, the names of the files read are appended to it.
     """
+    cache_dir = config.get('config_cache_dir')
     res = {}
     for key, value in config.items():
         if not isinstance(value, basestring) or not value.startswith('file:'):
@@ -319,8 +630,7 @@ def convert_config(config):
             raise ValueError('The configuration file was not found. "%s"' % \
                             filename)
 
-        conf = Config(filename)
-        res.update(conf.get_map())
+        res.update(load_config_map(filename, cache_dir, files))
 
     return res
 
@@ -350,6 +660,103 @@ def batch(iterable, size=100):
         yield group
 
 
+_MISSING = object()
+
+
+class LRUCache(object):
+    """Thread-safe mapping that keeps the `size` most recently used keys.
+
+    If `ttl` is given, entries expire after `ttl` seconds.
+    """
+    def __init__(self, size=1000, ttl=None):
+        self.size = int(size)
+        self.ttl = ttl and float(ttl) or None
+        self._map = {}
+        # circular doubly linked list of [prev, next, key, value, expires]
+        # links. The oldest entry comes right after the root.
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def _unlink(self, link):
+        prev, next_ = link[0], link[1]
+        prev[1] = next_
+        next_[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def get(self, key, default=None):
+        """Returns the value for key, or default if missing or expired."""
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                return default
+
+            self._unlink(link)
+            if link[4] is not None and link[4] < time.time():
+                del self._map[key]
+                return default
+
+            self._append(link)
+            return link[3]
+
+    def set(self, key, value):
+        """Sets a value, evicting the least recently used key if needed."""
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        else:
+            expires = None
+
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3], link[4] = value, expires
+            else:
+                if len(self._map) >= self.size:
+                    oldest = self._root[1]
+                    self._unlink(oldest)
+                    del self._map[oldest[2]]
+                link = [None, None, key, value, expires]
+                self._map[key] = link
+            self._append(link)
+
+    def delete(self, key):
+        """Removes a key. Returns True if it was present."""
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is None:
+                return False
+            self._unlink(link)
+            return True
+
+    def clear(self):
+        """Removes all keys."""
+        with self._lock:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None]
+
+
 class BackendError(Exception):
     """Raised when the backend is down or fails"""
     pass
@@ -360,19 +767,20 @@ class BackendTimeoutError(BackendError):
     pass
 
 
+# lifetime of the reset codes, in seconds
+RESET_CODE_TTL = 6 * 3600
+
+
 def generate_reset_code():
     """Generates a reset code
 
     Returns:
         reset code, expiration date
     """
-    chars = string.ascii_uppercase + string.digits
-
-    def _4chars():
-        return ''.join([randchar(chars) for i in range(4)])
-
-    code = '-'.join([_4chars() for i in range(4)])
-    expiration = datetime.datetime.now() + datetime.timedelta(hours=6)
+    chars = _RANDOM.sample(_CODE_CHARS, 16)
+    code = '-'.join([chars[i:i + 4] for i in range(0, 16, 4)])
+    expiration = datetime.datetime.now() + \
+            datetime.timedelta(seconds=RESET_CODE_TTL)
     return code, expiration
 
 
@@ -425,17 +833,51 @@ def email_to_idn(addr):
     return "%s@%s" % (prefix.encode('idna'), suffix.encode('idna'))
 
 
+def _hash_email(email):
+    """Returns the 32-character username for an email address"""
+    email = email_to_idn(email).lower()
+    hashed = sha1(email).digest()
+    return base64.b32encode(hashed).lower()
+
+
+# the most recent email -> username conversions
+_USERNAMES = LRUCache(10000)
+
+
 def extract_username(username):
     """Extracts the user name.
 
     Takes the username and if it is an email address, munges it down
-    to the corresponding 32-character username
+    to the corresponding 32-character username.
+
+    The conversions are memoized.
     """
     if '@' not in username:
         return username
-    username = email_to_idn(username).lower()
-    hashed = sha1(username).digest()
-    return base64.b32encode(hashed).lower()
+    hashed = _USERNAMES.get(username)
+    if hashed is None:
+        hashed = _hash_email(username)
+        _USERNAMES.set(username, hashed)
+    return hashed
+
+
+def extract_usernames(usernames):
+    """Extracts user names in bulk, for migration scripts.
+
+    Yields (username, extracted username) tuples. The extracted username
+    is None when the email address is not valid.
+
+    The memo used by extract_username is bypassed so big batches
+    don't evict the request-time entries.
+    """
+    for username in usernames:
+        if '@' not in username:
+            yield username, username
+            continue
+        try:
+            yield username, _hash_email(username)
+        except UnicodeError:
+            yield username, None
 
 
 class CatchErrorMiddleware(object):
@@ -565,16 +1007,191 @@ def proxy(request, scheme, netloc, timeout=5):
     return Response(body, status, headers.items())
 
 
+# upper bounds of the query latency histogram buckets, in seconds
+_QUERY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5.)
+
+
+class QueryStats(object):
+    """Per-statement query latency histograms.
+
+    Keeps at most max_statements statements. The next ones are counted
+    together under "other".
+    """
+    def __init__(self, max_statements=500):
+        self.max_statements = max_statements
+        self.slow_query_threshold = None
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, statement, params, duration):
+        """Records a query duration, and logs it if it's too slow."""
+        threshold = self.slow_query_threshold
+        if threshold is not None and duration >= threshold:
+            logger.warning('Slow query (%.3fs): %s -- params: %s'
+                           % (duration, statement, _params_shape(params)))
+
+        with self._lock:
+            stats = self._stats.get(statement)
+            if stats is None:
+                if len(self._stats) >= self.max_statements:
+                    statement = 'other'
+                    stats = self._stats.get(statement)
+                if stats is None:
+                    stats = [0, 0., 0.] + [0] * (len(_QUERY_BUCKETS) + 1)
+                    self._stats[statement] = stats
+            stats[0] += 1
+            stats[1] += duration
+            if duration > stats[2]:
+                stats[2] = duration
+            for index, bound in enumerate(_QUERY_BUCKETS):
+                if duration <= bound:
+                    stats[3 + index] += 1
+                    break
+            else:
+                stats[-1] += 1
+
+    def snapshot(self):
+        """Returns the stats of each statement.
+
+        The histogram is a list of (upper bound in ms, count) tuples, the
+        last bound being None.
+        """
+        bounds = [bound * 1000 for bound in _QUERY_BUCKETS] + [None]
+        res = {}
+        with self._lock:
+            for statement, stats in self._stats.items():
+                res[statement] = {'count': stats[0],
+                                  'total_ms': stats[1] * 1000,
+                                  'max_ms': stats[2] * 1000,
+                                  'histogram': zip(bounds, stats[3:])}
+        return res
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def _params_shape(params):
+    """Describes the parameters of a query without their values"""
+    if not params:
+        return 'none'
+    if isinstance(params, (list, tuple)):
+        if params and isinstance(params[0], dict):
+            return '%d rows of %s' % (len(params), sorted(params[0].keys()))
+        return '%d values' % len(params)
+    if isinstance(params, dict):
+        return str(sorted(params.keys()))
+    return type(params).__name__
+
+
+_QUERIES = QueryStats()
+
+
+def set_slow_query_threshold(threshold):
+    """Logs the queries that take more than threshold seconds.
+
+    None disables the slow-query log.
+    """
+    if threshold is not None:
+        threshold = float(threshold)
+    _QUERIES.slow_query_threshold = threshold
+
+
+def get_query_stats():
+    """Returns the latency stats of the queries run with safe_execute"""
+    return _QUERIES.snapshot()
+
+
+_RETRIES = 2
+_RETRY_BACKOFF = 0.05
+
+# receives the outcome of the backend calls, see set_backend_health
+_HEALTH = None
+
+
+def set_backend_health(health):
+    """Reports the outcome of the backend calls to health.
+
+    health must provide "success" and "failure" methods. None disables
+    the reports.
+    """
+    global _HEALTH
+    _HEALTH = health
+
+
+def report_backend_call(success):
+    """Reports a backend call outcome. See set_backend_health."""
+    health = _HEALTH
+    if health is None:
+        return
+    if success:
+        health.success()
+    else:
+        health.failure()
+
+
+def set_retry_policy(retries=2, backoff=0.05):
+    """Sets how safe_execute retries the failing read queries.
+
+    Args:
+        retries: maximum number of retries. 0 disables them
+        backoff: base delay in seconds. It doubles after each attempt,
+                 and a random part of it is used.
+    """
+    global _RETRIES, _RETRY_BACKOFF
+    _RETRIES = int(retries)
+    _RETRY_BACKOFF = float(backoff)
+
+
+def _is_idempotent(query):
+    if isinstance(query, basestring):
+        return query.lstrip()[:6].lower() == 'select'
+    return isinstance(query, Select)
+
+
 def safe_execute(engine, *args, **kwargs):
     """Execution wrapper that will raise a HTTPServiceUnavailableError
     on any OperationalError errors and log it.
+
+    Select queries are retried a few times before giving up, with a
+    jittered exponential backoff. See set_retry_policy. SQLAlchemy
+    invalidates the pooled connections on disconnections, so the retries
+    use fresh connections.
+
+    The duration of each query is recorded, see get_query_stats.
     """
-    try:
-        return engine.execute(*args, **kwargs)
-    except OperationalError:
-        err = traceback.format_exc()
-        logger.error(err)
-        raise BackendError()
+    attempt = 0
+    while True:
+        start = time.time()
+        try:
+            res = engine.execute(*args, **kwargs)
+            break
+        except OperationalError, e:
+            if attempt < _RETRIES and args and _is_idempotent(args[0]):
+                attempt += 1
+                delay = random.uniform(0, _RETRY_BACKOFF * 2 ** attempt)
+                logger.warning('Query failed, retrying in %.3fs (%d/%d): %s'
+                               % (delay, attempt, _RETRIES, e))
+                time.sleep(delay)
+                continue
+            err = traceback.format_exc()
+            logger.error(err)
+            report_backend_call(False)
+            raise BackendError()
+
+    report_backend_call(True)
+    duration = time.time() - start
+    context = getattr(res, 'context', None)
+    statement = getattr(context, 'statement', None)
+    if statement is not None:
+        if kwargs:
+            params = kwargs
+        elif len(args) > 1:
+            params = args[1]
+        else:
+            params = None
+        _QUERIES.record(statement, params, duration)
+    return res
 
 
 def get_source_ip(environ):
@@ -584,3 +1201,35 @@ def get_source_ip(environ):
     elif 'REMOTE_ADDR' in environ:
         return environ['REMOTE_ADDR']
     return None
+
+
+def split_proxies(proxies):
+    """Returns the set of the proxies addresses of a config value.
+
+    The value can be a list, or a comma-separated string.
+    """
+    if not proxies:
+        return set()
+    if isinstance(proxies, basestring):
+        proxies = proxies.split(',')
+    return set([proxy.strip() for proxy in proxies])
+
+
+def get_client_ip(environ, trusted_proxies=()):
+    """Extracts the client IP from the environ.
+
+    Unlike get_source_ip, X-Forwarded-For is only used when the request
+    comes from one of the trusted proxies. The client IP is then its last
+    address that is not a trusted proxy, since the client can put anything
+    in the first ones.
+    """
+    remote = environ.get('REMOTE_ADDR')
+    if remote not in trusted_proxies:
+        return remote
+
+    forwarded = environ.get('HTTP_X_FORWARDED_FOR', '')
+    for address in reversed(forwarded.split(',')):
+        address = address.strip()
+        if address and address not in trusted_proxies:
+            return address
+    return remote
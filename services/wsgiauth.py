@@ -38,20 +38,134 @@ Authentication class.
 """
 import binascii
 import base64
+import threading
+import time
 
-from webob.exc import HTTPUnauthorized, HTTPBadRequest
-from cef import log_cef
+from webob.exc import (HTTPUnauthorized, HTTPBadRequest,
+                       HTTPServiceUnavailable)
 
 from services.auth import get_auth
-from services.util import extract_username
+from services.cef import log_cef, ACCOUNT_LOCKED, AUTH_FAILURE
+from services.util import (extract_username, filter_params, split_proxies,
+                           get_client_ip)
+
+
+class FailureTracker(object):
+    """Counts failures per key over a sliding window of `window` seconds.
+
+    Each key only keeps the count of the current and of the previous
+    period. The sliding count is estimated by weighting the previous count
+    by the part of the window that still overlaps it.
+
+    Keys with no recent failures are swept every `sweep_interval` seconds.
+    At most `max_keys` keys are tracked: when full, the failures of new
+    keys are not counted until a sweep makes room.
+    """
+    def __init__(self, window=300, sweep_interval=60, max_keys=10000):
+        self.window = float(window)
+        self.sweep_interval = float(sweep_interval)
+        self.max_keys = int(max_keys)
+        # key -> [period, current count, previous count]
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def __len__(self):
+        return len(self._counters)
+
+    def _count(self, counter, now):
+        period = int(now / self.window)
+        if counter[0] == period:
+            current, previous = counter[1], counter[2]
+        elif counter[0] == period - 1:
+            current, previous = 0, counter[1]
+        else:
+            return 0.
+        elapsed = (now % self.window) / self.window
+        return current + previous * (1. - elapsed)
+
+    def count(self, key):
+        """Returns the number of failures in the last window."""
+        counter = self._counters.get(key)
+        if counter is None:
+            return 0.
+        return self._count(counter, time.time())
+
+    def add(self, key):
+        """Records a failure."""
+        now = time.time()
+        period = int(now / self.window)
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None and len(self._counters) >= self.max_keys:
+                self._sweep(period)
+                self._last_sweep = now
+                if len(self._counters) >= self.max_keys:
+                    return
+
+            if counter is None:
+                self._counters[key] = [period, 1, 0]
+            elif counter[0] == period:
+                counter[1] += 1
+            elif counter[0] == period - 1:
+                counter[:] = [period, 1, counter[1]]
+            else:
+                counter[:] = [period, 1, 0]
+
+            if now - self._last_sweep >= self.sweep_interval:
+                self._sweep(period)
+                self._last_sweep = now
+
+    def reset(self, key):
+        """Forgets the failures of a key."""
+        with self._lock:
+            self._counters.pop(key, None)
+
+    def _sweep(self, period):
+        for key, counter in self._counters.items():
+            if counter[0] < period - 1:
+                del self._counters[key]
 
 
 class Authentication(object):
-    """Authentication tool. defines the authentication strategy"""
+    """Authentication tool. defines the authentication strategy
+
+    The brute-force protection counts the failures per user and per
+    client IP. The client IP is REMOTE_ADDR, or when the request comes from
+    one of the "auth_throttle.trusted_proxies", the last address of
+    X-Forwarded-For that is not a trusted proxy.
+    """
     def __init__(self, config):
         self.config = config
         self.backend = get_auth(self.config)
 
+        # brute-force protection
+        throttle = filter_params('auth_throttle', self.config)
+        if throttle.get('use', False):
+            window = throttle.get('window', 300)
+            self.max_user_failures = throttle.get('max_user_failures', 10)
+            self.max_ip_failures = throttle.get('max_ip_failures', 100)
+            max_sources = throttle.get('max_sources', 10000)
+            self.trusted_proxies = split_proxies(
+                    throttle.get('trusted_proxies'))
+            self.retry_after = int(window)
+            self.user_failures = FailureTracker(window,
+                                                max_keys=max_sources)
+            self.ip_failures = FailureTracker(window, max_keys=max_sources)
+        else:
+            self.user_failures = self.ip_failures = None
+            self.trusted_proxies = set()
+
+    def _client_ip(self, environ):
+        """Returns the client IP, trusting only the configured proxies."""
+        return get_client_ip(environ, self.trusted_proxies)
+
+    def close(self):
+        """Closes the backend connections, if it holds any."""
+        close = getattr(self.backend, 'close', None)
+        if close is not None:
+            close()
+
     def check(self, request, match):
         """Checks if the current request/match can be viewed.
 
@@ -117,16 +231,30 @@ class Authentication(object):
                                      'username', {}, 'Username must be BIDI ' +
                                      'compliant UTF-8')
 
+            # rejecting the call without reaching the backend if there
+            # were too many failures
+            if self.user_failures is not None:
+                self._check_failures(environ, config, user_name)
+
             # let's try an authentication
             user_id = self.backend.authenticate_user(user_name, password)
             if user_id is None:
+                if self.user_failures is not None:
+                    self.user_failures.add(user_name)
+                    self.ip_failures.add(self._client_ip(environ))
+
                 err = 'Authentication Failed for Backend service ' + user_name
                 if remote_user_original is not None and \
                     user_name != remote_user_original:
                         err += ' (%s)' % (remote_user_original)
-                log_cef(err, 5, environ, config)
+                # the signature keeps the user name out of the CEF
+                # throttling key
+                log_cef(err, 5, environ, config, signature=AUTH_FAILURE)
                 raise HTTPUnauthorized()
 
+            if self.user_failures is not None:
+                self.user_failures.reset(user_name)
+
             # we're all clear ! setting up REMOTE_USER
             request.remote_user = environ['REMOTE_USER'] = user_name
 
@@ -136,3 +264,17 @@ class Authentication(object):
             request._authorization = environ['HTTP_AUTHORIZATION']
             del environ['HTTP_AUTHORIZATION']
             return user_id
+
+    def _check_failures(self, environ, config, user_name):
+        """Raises a 401 if the user, or a 503 if the source IP, had too
+        many authentication failures."""
+        source = self._client_ip(environ)
+        if self.ip_failures.count(source) >= self.max_ip_failures:
+            log_cef('Too many authentication failures from this IP', 7,
+                    environ, config, signature=ACCOUNT_LOCKED)
+            raise HTTPServiceUnavailable(retry_after=self.retry_after)
+
+        if self.user_failures.count(user_name) >= self.max_user_failures:
+            log_cef('Too many authentication failures for ' + user_name, 7,
+                    environ, config, signature=ACCOUNT_LOCKED)
+            raise HTTPUnauthorized()